@@ -0,0 +1,104 @@
+"""
+Parity check and benchmark of evaluation/batch_rollout.py.
+
+The batched dynamics are checked against Multirotor._s_dot_fn on random states, and lockstep rollouts of GeoControl
+against per-vehicle rollouts with Multirotor.step (the script exits with an error on any mismatch). The per-vehicle
+steps use scipy's adaptive RK45 and the batched ones a fixed RK4 step, so closed-loop trajectories agree to a
+tolerance rather than exactly. Then the lockstep engine is timed against the per-vehicle loop on increasing swarms;
+the loop is timed on a few vehicles and extrapolated, since its cost is linear in the swarm size.
+
+Usage:
+    python benchmarks/bench_batch_rollout.py [--t-final 2] [--tol 1e-2]
+"""
+import os
+import sys
+import argparse
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from rotorpy.vehicles.multirotor import Multirotor
+from rotorpy.vehicles.hummingbird_params import quad_params
+from rotorpy.trajectories.lissajous_traj import TwoDLissajous
+from rotorpy.trajectories.circular_traj import CircularTraj
+from controller.geometric_control import GeoControl
+from evaluation.rollout import rollout
+from evaluation.batch_rollout import BatchMultirotor, batch_rollout
+
+
+def swarm(num_agents):
+    """
+    Lissajous and circular trajectories spread over a grid.
+    """
+    trajectories = []
+    for i in range(num_agents):
+        x_offset, y_offset = 3.0*(i % 20), 3.0*(i // 20)
+        if i % 2:
+            trajectories.append(TwoDLissajous(A=1, B=1, a=2, b=1, x_offset=x_offset, y_offset=y_offset, height=2.0))
+        else:
+            trajectories.append(CircularTraj(center=np.array([x_offset, y_offset, 2.0]), radius=1))
+    return trajectories
+
+
+def timed(fn, *args, **kwargs):
+    tic = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - tic
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--t-final', type=float, default=2, help='duration of the rollouts [s]')
+    parser.add_argument('--tol', type=float, default=1e-2, help='closed-loop position tolerance [m]')
+    args = parser.parse_args()
+
+    params = dict(quad_params, motor_noise_std=0)
+    batch_vehicle = BatchMultirotor(params)
+    vehicle = Multirotor(params)
+
+    mismatches = []
+    rng = np.random.default_rng(0)
+    s = np.concatenate([rng.normal(size=(64, 6)), rng.normal(size=(64, 4)), rng.normal(size=(64, 6)),
+                        rng.uniform(1000, 2500, (64, 4))], axis=1)
+    s[:, 6:10] /= np.linalg.norm(s[:, 6:10], axis=1, keepdims=True)
+    cmd = rng.uniform(1000, 2500, (64, 4))
+    reference = np.stack([vehicle._s_dot_fn(0, s[i], cmd[i]) for i in range(64)])
+    if not np.allclose(batch_vehicle.s_dot_batch(s, cmd), reference, rtol=1e-10, atol=1e-8):
+        mismatches.append('s_dot_batch differs from Multirotor._s_dot_fn')
+
+    trajectories = swarm(6)
+    _, states, _, _ = batch_rollout(batch_vehicle, GeoControl(params), trajectories, t_final=args.t_final)
+    for i, trajectory in enumerate(trajectories):
+        _, single, _, _ = rollout(vehicle, GeoControl(params), trajectory, 0, args.t_final, 1/100)
+        error = np.max(np.abs(states['x'][:, i] - single['x']))
+        if error > args.tol:
+            mismatches.append('vehicle {}: position differs by {:.2e} m'.format(i, error))
+    if mismatches:
+        print('\n'.join(mismatches))
+        sys.exit('Parity check failed: {} mismatches'.format(len(mismatches)))
+    print('Parity check passed')
+
+    params = dict(quad_params)
+    loop_vehicles = 4
+    trajectories = swarm(loop_vehicles)
+    tic = time.perf_counter()
+    for trajectory in trajectories:
+        rollout(Multirotor(params), GeoControl(params), trajectory, 0, args.t_final, 1/100)
+    loop_per_vehicle = (time.perf_counter() - tic) / loop_vehicles
+
+    print('{:>8s} {:>10s} {:>12s} {:>10s} {:>16s}'.format('agents', 'loop [s]', 'lockstep [s]', 'speedup',
+                                                          'vehicle-steps/s'))
+    num_steps = int(round(args.t_final*100)) + 1
+    for num_agents in (10, 50, 200, 500):
+        trajectories = swarm(num_agents)
+        _, lockstep_time = timed(batch_rollout, BatchMultirotor(params), GeoControl(params), trajectories,
+                                 t_final=args.t_final)
+        loop_time = loop_per_vehicle*num_agents
+        print('{:>8d} {:>10.2f} {:>12.2f} {:>10.1f} {:>16.0f}'.format(num_agents, loop_time, lockstep_time,
+                                                                    loop_time/lockstep_time,
+                                                                    num_agents*num_steps/lockstep_time))
+
+
+if __name__ == '__main__':
+    main()
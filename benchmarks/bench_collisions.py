@@ -0,0 +1,92 @@
+"""
+Parity check and benchmark of evaluation/collisions.py.
+
+Random-walk swarms are checked with the dense and the KD-tree detectors and compared with the per-timestep loop that
+run_eval.find_collisions used before (the script exits with an error on any mismatch). Then the detectors are timed on
+increasing swarm sizes.
+
+Usage:
+    python benchmarks/bench_collisions.py [--steps 2000] [--epsilon 0.2]
+"""
+import os
+import sys
+import argparse
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from evaluation.collisions import collision_events, find_collisions
+
+
+def find_collisions_loop(all_positions, epsilon):
+    """
+    The original implementation: full distance matrix per timestep.
+    """
+    N, M, _ = all_positions.shape
+    collisions = []
+    for t in range(N):
+        pos_t = all_positions[t]
+        dist_sq = np.sum((pos_t[:, np.newaxis, :] - pos_t[np.newaxis, :, :])**2, axis=-1)
+        np.fill_diagonal(dist_sq, np.inf)
+        for i, j in zip(*np.where(dist_sq < epsilon**2)):
+            if i < j:
+                collisions.append((t, i, j))
+    return collisions
+
+
+def random_swarm(num_steps, num_agents, extent, seed=0):
+    """
+    Agents random-walking in a cube whose side grows with the swarm, to keep the density comparable.
+    """
+    rng = np.random.default_rng(seed)
+    start = rng.uniform(-extent, extent, (1, num_agents, 3))
+    return start + np.cumsum(0.02 * rng.standard_normal((num_steps, num_agents, 3)), axis=0)
+
+
+def timed(fn, *args, **kwargs):
+    tic = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - tic
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--steps', type=int, default=2000, help='number of timesteps')
+    parser.add_argument('--epsilon', type=float, default=0.2, help='collision distance [m]')
+    args = parser.parse_args()
+
+    mismatches = []
+    for num_agents in (12, 60):
+        positions = random_swarm(400, num_agents, 0.5 * num_agents ** (1 / 3))
+        reference = find_collisions_loop(positions, args.epsilon)
+        for method in ('dense', 'kdtree'):
+            events = list(zip(*(values.tolist() for values in collision_events(positions, args.epsilon,
+                                                                                method=method))))
+            if events != reference:
+                mismatches.append('{} agents, {}: {} events vs {}'.format(num_agents, method, len(events),
+                                                                         len(reference)))
+            first = collision_events(positions, args.epsilon, first_contact_only=True, method=method)
+            expected = sorted({(i, j): (t, i, j) for t, i, j in reversed(reference)}.values())
+            if list(zip(*(values.tolist() for values in first))) != expected:
+                mismatches.append('{} agents, {}: first contacts differ'.format(num_agents, method))
+        if len(find_collisions(positions, args.epsilon)) != len(reference):
+            mismatches.append('{} agents: find_collisions differs'.format(num_agents))
+    if mismatches:
+        print('\n'.join(mismatches))
+        sys.exit('Parity check failed: {} mismatches'.format(len(mismatches)))
+    print('Parity check passed')
+
+    print('{:>8s} {:>8s} {:>10s} {:>10s} {:>10s} {:>10s}'.format('agents', 'steps', 'loop [s]', 'dense [s]',
+                                                                'kdtree [s]', 'events'))
+    for num_agents in (12, 50, 200, 500):
+        positions = random_swarm(args.steps, num_agents, 0.5 * num_agents ** (1 / 3))
+        loop_time = timed(find_collisions_loop, positions, args.epsilon)[1] if num_agents <= 200 else float('nan')
+        dense_time = timed(collision_events, positions, args.epsilon, method='dense')[1]
+        events, kdtree_time = timed(collision_events, positions, args.epsilon, method='kdtree')
+        print('{:>8d} {:>8d} {:>10.3f} {:>10.3f} {:>10.3f} {:>10d}'.format(num_agents, args.steps, loop_time,
+                                                                         dense_time, kdtree_time, len(events[0])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+"""
+Latency benchmark of all the controllers, with JSON output to compare runs over time.
+
+For each reference (hover, circle, Lissajous, MinSnap), (state, flat_output) samples are recorded once from a
+closed-loop rollout of rotorpy's SE3Control, then replayed in order through a fresh instance of each controller
+(GeoControl, L1_GeoControl, GeometricAdaptiveController, SE3Control and, if acados is installed,
+ModelPredictiveControl). Every call is timed, giving the mean, p50, p99 and max latency and the calls per second; a
+second replay under tracemalloc measures the memory allocated per call (peak traced bytes, NumPy buffers included).
+Controllers with update_batch() are also replayed with batches of vehicles, each vehicle at a different sample.
+
+Usage:
+    python benchmarks/bench_controller_latency.py [--samples 500] [--batch-sizes 1 10 100]
+                                                  [--output controller_latency.json] [--compare previous.json]
+"""
+import os
+import sys
+import json
+import argparse
+import platform
+import time
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from rotorpy.vehicles.hummingbird_params import quad_params
+from rotorpy.vehicles.multirotor import Multirotor
+from rotorpy.controllers.quadrotor_control import SE3Control
+from rotorpy.trajectories.hover_traj import HoverTraj
+from rotorpy.trajectories.circular_traj import CircularTraj
+from rotorpy.trajectories.lissajous_traj import TwoDLissajous
+from rotorpy.trajectories.minsnap import MinSnap
+from controller.math import HAS_NUMBA
+from controller.geometric_control import GeoControl
+from controller.geometric_control_l1 import L1_GeoControl
+from controller.geometric_adaptive_controller import GeometricAdaptiveController
+try:
+    from controller.quadrotor_control_mpc import ModelPredictiveControl
+except ImportError:
+    ModelPredictiveControl = None
+
+T_STEP = 1/100
+
+
+def trajectories():
+    return {'hover': HoverTraj(x0=np.array([0, 0, 1])),
+            'circle': CircularTraj(radius=2),
+            'lissajous': TwoDLissajous(A=1, B=1, a=2, b=1, height=2.0, yaw_bool=True),
+            'minsnap': MinSnap(points=np.array([[0, 0, 0], [1, 1, 1], [2, 0, 1.5], [0, -1, 1]]), v_avg=1.0,
+                               verbose=False)}
+
+
+def controllers(num_samples):
+    """
+    Factories of the benchmarked controllers, called with the reference trajectory.
+    """
+    factories = {'GeoControl': lambda trajectory: GeoControl(quad_params),
+                 'L1_GeoControl': lambda trajectory: L1_GeoControl(quad_params),
+                 'GeometricAdaptiveController': lambda trajectory: GeometricAdaptiveController(quad_params, T_STEP),
+                 'SE3Control': lambda trajectory: SE3Control(quad_params)}
+    if ModelPredictiveControl is not None:
+        factories['ModelPredictiveControl'] = lambda trajectory: ModelPredictiveControl(
+            quad_params, sim_rate=1/T_STEP, trajectory=trajectory, t_final=num_samples*T_STEP, t_horizon=0.5,
+            n_nodes=10)
+    return factories
+
+
+def record_samples(trajectory, num_samples):
+    """
+    Times and (state, flat_output) pairs of a closed-loop rollout of rotorpy's SE3Control on trajectory.
+    """
+    mav = Multirotor(quad_params)
+    controller = SE3Control(quad_params)
+    state = {'x': trajectory.update(0)['x'],
+             'v': np.zeros(3,),
+             'q': np.array([0, 0, 0, 1]),
+             'w': np.zeros(3,),
+             'wind': np.zeros(3,),
+             'rotor_speeds': np.array([1788.53, 1788.53, 1788.53, 1788.53])}
+    samples = []
+    for i in range(num_samples):
+        flat = trajectory.update(i * T_STEP)
+        samples.append((i * T_STEP, {key: state[key].copy() for key in ('x', 'v', 'q', 'w')}, flat))
+        state = mav.step(state, controller.update(i * T_STEP, state, flat), T_STEP)
+    return samples
+
+
+def batch_samples(samples, batch_size):
+    """
+    Per call, the (N,13) states and stacked flat outputs of batch_size vehicles spread over the samples.
+    """
+    states = np.array([np.concatenate([s['x'], s['v'], s['q'], s['w']]) for _, s, _ in samples])
+    flats = {key: np.array([f[key] for _, _, f in samples]) for key in samples[0][2]}
+    stride = max(1, len(samples) // batch_size)
+    calls = []
+    for i in range(len(samples)):
+        index = (i + stride*np.arange(batch_size)) % len(samples)
+        calls.append((samples[i][0], states[index], {key: values[index] for key, values in flats.items()}))
+    return calls
+
+
+def latency_stats(latencies, batch_size):
+    latencies = np.asarray(latencies)
+    p50, p99 = np.percentile(latencies, [50, 99])
+    return {'calls': int(latencies.size),
+            'mean_us': 1e6*float(latencies.mean()),
+            'p50_us': 1e6*float(p50),
+            'p99_us': 1e6*float(p99),
+            'max_us': 1e6*float(latencies.max()),
+            'calls_per_second': float(1/latencies.mean()),
+            'vehicles_per_second': float(batch_size/latencies.mean())}
+
+
+def replay(update, calls):
+    """
+    Calls update(*args) for every args of calls, timing each call. Then replays the calls again under tracemalloc
+    and returns the latencies and the mean peak of traced memory per call, in bytes.
+    """
+    latencies = np.empty(len(calls))
+    for i, args in enumerate(calls):
+        tic = time.perf_counter()
+        update(*args)
+        latencies[i] = time.perf_counter() - tic
+
+    peaks = np.empty(len(calls))
+    tracemalloc.start()
+    try:
+        for i, args in enumerate(calls):
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            update(*args)
+            peaks[i] = tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+    return latencies, float(peaks.mean())
+
+
+def run(num_samples, batch_sizes, warmup):
+    results = []
+    for traj_name, trajectory in trajectories().items():
+        samples = record_samples(trajectory, num_samples)
+        single_calls = [(t, state, flat) for t, state, flat in samples]
+        for name, factory in controllers(num_samples).items():
+            # Warm up on a separate instance (numba compilation, caches), then replay on a fresh one; the stateful
+            # controllers are rebuilt between the timed and the tracemalloc replays so both see the same history.
+            warm = factory(trajectory)
+            for args in single_calls[:warmup]:
+                warm.update(*args)
+            for batch_size in batch_sizes:
+                if batch_size == 1:
+                    controller = factory(trajectory)
+                    latencies, _ = replay(controller.update, single_calls)
+                    controller = factory(trajectory)
+                    _, alloc = replay(controller.update, single_calls)
+                    method = 'update'
+                elif hasattr(warm, 'update_batch'):
+                    calls = batch_samples(samples, batch_size)
+                    warm.update_batch(*calls[0])
+                    controller = factory(trajectory)
+                    latencies, _ = replay(controller.update_batch, calls)
+                    controller = factory(trajectory)
+                    _, alloc = replay(controller.update_batch, calls)
+                    method = 'update_batch'
+                else:
+                    continue
+                stats = latency_stats(latencies, batch_size)
+                stats.update(controller=name, trajectory=traj_name, method=method, batch_size=batch_size,
+                             alloc_bytes_per_call=alloc)
+                results.append(stats)
+                print('{:<28s} {:<10s} {:>6d} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>12.0f} {:>12.0f}'.format(
+                    name, traj_name, batch_size, stats['mean_us'], stats['p50_us'], stats['p99_us'], stats['max_us'],
+                    stats['calls_per_second'], alloc))
+    return results
+
+
+def compare(results, previous):
+    """
+    Prints the ratio of the mean latencies to those of a previous run.
+    """
+    before = {(r['controller'], r['trajectory'], r['batch_size']): r for r in previous['results']}
+    print('\nmean latency vs {}'.format(previous.get('date', 'previous run')))
+    for r in results:
+        key = (r['controller'], r['trajectory'], r['batch_size'])
+        if key in before:
+            print('{:<28s} {:<10s} {:>6d} {:>10.1f} -> {:>10.1f} us ({:+.1f}%)'.format(
+                *key, before[key]['mean_us'], r['mean_us'], 100*(r['mean_us']/before[key]['mean_us'] - 1)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', type=int, default=500, help='number of recorded samples per trajectory')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 10, 100],
+                        help='batch sizes, 1 times update() and larger ones update_batch()')
+    parser.add_argument('--warmup', type=int, default=20, help='untimed calls before each controller is timed')
+    parser.add_argument('--output', default='controller_latency.json', help='JSON file of the results')
+    parser.add_argument('--compare', default=None, help='JSON file of a previous run to compare with')
+    args = parser.parse_args()
+
+    if ModelPredictiveControl is None:
+        print('acados is not installed, skipping ModelPredictiveControl')
+    print('{:<28s} {:<10s} {:>6s} {:>10s} {:>10s} {:>10s} {:>10s} {:>12s} {:>12s}'.format(
+        'controller', 'trajectory', 'batch', 'mean [us]', 'p50 [us]', 'p99 [us]', 'max [us]', 'calls/s',
+        'alloc [B]'))
+    results = run(args.samples, args.batch_sizes, args.warmup)
+
+    report = {'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'platform': platform.platform(),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'numba': HAS_NUMBA,
+              'samples': args.samples,
+              'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Results written to {}'.format(args.output))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Micro-benchmark of the per-call latency of the geometric controllers.
+
+Times GeoControl and L1_GeoControl on a Lissajous reference, both through the single-vehicle update()
+(in a closed-loop rollout) and through the batched update_batch() (replaying a fixed set of recorded
+(state, flat_output) samples).
+
+Usage:
+    python benchmarks/bench_controller_update.py [--calls 1000] [--repeat 5] [--batch 100]
+"""
+import os
+import sys
+import argparse
+import time
+import timeit
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from rotorpy.vehicles.hummingbird_params import quad_params
+from rotorpy.vehicles.multirotor import Multirotor
+from rotorpy.controllers.quadrotor_control import SE3Control
+from rotorpy.trajectories.lissajous_traj import TwoDLissajous
+from controller.geometric_control import GeoControl
+from controller.geometric_control_l1 import L1_GeoControl
+
+
+TRAJECTORY = TwoDLissajous(A=1, B=1, a=2, b=1, height=2.0, yaw_bool=True)
+T_STEP = 1/100
+
+
+def initial_state():
+    return {'x': TRAJECTORY.update(0)['x'],
+            'v': np.zeros(3,),
+            'q': np.array([0, 0, 0, 1]),
+            'w': np.zeros(3,),
+            'wind': np.zeros(3,),
+            'rotor_speeds': np.array([1788.53, 1788.53, 1788.53, 1788.53])}
+
+
+def make_samples(num_samples):
+    """
+    Records (state, flat_output) pairs from a closed-loop rollout of rotorpy's SE3Control on the reference.
+    """
+    mav = Multirotor(quad_params)
+    controller = SE3Control(quad_params)
+    state = initial_state()
+    samples = []
+    for i in range(num_samples):
+        flat = TRAJECTORY.update(i * T_STEP)
+        samples.append(({key: state[key] for key in ('x', 'v', 'q', 'w')}, flat))
+        state = mav.step(state, controller.update(i * T_STEP, state, flat), T_STEP)
+    return samples
+
+
+def stack_samples(samples):
+    """
+    Stacks (state, flat_output) pairs into the (N,13) states and flat output dict used by update_batch().
+    """
+    states = np.array([np.concatenate([s['x'], s['v'], s['q'], s['w']]) for s, _ in samples])
+    flats = {key: np.array([f[key] for _, f in samples]) for key in samples[0][1]}
+    return states, flats
+
+
+def bench_update(controller_class, calls, repeat):
+    """
+    Per-call latency of controller.update() in microseconds. The controller flies the reference in closed
+    loop with rotorpy's Multirotor so that stateful controllers see consistent data; only the update() call
+    is timed. Returns the best mean over repeat rollouts, each with a fresh controller.
+    """
+    best = np.inf
+    for _ in range(repeat):
+        controller = controller_class(quad_params)
+        mav = Multirotor(quad_params)
+        state = initial_state()
+        elapsed = 0.0
+        for i in range(calls):
+            flat = TRAJECTORY.update(i * T_STEP)
+            tic = time.perf_counter()
+            control = controller.update(i * T_STEP, state, flat)
+            elapsed += time.perf_counter() - tic
+            state = mav.step(state, control, T_STEP)
+        best = min(best, elapsed / calls)
+    return best * 1e6
+
+
+def bench_update_batch(controller, samples, calls, repeat):
+    """
+    Per-vehicle latency of controller.update_batch() in microseconds (best of repeat runs).
+    """
+    states, flats = stack_samples(samples)
+    calls = max(1, calls // len(samples))
+    best = min(timeit.repeat(lambda: controller.update_batch(0.0, states, flats), number=calls, repeat=repeat))
+    return best / calls / len(samples) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=1000, help='number of calls per timing run')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timing runs (best is reported)')
+    parser.add_argument('--batch', type=int, default=100, help='batch size for update_batch')
+    args = parser.parse_args()
+
+    samples = make_samples(args.batch)
+    print('{:<16s} {:>22s} {:>28s}'.format('controller', 'update [us/call]', 'update_batch [us/vehicle]'))
+    for controller_class in (GeoControl, L1_GeoControl):
+        single = bench_update(controller_class, args.calls, args.repeat)
+        batched = bench_update_batch(controller_class(quad_params), samples, args.calls, args.repeat)
+        print('{:<16s} {:>22.1f} {:>28.2f}'.format(controller_class.__name__, single, batched))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Parity check and micro-benchmark of the JIT kernels in controller/math.py against the NumPy implementations.
+
+Every kernel is first compared with its NumPy counterpart on random inputs (the script exits with an error on
+any mismatch), then both are timed. Without numba installed the kernels run as plain python, so the parity
+check is still meaningful but the timings are not.
+
+Usage:
+    python benchmarks/bench_math_kernels.py [--samples 200] [--calls 20000]
+"""
+import os
+import sys
+import argparse
+import timeit
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from controller.math import (HAS_NUMBA, cross, skew, vee, normalize, deriv_unit_vector,
+                             cross_kernel, skew_kernel, vee_kernel, normalize_kernel, deriv_unit_vector_kernel,
+                             geometric_control_kernel)
+from controller.geometric_control import position_control, attitude_control, desired_from_flat_output
+
+
+def random_case(rng):
+    """
+    Random inputs for the geometric control law.
+    """
+    flat = {'x': rng.standard_normal(3), 'x_dot': rng.standard_normal(3), 'x_ddot': rng.standard_normal(3),
+            'x_dddot': rng.standard_normal(3), 'x_ddddot': rng.standard_normal(3),
+            'yaw': rng.uniform(-np.pi, np.pi), 'yaw_dot': rng.standard_normal(), 'yaw_ddot': rng.standard_normal()}
+    return {'x': rng.standard_normal(3), 'v': rng.standard_normal(3),
+            'R': Rotation.random(random_state=rng.integers(1 << 31)).as_matrix(), 'W': rng.standard_normal(3),
+            'desired': desired_from_flat_output(flat),
+            'k': {'x': np.array([4.0, 4.0, 9.0]), 'v': np.array([2.0, 2.0, 4.0]),
+                  'R': 0.3 * np.ones(3), 'W': 0.03 * np.ones(3)},
+            'm': 0.5, 'J': np.diag([3.65e-3, 3.68e-3, 7.03e-3])}
+
+
+def control_numpy(c):
+    f, Rc, Wc, Wc_dot, error = position_control(c['x'], c['v'], c['R'], c['W'], c['desired'], c['k'], c['m'])
+    M, eR, eW = attitude_control(c['R'], c['W'], Rc, Wc, Wc_dot, c['k'], c['J'])
+    return f, M, Rc, Wc, error['x'], error['v'], eR, eW
+
+
+def control_kernel(c):
+    d, k = c['desired'], c['k']
+    return geometric_control_kernel(c['x'], c['v'], c['R'], c['W'],
+                                    d['x'], d['v'], d['x_2dot'], d['x_3dot'], d['x_4dot'], d['b1'], d['b1_dot'], d['b1_2dot'],
+                                    k['x'], k['v'], k['R'], k['W'], c['m'], c['J'])
+
+
+def check_parity(num_samples, seed=0):
+    """
+    Compares every kernel with its NumPy counterpart. Returns a list of mismatch descriptions.
+    """
+    rng = np.random.default_rng(seed)
+    mismatches = []
+
+    def compare(name, reference, result):
+        if not np.allclose(reference, result, rtol=1e-9, atol=1e-12):
+            mismatches.append('{}: {} != {}'.format(name, reference, result))
+
+    for _ in range(num_samples):
+        a, b, c = rng.standard_normal((3, 3))
+        compare('cross', cross(a, b), cross_kernel(a, b))
+        compare('skew', skew(a), skew_kernel(a))
+        compare('vee', vee(skew(a)), vee_kernel(skew(a)))
+        compare('normalize', normalize(a), normalize_kernel(a))
+        for name, r, k in zip(('u', 'u_dot', 'u_ddot'), deriv_unit_vector(a, b, c), deriv_unit_vector_kernel(a, b, c)):
+            compare('deriv_unit_vector ' + name, r, k)
+        case = random_case(rng)
+        names = ('f', 'M', 'Rc', 'Wc', 'ex', 'ev', 'eR', 'eW')
+        for name, r, k in zip(names, control_numpy(case), control_kernel(case)):
+            compare('geometric_control ' + name, r, k)
+    return mismatches
+
+
+def per_call_us(func, calls):
+    func()  # trigger compilation outside of the timed region
+    return min(timeit.repeat(func, number=calls, repeat=3)) / calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', type=int, default=200, help='number of random cases for the parity check')
+    parser.add_argument('--calls', type=int, default=20000, help='number of calls per timing run')
+    args = parser.parse_args()
+
+    mismatches = check_parity(args.samples)
+    if mismatches:
+        print('\n'.join(mismatches))
+        sys.exit('Parity check failed: {} mismatches'.format(len(mismatches)))
+    print('Parity check passed on {} random cases (numba installed: {})'.format(args.samples, HAS_NUMBA))
+
+    rng = np.random.default_rng(1)
+    a, b, c = rng.standard_normal((3, 3))
+    case = random_case(rng)
+    rows = [('cross', lambda: cross(a, b), lambda: cross_kernel(a, b)),
+            ('skew', lambda: skew(a), lambda: skew_kernel(a)),
+            ('vee', lambda: vee(case['R']), lambda: vee_kernel(case['R'])),
+            ('normalize', lambda: normalize(a), lambda: normalize_kernel(a)),
+            ('deriv_unit_vector', lambda: deriv_unit_vector(a, b, c), lambda: deriv_unit_vector_kernel(a, b, c)),
+            ('geometric_control', lambda: control_numpy(case), lambda: control_kernel(case))]
+    print('{:<20s} {:>14s} {:>14s}'.format('kernel', 'numpy [us]', 'jit [us]'))
+    for name, numpy_func, kernel_func in rows:
+        calls = args.calls // 20 if name == 'geometric_control' else args.calls
+        print('{:<20s} {:>14.2f} {:>14.2f}'.format(name, per_call_us(numpy_func, calls), per_call_us(kernel_func, calls)))
+
+
+if __name__ == '__main__':
+    main()
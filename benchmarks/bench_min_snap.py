@@ -0,0 +1,99 @@
+"""
+Parity check and benchmark of the vectorized minimum_snap_trajectory_generator in controller/quadrotor_util.py.
+
+The batched building blocks are first compared with the per-sample functions they replace (the script exits with an
+error on any mismatch): rotation_matrix_to_quat_batch vs rotation_matrix_to_quat (pyquaternion),
+undo_quaternion_flips vs sequential undo_quaternion_flip, and column-wise q_dot_q vs per-sample q_dot_q. Then the
+reference generation is timed for increasing trajectory lengths.
+
+Usage:
+    python benchmarks/bench_min_snap.py [--samples 2000] [--rate 100]
+"""
+import os
+import sys
+import io
+import argparse
+import contextlib
+import time
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from rotorpy.vehicles.hummingbird_params import quad_params
+from rotorpy.trajectories.circular_traj import CircularTraj
+from rotorpy.trajectories.lissajous_traj import TwoDLissajous
+from controller.quadrotor_util import (rotation_matrix_to_quat, rotation_matrix_to_quat_batch, undo_quaternion_flip,
+                                       undo_quaternion_flips, q_dot_q, minimum_snap_trajectory_generator)
+
+
+def check_parity(num_samples, seed=0):
+    """
+    Compares the batched helpers with their per-sample counterparts. Returns a list of mismatch descriptions.
+    """
+    rng = np.random.default_rng(seed)
+    mismatches = []
+
+    def compare(name, reference, result):
+        if not np.allclose(reference, result, rtol=1e-9, atol=1e-12):
+            mismatches.append('{}: max abs error {:.3e}'.format(name, np.max(np.abs(reference - result))))
+
+    rot = Rotation.random(num_samples, random_state=seed).as_matrix()
+    compare('rotation_matrix_to_quat_batch', np.array([rotation_matrix_to_quat(r) for r in rot]),
+            rotation_matrix_to_quat_batch(rot))
+
+    # Slowly rotating series with random sign flips
+    q = np.cumsum(0.05 * rng.standard_normal((num_samples, 4)), 0) + np.array([1.0, 0.0, 0.0, 0.0])
+    q = q / np.linalg.norm(q, axis=1, keepdims=True) * rng.choice([-1.0, 1.0], (num_samples, 1))
+    for start in (1, 2):
+        sequential = q.copy()
+        for i in range(start, num_samples):
+            sequential[i] = undo_quaternion_flip(sequential[i - 1], sequential[i])
+        compare('undo_quaternion_flips(start={})'.format(start), sequential, undo_quaternion_flips(q, start=start))
+
+    r = rng.standard_normal((num_samples, 4))
+    compare('q_dot_q (column-wise)', np.array([q_dot_q(a, b) for a, b in zip(q, r)]), q_dot_q(q.T, r.T).T)
+    return mismatches
+
+
+def sample_trajectory(traj, t_final, rate):
+    """
+    Samples traj like QuadMPC.prepare_ref_traj does.
+    """
+    num_samples = int(t_final * rate)
+    t_ref = np.linspace(0, t_final, num_samples)
+    traj_d = np.zeros((4, 3, num_samples))
+    yaw_d = np.zeros((2, num_samples))
+    for i, t in enumerate(t_ref):
+        flat = traj.update(t)
+        traj_d[:, :, i] = (flat['x'], flat['x_dot'], flat['x_ddot'], flat['x_dddot'])
+        yaw_d[:, i] = (flat['yaw'], flat['yaw_dot'])
+    return traj_d, yaw_d, t_ref
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', type=int, default=2000, help='number of samples for the parity check')
+    parser.add_argument('--rate', type=float, default=100, help='reference sampling rate [Hz]')
+    args = parser.parse_args()
+
+    mismatches = check_parity(args.samples)
+    if mismatches:
+        print('\n'.join(mismatches))
+        sys.exit('Parity check failed: {} mismatches'.format(len(mismatches)))
+    print('Parity check passed on {} samples'.format(args.samples))
+
+    print('{:<16s} {:>10s} {:>10s} {:>16s}'.format('trajectory', 't_final', 'samples', 'generation [ms]'))
+    for name, traj in (('circle', CircularTraj(radius=2)),
+                       ('lissajous_yaw', TwoDLissajous(A=1, B=1, a=2, b=1, height=2.0, yaw_bool=True))):
+        for t_final in (10, 60, 300):
+            traj_d, yaw_d, t_ref = sample_trajectory(traj, t_final, args.rate)
+            with contextlib.redirect_stdout(io.StringIO()):  # the generator prints the yaw rate adaption
+                tic = time.perf_counter()
+                minimum_snap_trajectory_generator(traj_d, yaw_d, t_ref, quad_params)
+                elapsed = time.perf_counter() - tic
+            print('{:<16s} {:>10d} {:>10d} {:>16.1f}'.format(name, t_final, len(t_ref), elapsed * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Parity check and micro-benchmark of controller/rotation.py against scipy's Rotation.
+
+The conversions are first compared with scipy on random rotations (the script exits with an error on any
+mismatch), then both are timed: per conversion, per controller tick (the conversions each controller
+performs in one update()), and batched over N vehicles.
+
+Usage:
+    python benchmarks/bench_rotation.py [--samples 1000] [--calls 20000] [--batch 100]
+"""
+import os
+import sys
+import argparse
+import timeit
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from controller.math import HAS_NUMBA
+from controller.rotation import (quat_to_rotmat, rotmat_to_quat, quat_multiply, quat_inverse,
+                                 quat_to_rotmat_batch, rotmat_to_quat_batch, quat_multiply_batch, quat_inverse_batch)
+
+
+def scipy_tilt_error(q, q_des):
+    return (Rotation.from_quat(q).inv() * Rotation.from_quat(q_des)).as_quat()
+
+
+def fast_tilt_error(q, q_des):
+    q_e = quat_multiply(quat_inverse(q), q_des)
+    return q_e / np.linalg.norm(q_e)
+
+
+def check_parity(num_samples, seed=0):
+    """
+    Compares the conversions with scipy. Returns a list of mismatch descriptions.
+    """
+    rotations = Rotation.random(num_samples, random_state=seed)
+    # Include the identity and half turns, where Shepperd's method switches branches.
+    rotations = Rotation.concatenate([rotations, Rotation.from_quat(np.vstack([np.eye(4), [1.0, 1.0, 0.0, 0.0]]))])
+    Q, R = rotations.as_quat(), rotations.as_matrix()
+    Q_prev = np.roll(Q, 1, axis=0)
+    mismatches = []
+
+    def compare(name, reference, result):
+        if not np.allclose(reference, result, rtol=1e-9, atol=1e-12):
+            mismatches.append('{}: max abs error {:.3e}'.format(name, np.max(np.abs(reference - result))))
+
+    compare('quat_to_rotmat_batch', R, quat_to_rotmat_batch(Q))
+    Q_from_R = Rotation.from_matrix(R).as_quat()  # may differ in sign from Q
+    compare('rotmat_to_quat_batch', Q_from_R, rotmat_to_quat_batch(R))
+    compare('quat_multiply_batch', (rotations.inv() * Rotation.from_quat(Q_prev)).as_quat(),
+            quat_multiply_batch(quat_inverse_batch(Q), Q_prev))
+    compare('quat_to_rotmat', R, np.array([quat_to_rotmat(q) for q in Q]))
+    compare('rotmat_to_quat', Q_from_R, np.array([rotmat_to_quat(r) for r in R]))
+    compare('quat_multiply', np.array([scipy_tilt_error(q, p) for q, p in zip(Q, Q_prev)]),
+            np.array([fast_tilt_error(q, p) for q, p in zip(Q, Q_prev)]))
+    return mismatches
+
+
+def per_call_us(func, calls):
+    func()  # trigger compilation outside of the timed region
+    return min(timeit.repeat(func, number=calls, repeat=3)) / calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', type=int, default=1000, help='number of random rotations for the parity check')
+    parser.add_argument('--calls', type=int, default=20000, help='number of calls per timing run')
+    parser.add_argument('--batch', type=int, default=100, help='batch size for the *_batch conversions')
+    args = parser.parse_args()
+
+    mismatches = check_parity(args.samples)
+    if mismatches:
+        print('\n'.join(mismatches))
+        sys.exit('Parity check failed: {} mismatches'.format(len(mismatches)))
+    print('Parity check passed on {} random rotations (numba installed: {})'.format(args.samples, HAS_NUMBA))
+
+    rotations = Rotation.random(args.batch, random_state=1)
+    Q, R = rotations.as_quat(), rotations.as_matrix()
+    q, r, q_des = Q[0], R[0], Q[1]
+    rows = [('quat -> matrix', lambda: Rotation.from_quat(q).as_matrix(), lambda: quat_to_rotmat(q)),
+            ('matrix -> quat', lambda: Rotation.from_matrix(r).as_quat(), lambda: rotmat_to_quat(r)),
+            ('inv(q) * q_des', lambda: scipy_tilt_error(q, q_des), lambda: fast_tilt_error(q, q_des)),
+            # GeoControl and L1_GeoControl convert the state to a matrix and the command back to a quaternion.
+            ('GeoControl tick', lambda: (Rotation.from_quat(q).as_matrix(), Rotation.from_matrix(r).as_quat()),
+             lambda: (quat_to_rotmat(q), rotmat_to_quat(r))),
+            # GeometricAdaptiveController additionally computes the tilt-prioritized quaternion error.
+            ('Adaptive tick', lambda: (Rotation.from_quat(q).as_matrix(), scipy_tilt_error(q, Rotation.from_matrix(r).as_quat())),
+             lambda: (quat_to_rotmat(q), fast_tilt_error(q, rotmat_to_quat(r)))),
+            ('batch quat -> matrix', lambda: Rotation.from_quat(Q).as_matrix(), lambda: quat_to_rotmat_batch(Q)),
+            ('batch matrix -> quat', lambda: Rotation.from_matrix(R).as_quat(), lambda: rotmat_to_quat_batch(R))]
+    print('{:<22s} {:>14s} {:>14s}'.format('operation', 'scipy [us]', 'fast [us]'))
+    for name, scipy_func, fast_func in rows:
+        calls = args.calls // 10 if name.startswith('batch') else args.calls
+        print('{:<22s} {:>14.2f} {:>14.2f}'.format(name, per_call_us(scipy_func, calls), per_call_us(fast_func, calls)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Check and benchmark of the controller reuse of evaluation/sweep.py for trajectory-bound controllers.
+
+A sweep worker builds ModelPredictiveControl once and re-targets it between tasks on different trajectories. The
+rollouts of a circle and a Lissajous task sharing one MPC must differ, and each must match the rollout of a sweep that
+builds its MPC for that trajectory alone (the script exits with an error otherwise). Then the reuse is timed against
+building a new controller per task. Requires acados.
+
+Usage:
+    python benchmarks/bench_sweep_controllers.py [--t-final 2]
+"""
+import os
+import sys
+import argparse
+import functools
+import tempfile
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from rotorpy.vehicles.hummingbird_params import quad_params
+from rotorpy.trajectories.circular_traj import CircularTraj
+from rotorpy.trajectories.lissajous_traj import TwoDLissajous
+from evaluation.sweep import Sweep
+from evaluation.storage import load_rollout
+try:
+    from controller.quadrotor_control_mpc import ModelPredictiveControl
+except ImportError:
+    ModelPredictiveControl = None
+
+
+def positions(sweep, results):
+    """
+    Positions of the rollouts of the results, by trajectory name.
+    """
+    by_id = {task['task_id']: task for task in sweep.tasks()}
+    out = {}
+    for result in results:
+        if result['status'] != 'ok':
+            sys.exit('Task {} failed: {}'.format(result['task_id'], result.get('error', result['status'])))
+        _, logs = load_rollout(os.path.join(sweep.output_dir, result['task_id']))
+        out[by_id[result['task_id']]['trajectory']] = np.array(logs['states']['x'])
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--t-final', type=float, default=2, help='duration of each rollout [s]')
+    args = parser.parse_args()
+    if ModelPredictiveControl is None:
+        sys.exit('acados is not installed, nothing to check')
+
+    mpc = functools.partial(ModelPredictiveControl, sim_rate=100, t_horizon=0.5, n_nodes=10)
+    trajectories = {'circle': CircularTraj(radius=1), 'lissajous': TwoDLissajous(A=1, B=1, a=2, b=1, height=1.0)}
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        sweep = Sweep({'controller': {'mpc': mpc}, 'trajectory': trajectories}, quad_params, t_final=args.t_final,
+                      output_dir=os.path.join(output_dir, 'shared'))
+        tic = time.perf_counter()
+        shared = positions(sweep, sweep.run(processes=1, resume=False))
+        shared_time = time.perf_counter() - tic
+
+        fresh = {}
+        tic = time.perf_counter()
+        for name, trajectory in trajectories.items():
+            alone = Sweep({'controller': {'mpc': mpc}, 'trajectory': {name: trajectory}}, quad_params,
+                          t_final=args.t_final, output_dir=os.path.join(output_dir, name))
+            fresh.update(positions(alone, alone.run(processes=1, resume=False)))
+        fresh_time = time.perf_counter() - tic
+
+    mismatches = []
+    if np.allclose(shared['circle'], shared['lissajous']):
+        mismatches.append('the circle and Lissajous tasks sharing one MPC have the same rollout')
+    for name in trajectories:
+        if not np.allclose(shared[name], fresh[name], atol=1e-6):
+            mismatches.append('{}: the reused MPC differs from a fresh one by {:.2e} m'.format(
+                name, np.max(np.abs(shared[name] - fresh[name]))))
+    if mismatches:
+        print('\n'.join(mismatches))
+        sys.exit('Check failed: {} mismatches'.format(len(mismatches)))
+    print('Check passed')
+    print('{} tasks: {:.2f} s with one re-targeted MPC, {:.2f} s with one MPC per task'.format(
+        len(trajectories), shared_time, fresh_time))
+
+
+if __name__ == '__main__':
+    main()
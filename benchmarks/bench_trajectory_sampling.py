@@ -0,0 +1,73 @@
+"""
+Parity check and benchmark of controller/trajectory_sampling.py.
+
+For every trajectory with a closed form (and one falling back to the loop), sample_trajectory is compared with calling
+trajectory.update per sample (the script exits with an error on any mismatch), then both are timed.
+
+Usage:
+    python benchmarks/bench_trajectory_sampling.py [--t-final 60] [--rate 100]
+"""
+import os
+import sys
+import argparse
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from rotorpy.trajectories.circular_traj import CircularTraj, ThreeDCircularTraj
+from rotorpy.trajectories.lissajous_traj import TwoDLissajous
+from rotorpy.trajectories.hover_traj import HoverTraj
+from rotorpy.trajectories.minsnap import MinSnap
+from controller.trajectory_sampling import sample_trajectory, sample_trajectory_loop
+
+
+def trajectories():
+    center = np.array([1.0, -0.5, 2.0])
+    for plane in ('XY', 'YZ', 'XZ'):
+        for direction in ('CCW', 'CW'):
+            yield 'circle_{}_{}'.format(plane, direction), CircularTraj(center=center, radius=2, plane=plane,
+                                                                        direction=direction, yaw_bool=True)
+    yield 'circle_3d', ThreeDCircularTraj(center=center, radius=np.array([1, 2, 0.5]),
+                                          freq=np.array([0.2, 0.3, 0.4]), yaw_bool=True)
+    yield 'lissajous', TwoDLissajous(A=1, B=1, a=2, b=1, delta=0.3, height=2.0)
+    yield 'lissajous_yaw', TwoDLissajous(A=1, B=1, a=2, b=1, height=2.0, yaw_bool=True)
+    yield 'hover', HoverTraj(x0=center)
+    yield 'minsnap (loop)', MinSnap(points=np.array([[0, 0, 0], [2, 1, 0], [3, -1, 1]]), v_avg=1.0, verbose=False)
+
+
+def timed(fn, *args):
+    tic = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - tic
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--t-final', type=float, default=60, help='duration of the sampled trajectory [s]')
+    parser.add_argument('--rate', type=float, default=100, help='sampling rate [Hz]')
+    args = parser.parse_args()
+
+    t = np.linspace(0, args.t_final, int(args.t_final * args.rate))
+    mismatches = []
+    print('{:<18s} {:>12s} {:>12s} {:>10s}'.format('trajectory', 'loop [ms]', 'batched [ms]', 'speedup'))
+    for name, traj in trajectories():
+        reference, loop_time = timed(sample_trajectory_loop, traj, t)
+        result, batched_time = timed(sample_trajectory, traj, t)
+        if reference.keys() != result.keys():
+            mismatches.append('{}: keys {} vs {}'.format(name, sorted(reference), sorted(result)))
+            continue
+        for key in reference:
+            if reference[key].shape != result[key].shape or not np.allclose(reference[key], result[key],
+                                                                            rtol=1e-12, atol=1e-12):
+                mismatches.append('{}: {} differs'.format(name, key))
+        print('{:<18s} {:>12.2f} {:>12.2f} {:>10.1f}'.format(name, loop_time * 1e3, batched_time * 1e3,
+                                                            loop_time / batched_time))
+    if mismatches:
+        print('\n'.join(mismatches))
+        sys.exit('Parity check failed: {} mismatches'.format(len(mismatches)))
+    print('Parity check passed on {} samples'.format(len(t)))
+
+
+if __name__ == '__main__':
+    main()
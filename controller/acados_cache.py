@@ -0,0 +1,132 @@
+"""
+Persistent cache of compiled acados OCP solvers.
+
+Generating and compiling the C code of an acados solver takes tens of seconds, while the solver only depends on the
+OCP formulation. Each formulation is fingerprinted (model dynamics, dimensions, horizon, cost, constraints and solver
+options) and built once into its own directory under the models directory; later constructions with the same
+fingerprint load the prebuilt shared library instead of regenerating and recompiling it.
+
+Builds are serialized across processes with a lock file per solver directory, so several MPC instances (e.g. the
+workers of a multiprocessing.Pool) can be constructed concurrently: the first one builds, the others wait and load.
+All paths are absolute and the working directory is never changed.
+"""
+import os
+import glob
+import shutil
+import hashlib
+from contextlib import contextmanager
+import numpy as np
+import casadi as cs
+from acados_template import AcadosOcpSolver
+try:
+    import fcntl
+except ImportError:  # not available on Windows, builds are then not locked
+    fcntl = None
+
+# Same location as before the cache existed: next to the repository root.
+ACADOS_MODELS_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'acados_models'))
+
+# Model attributes that define the generated code.
+MODEL_FIELDS = ('name', 'x', 'xdot', 'u', 'p', 'z', 'f_expl_expr', 'f_impl_expr', 'disc_dyn_expr',
+                'cost_y_expr', 'cost_y_expr_e', 'con_h_expr', 'con_h_expr_e')
+
+
+def _update_hash(h, value):
+    """
+    Feeds a canonical representation of value into the hash h. Unknown objects only contribute their type name, so
+    that memory addresses never leak into the fingerprint.
+    """
+    if isinstance(value, dict):
+        for key in sorted(value, key=str):
+            h.update(str(key).encode())
+            _update_hash(h, value[key])
+    elif isinstance(value, (list, tuple)):
+        h.update(b'[')
+        for item in value:
+            _update_hash(h, item)
+        h.update(b']')
+    elif isinstance(value, (np.ndarray, np.generic)):
+        value = np.ascontiguousarray(value)
+        h.update('{}{}'.format(value.dtype.str, value.shape).encode())
+        h.update(value.tobytes())
+    elif value is None or isinstance(value, (bool, int, float, str)):
+        h.update(repr(value).encode())
+    elif isinstance(value, (cs.MX, cs.SX, cs.DM)):
+        h.update(str(value).encode())
+    else:
+        h.update(type(value).__name__.encode())
+
+
+def ocp_fingerprint(ocp, *extra):
+    """
+    Hex digest identifying the solver generated from ocp. extra can hold additional values baked into the model that
+    should invalidate the cache when they change (e.g. the vehicle parameters).
+    """
+    h = hashlib.sha1()
+    for field in MODEL_FIELDS:
+        _update_hash(h, getattr(ocp.model, field, None))
+    for section in (ocp.dims, ocp.cost, ocp.constraints, ocp.solver_options):
+        _update_hash(h, vars(section))
+    _update_hash(h, ocp.parameter_values)
+    _update_hash(h, os.environ.get('ACADOS_SOURCE_DIR'))
+    _update_hash(h, list(extra))
+    return h.hexdigest()[:16]
+
+
+def solver_build_dir(models_dir, model_name, fingerprint):
+    """
+    Directory holding the JSON description and generated code of one cached solver.
+    """
+    return os.path.join(models_dir, '{}_{}'.format(model_name, fingerprint))
+
+
+@contextmanager
+def build_lock(build_dir):
+    """
+    Exclusive inter-process lock on the solver directory build_dir, held while it is built, loaded or removed.
+    """
+    os.makedirs(os.path.dirname(build_dir), exist_ok=True)
+    with open(build_dir + '.lock', 'w') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def solver_library_exists(code_export_directory, model_name):
+    """
+    Whether the shared library of the solver for model_name has been built in code_export_directory.
+    """
+    return len(glob.glob(os.path.join(code_export_directory, 'libacados_ocp_solver_{}.*'.format(model_name)))) > 0
+
+
+def load_or_build_solver(ocp, build_dir):
+    """
+    Returns an AcadosOcpSolver for ocp whose code lives in build_dir. The prebuilt library is loaded if present,
+    otherwise the C code is generated and compiled there first.
+    """
+    build_dir = os.path.abspath(build_dir)
+    model_name = ocp.model.name
+    ocp.code_export_directory = os.path.join(build_dir, 'c_generated_code')
+    json_file = os.path.join(build_dir, model_name + '_acados_ocp.json')
+    # Only written once the build succeeded, so a build that was interrupted (e.g. a killed worker) is redone.
+    marker = os.path.join(build_dir, 'build_complete')
+    with build_lock(build_dir):
+        if os.path.exists(marker) and solver_library_exists(ocp.code_export_directory, model_name):
+            return AcadosOcpSolver(ocp, json_file=json_file, build=False, generate=False)
+        os.makedirs(build_dir, exist_ok=True)
+        solver = AcadosOcpSolver(ocp, json_file=json_file)
+        open(marker, 'w').close()
+        return solver
+
+
+def clear_solver(build_dir):
+    """
+    Removes a cached solver so that it is rebuilt on the next construction.
+    """
+    with build_lock(build_dir):
+        if os.path.exists(build_dir):
+            shutil.rmtree(build_dir)
@@ -0,0 +1,90 @@
+"""
+Real-time feasibility monitoring of the MPC solves.
+
+The MPC re-solves every optimization_dt seconds, so on a flight computer each solve has to finish within that budget.
+DeadlineMonitor collects the statistics of every solve (QuadOptimizer.last_solve_stats: wall-clock solve time, acados
+time, SQP iterations, NLP and QP status, residuals if computed) and counts the solves that overran the budget.
+summary() gives the numbers of a run, format_summary() a short report to print at the end of it.
+"""
+import numpy as np
+
+# Fields of QuadOptimizer.last_solve_stats kept per solve
+SOLVE_FIELDS = ('solve_time', 'time_tot', 'sqp_iter', 'status', 'qp_status', 'res_stat', 'res_eq', 'res_ineq',
+                'res_comp')
+
+
+class DeadlineMonitor(object):
+    """
+    Per-solve statistics of an MPC and their deadline misses against budget (seconds).
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.records = {field: [] for field in SOLVE_FIELDS}
+
+    def record(self, solve_stats):
+        """
+        Adds the statistics of one solve, a dict like QuadOptimizer.last_solve_stats (missing fields are NaN).
+        Returns True if the solve missed the deadline.
+        """
+        for field, values in self.records.items():
+            values.append(solve_stats.get(field, np.nan))
+        return solve_stats['solve_time'] > self.budget
+
+    @property
+    def num_solves(self):
+        return len(self.records['solve_time'])
+
+    def misses(self):
+        """
+        Boolean array of the solves that exceeded the budget.
+        """
+        return np.array(self.records['solve_time']) > self.budget
+
+    def summary(self):
+        """
+        Dict of the run: budget, number of solves, deadline misses (count, rate, worst overrun), solve time
+        statistics (s), SQP iterations, failed solves (nonzero NLP or QP status) and the largest residuals.
+        """
+        summary = {'budget': self.budget, 'num_solves': self.num_solves}
+        if self.num_solves == 0:
+            return summary
+        records = {field: np.array(values, dtype=float) for field, values in self.records.items()}
+        solve_time = records['solve_time']
+        misses = solve_time > self.budget
+        summary.update({'num_misses': int(np.count_nonzero(misses)),
+                        'miss_rate': float(np.mean(misses)),
+                        'max_overrun': float(max(0.0, solve_time.max() - self.budget)),
+                        'mean_solve_time': float(solve_time.mean()),
+                        'p50_solve_time': float(np.percentile(solve_time, 50)),
+                        'p99_solve_time': float(np.percentile(solve_time, 99)),
+                        'max_solve_time': float(solve_time.max()),
+                        'budget_utilization': float(solve_time.mean() / self.budget),
+                        'mean_sqp_iter': float(np.mean(records['sqp_iter'])),
+                        'max_sqp_iter': int(np.max(records['sqp_iter'])),
+                        'num_failed': int(np.count_nonzero(records['status'])),
+                        'num_qp_failed': int(np.count_nonzero(np.nan_to_num(records['qp_status'])))})
+        for field in ('res_stat', 'res_eq', 'res_ineq', 'res_comp'):
+            summary['max_' + field] = float(np.nanmax(records[field])) if np.any(~np.isnan(records[field])) \
+                else float('nan')
+        summary['real_time_feasible'] = summary['num_misses'] == 0
+        return summary
+
+    def format_summary(self):
+        """
+        The summary as a few lines of text, times in milliseconds.
+        """
+        summary = self.summary()
+        if summary['num_solves'] == 0:
+            return 'MPC deadline: no solves'
+        report = ('MPC deadline {:.2f} ms: {} of {} solves missed ({:.1f}%), worst overrun {:.2f} ms\n'
+                  'solve time mean {:.2f} / p50 {:.2f} / p99 {:.2f} / max {:.2f} ms, '
+                  '{:.0f}% of the budget on average\n'
+                  'SQP iterations mean {:.1f} / max {}, {} failed solves, {} failed QPs').format(
+            1e3*summary['budget'], summary['num_misses'], summary['num_solves'], 100*summary['miss_rate'],
+            1e3*summary['max_overrun'], 1e3*summary['mean_solve_time'], 1e3*summary['p50_solve_time'],
+            1e3*summary['p99_solve_time'], 1e3*summary['max_solve_time'], 100*summary['budget_utilization'],
+            summary['mean_sqp_iter'], summary['max_sqp_iter'], summary['num_failed'], summary['num_qp_failed'])
+        if not np.isnan(summary['max_res_stat']):
+            report += '\nmax residuals stat {:.2e} eq {:.2e} ineq {:.2e} comp {:.2e}'.format(
+                summary['max_res_stat'], summary['max_res_eq'], summary['max_res_ineq'], summary['max_res_comp'])
+        return report
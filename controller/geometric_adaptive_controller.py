@@ -6,9 +6,9 @@ Farhad A. Goodarzi, Daewon Lee, and Taeyoung Lee.
 """
 
 import numpy as np
-from scipy.spatial.transform import Rotation
 from controller.controller_template import MultirotorControlTemplate
 from controller.math import *
+from controller.rotation import quat_to_rotmat, rotmat_to_quat, quat_multiply, quat_inverse
 class GeometricAdaptiveController(MultirotorControlTemplate):
     def __init__(self, vehicle_params, dt=0.01):
         """
@@ -54,8 +54,7 @@ class GeometricAdaptiveController(MultirotorControlTemplate):
         self.W_R = np.eye(3)
         
         # Initialize estimated uncertainties
-        self.bar_theta_x = np.zeros(3)
-        self.bar_theta_R = np.zeros(3)
+        self.reset()
         
         # Constants
         self.min_thrust = 0.1
@@ -64,6 +63,26 @@ class GeometricAdaptiveController(MultirotorControlTemplate):
         # Time step for the controller
         self.dt = dt
 
+    def reset(self):
+        """
+        Clears the estimated uncertainties, so that the controller can be reused for a new episode.
+        """
+        self.bar_theta_x = np.zeros(3)
+        self.bar_theta_R = np.zeros(3)
+
+    def get_state(self):
+        """
+        Snapshot of the estimated uncertainties, [bar_theta_x, bar_theta_R] of shape (6,).
+        """
+        return np.concatenate([self.bar_theta_x, self.bar_theta_R])
+
+    def set_state(self, state):
+        """
+        Restores a snapshot of get_state().
+        """
+        self.bar_theta_x = np.array(state[:3], dtype=float)
+        self.bar_theta_R = np.array(state[3:6], dtype=float)
+
     def update(self, t, state, flat_output):
         """
         Compute control inputs based on current state and desired flat outputs.
@@ -73,7 +92,7 @@ class GeometricAdaptiveController(MultirotorControlTemplate):
         """
       
         # Extract state and desired state
-        R = Rotation.from_quat(state['q']).as_matrix()
+        R = quat_to_rotmat(state['q'])
         w = state['w']
         yaw_des = flat_output['yaw']
         
@@ -114,7 +133,7 @@ class GeometricAdaptiveController(MultirotorControlTemplate):
 
     
         # Compute desired angular velocity
-        w_des = self.tilt_prioritized_control(state['q'], Rotation.from_matrix(R_des).as_quat())
+        w_des = self.tilt_prioritized_control(state['q'], rotmat_to_quat(R_des))
         eW = w_des-w  
         
         ## Geometric Adaptive Attitude control
@@ -161,9 +180,8 @@ class GeometricAdaptiveController(MultirotorControlTemplate):
             rate_cmd: Angular velocity command
         """
         # Get quaternion error (q_e = q^(-1) * q_des)
-        q_curr = Rotation.from_quat(q)
-        q_d = Rotation.from_quat(q_des)
-        q_e = (q_curr.inv() * q_d).as_quat()  # [x,y,z,w]
+        q_e = quat_multiply(quat_inverse(q), q_des)  # [x,y,z,w]
+        q_e = q_e / np.linalg.norm(q_e)  # same as normalizing q and q_des first
         
         # Extract components
         qe_w = q_e[3]  # w component is last in scipy
@@ -1,17 +1,255 @@
+import math
 import numpy as np
-from scipy.spatial.transform import Rotation
+from controller.rotation import quat_to_rotmat, rotmat_to_quat, quat_to_rotmat_batch, rotmat_to_quat_batch
+from controller.math import cross, deriv_unit_vector, skew, vee
+from controller.math import HAS_NUMBA, geometric_control_kernel
+from controller.math import wedge_batch, vee_batch, cross_batch, dot_batch, deriv_unit_vector_batch
 
 #import jax
 # import jax.numpy as np
 
+# note: rotoypy seems to use ENU
+E3 = np.array([0.0, 0.0, 1.0])
+DESIRED_KEYS = ('x', 'v', 'x_2dot', 'x_3dot', 'x_4dot', 'b1', 'b1_dot', 'b1_2dot')
+
+def desired_from_flat_output(flat_output, desired=None):
+    """
+    Convert a flat output dict into the desired dict used by position_control.
+    If desired is given, its preallocated (3,) arrays are filled in place and reused.
+    """
+    if desired is None:
+        desired = {key: np.zeros(3) for key in DESIRED_KEYS}
+    desired['x'][:] = flat_output['x']
+    desired['v'][:] = flat_output['x_dot']
+    desired['x_2dot'][:] = flat_output['x_ddot']
+    desired['x_3dot'][:] = flat_output['x_dddot']
+    desired['x_4dot'][:] = flat_output['x_ddddot']
+
+    yaw = float(flat_output['yaw'])
+    yaw_dot = float(flat_output['yaw_dot'])
+    yaw_ddot = float(flat_output['yaw_ddot'])
+    cos_yaw = math.cos(yaw)
+    sin_yaw = math.sin(yaw)
+    desired['b1'][0] = cos_yaw
+    desired['b1'][1] = sin_yaw
+    desired['b1_dot'][0] = yaw_dot * -sin_yaw
+    desired['b1_dot'][1] = yaw_dot * cos_yaw
+    desired['b1_2dot'][0] = yaw_ddot * -sin_yaw + yaw_dot**2 * -cos_yaw
+    desired['b1_2dot'][1] = yaw_ddot * cos_yaw + yaw_dot**2 * -sin_yaw
+    return desired
+
+def position_control(x, v, R, W, desired, k, m):
+    """
+    Geometric position control. Vectors are arrays of shape (3,), R is the (3,3) rotation matrix,
+    desired is a dict from desired_from_flat_output and k a dict of (3,) gains.
+
+    Outputs:
+        f, thrust, N
+        Rc, Wc, Wc_dot, commanded attitude, angular velocity and angular acceleration
+        error, a dict with keys x, v
+    """
+    g = 9.8
+
+    error_x = x - desired['x']
+    error_v = v - desired['v']
+    error = {
+        'x': error_x,
+        'v': error_v,
+        'W': 0,
+        'R': 0
+    }
+    # ENU
+    A = -k['x'] * error_x - k['v'] * error_v + m * g * E3 + m * desired['x_2dot']
+
+    b3 = R[:, 2]
+    f = A @ b3
+
+    ev_dot = -g * E3 + f / m * b3 - desired['x_2dot']
+
+    A_dot = -k['x'] * error_v - k['v'] * ev_dot + m * desired['x_3dot']
+
+    # R @ wedge(W) @ e3
+    b3_dot = R @ np.array([W[1], -W[0], 0.0])
+    f_dot = A_dot @ b3 + A @ b3_dot
+    ev_2dot = f_dot / m * b3 + f / m * b3_dot - desired['x_3dot']
+    A_ddot = - k['x'] * ev_dot - k['v'] * ev_2dot + m * desired['x_4dot']
+
+    b3c, b3c_dot, b3c_ddot = deriv_unit_vector(A, A_dot, A_ddot)
+
+    # wedge(a) @ b is the cross product a x b
+    A2 = -cross(desired['b1'], b3c)
+    A2_dot = -cross(desired['b1_dot'], b3c) - cross(desired['b1'], b3c_dot)
+    A2_ddot = -cross(desired['b1_2dot'], b3c) - 2 * cross(desired['b1_dot'], b3c_dot) - cross(desired['b1'], b3c_ddot)
+
+    b2c, b2c_dot, b2c_ddot = deriv_unit_vector(A2, A2_dot, A2_ddot)
+
+    b1c = cross(b2c, b3c)
+    b1c_dot = cross(b2c_dot, b3c) + cross(b2c, b3c_dot)
+    b1c_ddot = cross(b2c_ddot, b3c) + 2 * cross(b2c_dot, b3c_dot) + cross(b2c, b3c_ddot)
+
+    Rc = np.array((b1c, b2c, b3c)).T
+    Rc_dot = np.array((b1c_dot, b2c_dot, b3c_dot)).T
+    Rc_ddot = np.array((b1c_ddot, b2c_ddot, b3c_ddot)).T
+
+    Wc = vee(Rc.T @ Rc_dot)
+    Wc_hat = skew(Wc)
+    Wc_dot = vee(Rc.T @ Rc_ddot - Wc_hat @ Wc_hat)
+
+    return f, Rc, Wc, Wc_dot, error
+
+def attitude_control(R, W, Rd, Wd, Wddot, k, J):
+    """
+    Geometric attitude control. Vectors are arrays of shape (3,), R and Rd are (3,3) rotation matrices,
+    k a dict of (3,) gains and J the inertia matrix.
+
+    Outputs:
+        M, eR, eW, moment, attitude error and angular velocity error
+    """
+    RtRd = R.T @ Rd
+    eR = 1 / 2 * vee(RtRd.T - RtRd)
+    RtRd_Wd = RtRd @ Wd
+    eW = W - RtRd_Wd
+    M = - k['R'] * eR - k['W'] * eW + cross(W, J @ W) - J @ (cross(W, RtRd_Wd) - RtRd @ Wddot)
+    return M, eR, eW
+
+def geometric_controller(x, v, R, W, desired, k, m, J, use_jit=False):
+    """
+    Geometric tracking control on SE(3): position_control followed by attitude_control.
+    If use_jit is True, the whole law runs in the numba-compiled geometric_control_kernel instead
+    (see controller/math.py); this requires numba, check HAS_NUMBA.
+
+    Outputs:
+        f, M, error, Rc, Wc, thrust, moment, errors, commanded attitude and angular velocity
+    """
+    if use_jit:
+        f, M, Rc, Wc, ex, ev, eR, eW = geometric_control_kernel(
+            np.asarray(x, dtype=float), np.asarray(v, dtype=float), R, np.asarray(W, dtype=float),
+            desired['x'], desired['v'], desired['x_2dot'], desired['x_3dot'], desired['x_4dot'],
+            desired['b1'], desired['b1_dot'], desired['b1_2dot'],
+            k['x'], k['v'], k['R'], k['W'], float(m), J)
+        return f, M, {'x': ex, 'v': ev, 'R': eR, 'W': eW}, Rc, Wc
+
+    f, Rc, Wc, Wc_dot, error = position_control(x, v, R, W, desired, k, m)
+    M, error['R'], error['W'] = attitude_control(R, W, Rc, Wc, Wc_dot, k, J)
+    return f, M, error, Rc, Wc
+
+def desired_from_flat_outputs_batch(flat_outputs, N):
+    """
+    Convert a dict of stacked flat outputs into the stacked desired dict used by position_control_batch.
+    Vector entries are broadcast to shape (N,3) and yaw entries to shape (N,).
+    """
+    yaw = np.broadcast_to(flat_outputs['yaw'], (N,))
+    yaw_dot = np.broadcast_to(flat_outputs['yaw_dot'], (N,))
+    yaw_ddot = np.broadcast_to(flat_outputs['yaw_ddot'], (N,))
+    cos_yaw = np.cos(yaw)
+    sin_yaw = np.sin(yaw)
+    zeros = np.zeros(N)
+    desired = {
+        'x': np.broadcast_to(flat_outputs['x'], (N, 3)),
+        'v': np.broadcast_to(flat_outputs['x_dot'], (N, 3)),
+        'x_2dot': np.broadcast_to(flat_outputs['x_ddot'], (N, 3)),
+        'x_3dot': np.broadcast_to(flat_outputs['x_dddot'], (N, 3)),
+        'x_4dot': np.broadcast_to(flat_outputs['x_ddddot'], (N, 3)),
+        'b1': np.stack((cos_yaw, sin_yaw, zeros), axis=-1),
+        'b1_dot': np.stack((yaw_dot * -sin_yaw, yaw_dot * cos_yaw, zeros), axis=-1),
+        'b1_2dot': np.stack((yaw_ddot * -sin_yaw + yaw_dot**2 * -cos_yaw,
+                             yaw_ddot * cos_yaw + yaw_dot**2 * -sin_yaw,
+                             zeros), axis=-1),
+    }
+    return desired
+
+def position_control_batch(x, v, R, W, desired, k, m):
+    """
+    Batched position control for N vehicles. Same control law as the module-level position_control kernel,
+    with every 3x1 column vector replaced by a stack of shape (N,3) and every rotation by a stack of shape (N,3,3).
+
+    Inputs:
+        x, v, W, arrays of shape (N,3)
+        R, array of shape (N,3,3)
+        desired, a dict with keys x, v, x_2dot, x_3dot, x_4dot, b1, b1_dot, b1_2dot, each of shape (N,3)
+        k, a dict of gains with keys x, v, each of shape (3,)
+        m, mass, kg
+    Outputs:
+        f, thrust of shape (N,)
+        Rc, Wc, Wc_dot, commanded attitude (N,3,3), angular velocity (N,3) and angular acceleration (N,3)
+        error, a dict with keys x, v
+    """
+    g = 9.8
+
+    error_x = x - desired['x']
+    error_v = v - desired['v']
+    error = {
+        'x': error_x,
+        'v': error_v,
+    }
+    A = -k['x'] * error_x - k['v'] * error_v + m * g * E3 + m * desired['x_2dot']
+
+    b3 = R[:, :, 2]
+    f = dot_batch(A, b3)
+
+    ev_dot = -g * E3 + f / m * b3 - desired['x_2dot']
+
+    A_dot = -k['x'] * error_v - k['v'] * ev_dot + m * desired['x_3dot']
+
+    # R @ wedge(W) @ e3
+    b3_dot = np.einsum('nij,nj->ni', R, cross_batch(W, np.broadcast_to(E3, W.shape)))
+    f_dot = dot_batch(A_dot, b3) + dot_batch(A, b3_dot)
+    ev_2dot = f_dot / m * b3 + f / m * b3_dot - desired['x_3dot']
+    A_ddot = - k['x'] * ev_dot - k['v'] * ev_2dot + m * desired['x_4dot']
+
+    b3c, b3c_dot, b3c_ddot = deriv_unit_vector_batch(A, A_dot, A_ddot)
+
+    # wedge(a) @ b is the cross product a x b
+    A2 = -cross_batch(desired['b1'], b3c)
+    A2_dot = -cross_batch(desired['b1_dot'], b3c) - cross_batch(desired['b1'], b3c_dot)
+    A2_ddot = -cross_batch(desired['b1_2dot'], b3c) - 2 * cross_batch(desired['b1_dot'], b3c_dot) - cross_batch(desired['b1'], b3c_ddot)
+
+    b2c, b2c_dot, b2c_ddot = deriv_unit_vector_batch(A2, A2_dot, A2_ddot)
+
+    b1c = cross_batch(b2c, b3c)
+    b1c_dot = cross_batch(b2c_dot, b3c) + cross_batch(b2c, b3c_dot)
+    b1c_ddot = cross_batch(b2c_ddot, b3c) + 2 * cross_batch(b2c_dot, b3c_dot) + cross_batch(b2c, b3c_ddot)
+
+    Rc = np.stack((b1c, b2c, b3c), axis=-1)
+    Rc_dot = np.stack((b1c_dot, b2c_dot, b3c_dot), axis=-1)
+    Rc_ddot = np.stack((b1c_ddot, b2c_ddot, b3c_ddot), axis=-1)
+
+    RcT = np.swapaxes(Rc, -1, -2)
+    Wc = vee_batch(RcT @ Rc_dot)
+    Wc_hat = wedge_batch(Wc)
+    Wc_dot = vee_batch(RcT @ Rc_ddot - Wc_hat @ Wc_hat)
+
+    return f[:, 0], Rc, Wc, Wc_dot, error
+
+def attitude_control_batch(R, W, Rd, Wd, Wddot, k, J):
+    """
+    Batched attitude control for N vehicles. Same control law as the module-level attitude_control kernel.
+
+    Inputs:
+        R, Rd, arrays of shape (N,3,3)
+        W, Wd, Wddot, arrays of shape (N,3)
+        k, a dict of gains with keys R, W, each of shape (3,)
+        J, inertia matrix of shape (3,3)
+    Outputs:
+        M, eR, eW, arrays of shape (N,3)
+    """
+    RtRd = np.swapaxes(R, -1, -2) @ Rd
+    eR = 1 / 2 * vee_batch(np.swapaxes(RtRd, -1, -2) - RtRd)
+    RtRd_Wd = np.einsum('nij,nj->ni', RtRd, Wd)
+    RtRd_Wddot = np.einsum('nij,nj->ni', RtRd, Wddot)
+    eW = W - RtRd_Wd
+    M = - k['R'] * eR - k['W'] * eW + cross_batch(W, W @ J.T) - (cross_batch(W, RtRd_Wd) - RtRd_Wddot) @ J.T
+    return M, eR, eW
+
 class GeoControl(object):
     """
     implementing the original geometric control
     """
-    def __init__(self, quad_params):
+    def __init__(self, quad_params, use_jit=None):
         """
         Parameters:
             quad_params, dict with keys specified in rotorpy/vehicles
+            use_jit, run the control law in the numba kernel; None (default) uses it whenever numba is installed
         """
 
         # Quadrotor physical parameters.
@@ -99,6 +337,13 @@ class GeoControl(object):
                                  (k * self.rotor_dir).reshape(1,-1)))
         self.TM_to_f = np.linalg.inv(self.f_to_TM)
 
+        # Flattened gains and scratch buffers reused across update() calls.
+        # Note: if self.k is replaced after construction, k_vec must be rebuilt as well.
+        self.k_vec = {key: np.ravel(gain).astype(float) for key, gain in self.k.items()}
+        self.desired_buffer = {key: np.zeros(3) for key in DESIRED_KEYS}
+        self.TM_buffer = np.zeros(4)
+        self.use_jit = HAS_NUMBA if use_jit is None else use_jit
+
     def update_ref(self, t, flat_output):
         """
         Sheng: not used
@@ -180,7 +425,7 @@ class GeoControl(object):
         cmd_motor_speeds = cmd_motor_forces / self.k_eta
         cmd_motor_speeds = np.sign(cmd_motor_speeds) * np.sqrt(np.abs(cmd_motor_speeds))
 
-        cmd_q = Rotation.from_matrix(R_des).as_quat()
+        cmd_q = rotmat_to_quat(R_des)
 
 
         control_input = {'cmd_motor_speeds':cmd_motor_speeds,
@@ -222,225 +467,81 @@ class GeoControl(object):
                 cmd_w, angular rates in the body frame, rad/s
                 cmd_v, velocity in the world frame, m/s
         """
-        cmd_motor_speeds = np.zeros((4,))
-        cmd_thrust = 0
-        cmd_moment = np.zeros((3,))
-        cmd_q = np.zeros((4,))
-        
-        # sheng: move the private functions here
-
-        # def normalize(x):
-        #     """Return normalized vector."""
-        #     return x / np.linalg.norm(x)
-
-        # def vee_map(S):
-        #     """Return vector corresponding to given skew symmetric matrix."""
-        #     return np.array([-S[1,2], S[0,2], -S[0,1]])
-        
-        def wedge(x):
-            """Return wedged vector."""
-            wedge_x = np.array([[0,-x[2][0], x[1][0]], [x[2][0], 0, -x[0][0]], [-x[1][0], x[0][0], 0]])
-            return wedge_x
-        
-        
-        def deriv_unit_vector(q, q_dot, q_ddot):
-            """derivative of a unit vector"""
-            nq = np.linalg.norm(q)
-            u = q / nq
-            u_dot = q_dot / nq - q * np.dot(np.ravel(q), np.ravel(q_dot)) / nq**3
-            u_ddot = q_ddot / nq - q_dot / (nq**3) * (2 * np.dot(np.ravel(q), np.ravel(q_dot))) \
-            - q / nq**3 * (np.dot(np.ravel(q_dot), np.ravel(q_dot)) + np.dot(np.ravel(q), np.ravel(q_ddot))) \
-            + 3 * q / nq**5 * np.dot(np.ravel(q), np.ravel(q_dot))**2
-            return u, u_dot, u_ddot
-
-        
-        def vee(S):
-            """Return vector corresponding to given skew symmetric matrix."""
-            s = np.array([[-S[1,2]], [S[0,2]], [-S[0,1]]])
-            return s
-
-
-        
-        # note: rotoypy seems to use ENU
-        
-        def geometric_controller(self, state, flat_output):
-            # split the state
-            x = state['x'].reshape(3,1)
-            v = state['v'].reshape(3,1)
-            R = Rotation.from_quat(state['q']).as_matrix()
-            W = state['w'].reshape(3,1)
-            
-            # converting flat_output to desired
-            desired = dict()
-            desired.update({'x': flat_output['x'].reshape(3,1)})
-            desired.update({'v': flat_output['x_dot'].reshape(3,1)})
-            desired.update({'x_2dot': flat_output['x_ddot'].reshape(3,1)})
-            desired.update({'x_3dot': flat_output['x_dddot'].reshape(3,1)})
-            desired.update({'x_4dot': flat_output['x_ddddot'].reshape(3,1)})
-
-            desired.update({'yaw': flat_output['yaw']})
-            b1 = np.array([np.cos(flat_output['yaw']), np.sin(flat_output['yaw']), 0])
-            b1_dot = np.array([flat_output['yaw_dot'] * -np.sin(flat_output['yaw']), 
-                               flat_output['yaw_dot'] * np.cos(flat_output['yaw']), 
-                               0])
-            b1_2dot = np.array([flat_output['yaw_ddot'] * -np.sin(flat_output['yaw']) + flat_output['yaw_dot']**2 * -np.cos(flat_output['yaw']), 
-                               flat_output['yaw_ddot'] * np.cos(flat_output['yaw']) + flat_output['yaw_dot']**2 * -np.sin(flat_output['yaw']), 
-                               0])
-            
-            desired.update({'b1': b1.reshape(3,1)})
-            desired.update({'b1_dot': b1_dot.reshape(3,1)})
-            desired.update({'b1_2dot': b1_2dot.reshape(3,1)})
-
-            f, Rc, Wc, Wc_dot, error = position_control(x, v, R, W, desired, self.k, self.mass)
-            # print(R)
-            # print(Rc)
-            M, error['R'], error['W'] = attitude_control(R, W, Rc, Wc, Wc_dot, self.k, self.inertia)
-
-            u = np.vstack((f, M[0]))
-            u = np.vstack((u, M[1]))
-            u = np.vstack((u, M[2]))
-            
-            # print('R=')
-            # print(R)
-            # print('Rc=')
-            # print(Rc)
-
-            return u, error, Rc, Wc
-        
-        # position control
-        def position_control(x, v, R, W, desired, k, m):
-            e3 = np.array([[0],[0],[1]])
-            # e3 = np.array([0,0,1])
-            g = 9.8
-
-            error_x = x - desired['x']
-            error_v = v - desired['v']
-            error = {
-                'x': error_x,
-                'v': error_v,
-                'W': 0,
-                'R': 0
-            }
-            # ENU
-            # A = -k['x'] * error['x'] - k['v'] * error['v'] - m * g * e3 + m * desired['x_2dot']
-            A = -k['x'] * error['x'] - k['v'] * error['v'] + m * g * e3 + m * desired['x_2dot']
-            
-            b3 = R @ e3
-            # ENU
-            # f = -np.dot(np.ravel(A), b3)
-            f = np.dot(np.ravel(A), b3)
-            
-            # ENU
-            # ev_dot = g * e3 - f / m * b3 - desired['x_2dot']
-            ev_dot = -g * e3 + f / m * b3 - desired['x_2dot']
-            
-            A_dot = -k['x'] * error['v'] - k['v'] * ev_dot + m * desired['x_3dot']
-
-            b3_dot = R @ wedge(W) @ e3
-            # ENU
-            # f_dot = -np.dot(np.ravel(A_dot), b3) - np.dot(np.ravel(A), b3_dot)
-            f_dot = np.dot(np.ravel(A_dot), b3) + np.dot(np.ravel(A), b3_dot)
-            # ENU
-            # ev_2dot = -f_dot / m * b3 - f / m * b3_dot - desired['x_3dot']
-            ev_2dot = f_dot / m * b3 + f / m * b3_dot - desired['x_3dot']
-            # ENU
-            # A_ddot = - k['x'] * ev_dot - k['v'] * ev_2dot + m * desired['x_4dot']
-            A_ddot = - k['x'] * ev_dot - k['v'] * ev_2dot + m * desired['x_4dot']
-            
-            # ENU
-            # b3c, b3c_dot, b3c_ddot = deriv_unit_vector(-A, -A_dot, -A_ddot)
-            b3c, b3c_dot, b3c_ddot = deriv_unit_vector(A, A_dot, A_ddot)
-
-            A2 = -wedge(desired['b1']) @ b3c
-
-            A2_dot = -wedge(desired['b1_dot']) @ b3c - wedge(desired['b1']) @ b3c_dot
-
-            A2_ddot = -wedge(desired['b1_2dot']) @ b3c - 2 * wedge(desired['b1_dot']) @ b3c_dot - wedge(desired['b1']) @ b3c_ddot
-
-            b2c, b2c_dot, b2c_ddot = deriv_unit_vector(A2, A2_dot, A2_ddot)
-
-            b1c = wedge(b2c) @ b3c
-            b1c_dot = wedge(b2c_dot) @ b3c + wedge(b2c) @ b3c_dot
-            b1c_ddot = wedge(b2c_ddot) @ b3c + 2 * wedge(b2c_dot) @ b3c_dot + wedge(b2c) @ b3c_ddot
-
-            Rc = np.hstack((b1c, b2c))
-            Rc = np.hstack((Rc, b3c))
-            Rc_dot = np.hstack((b1c_dot, b2c_dot))
-            Rc_dot = np.hstack((Rc_dot, b3c_dot))
-
-            Rc_ddot = np.hstack((b1c_ddot, b2c_ddot))
-            Rc_ddot = np.hstack((Rc_ddot, b3c_ddot))
-
-            Wc = vee(np.transpose(Rc) @ Rc_dot)
-            # print(np.transpose(Rc) @ Rc_ddot - wedge(Wc) @ wedge(Wc))
-            Wc_dot = vee(np.transpose(Rc) @ Rc_ddot - wedge(Wc) @ wedge(Wc))
-            
-            return f, Rc, Wc, Wc_dot, error
-        
-        # attitude control
-        def attitude_control(R, W, Rd, Wd, Wddot, k, J):
-            eR = 1 / 2 * vee(np.transpose(Rd) @ R - np.transpose(R) @ Rd)
-            eW = W - np.transpose(R) @ Rd @ Wd
-            M = - k['R'] * eR - k['W'] * eW + wedge(W) @ (J @ W) - J @ (wedge(W) @ np.transpose(R) @ Rd @ Wd - np.transpose(R) @ Rd @ Wddot)
-            return M, eR, eW
-
-        # the original code starts from below
-        # # Get the desired force vector.
-        # pos_err  = state['x'] - flat_output['x']
-        # dpos_err = state['v'] - flat_output['x_dot']
-        # F_des = self.mass * (- self.kp_pos*pos_err
-        #                      - self.kd_pos*dpos_err
-        #                      + flat_output['x_ddot']
-        #                      + np.array([0, 0, self.g]))
-
-        # # Desired thrust is force projects onto b3 axis.
-        # R = Rotation.from_quat(state['q']).as_matrix()
-        # b3 = R @ np.array([0, 0, 1])
-        # u1 = np.dot(F_des, b3)
-
-        # # Desired orientation to obtain force vector.
-        # b3_des = normalize(F_des)
-        # yaw_des = flat_output['yaw']
-        # c1_des = np.array([np.cos(yaw_des), np.sin(yaw_des), 0])
-        # b2_des = normalize(np.cross(b3_des, c1_des))
-        # b1_des = np.cross(b2_des, b3_des)
-        # R_des = np.stack([b1_des, b2_des, b3_des]).T
-
-        # # Orientation error.
-        # S_err = 0.5 * (R_des.T @ R - R.T @ R_des) # sheng: this is the same as we do
-        # att_err = vee_map(S_err)
-
-        # # Angular velocity error (this is oversimplified).
-        # w_des = np.array([0, 0, flat_output['yaw_dot']]) # sheng: this is indeed oversimplified
-        # w_err = state['w'] - w_des
-
-        # # Desired torque, in units N-m.
-        # u2 = self.inertia @ (-self.kp_att*att_err - self.kd_att*w_err) + np.cross(state['w'], self.inertia@state['w'])  # Includes compensation for wxJw component
-
-        # # Compute command body rates by doing PD on the attitude error. 
-        # cmd_w = -self.kp_att*att_err - self.kd_att*w_err
+        R = quat_to_rotmat(state['q'])
+        desired = desired_from_flat_output(flat_output, self.desired_buffer)
 
         # Compute motor speeds. Avoid taking square root of negative numbers.
-        u, error, R_des, omega_des = geometric_controller(self, state, flat_output)
-        
-        TM = np.array(u)
+        f, M, error, R_des, omega_des = geometric_controller(state['x'], state['v'], R, state['w'], desired,
+                                                             self.k_vec, self.mass, self.inertia, self.use_jit)
+
+        TM = self.TM_buffer
+        TM[0] = f
+        TM[1:4] = M
         cmd_rotor_thrusts = self.TM_to_f @ TM
         cmd_motor_speeds = cmd_rotor_thrusts / self.k_eta
         cmd_motor_speeds = np.sign(cmd_motor_speeds) * np.sqrt(np.abs(cmd_motor_speeds))
 
-        # Assign controller commands. sheng: todo
-        cmd_thrust = u[0]                                             # Commanded thrust, in units N.
-        cmd_moment = u[1:4]                                             # Commanded moment, in units N-m.
-        cmd_q = Rotation.from_matrix(R_des).as_quat()               # Commanded attitude as a quaternion.
-        # cmd_v = -self.kp_vel*pos_err + flat_output['x_dot']     # Commanded velocity in world frame (if using cmd_vel control abstraction), in units m/s
+        # Assign controller commands.
+        cmd_thrust = f                                                # Commanded thrust, in units N.
+        cmd_moment = M                                                # Commanded moment, in units N-m.
+        cmd_q = rotmat_to_quat(R_des)               # Commanded attitude as a quaternion.
         cmd_v = flat_output['x_dot']     # sheng: desired velocity (use the simplified version)
-        
+
         control_input = {'cmd_motor_speeds':cmd_motor_speeds,
                          'cmd_motor_thrusts':cmd_rotor_thrusts,
-                         'cmd_thrust':cmd_thrust[0],
-                         'cmd_moment':cmd_moment.reshape(3,),
+                         'cmd_thrust':cmd_thrust,
+                         'cmd_moment':cmd_moment,
                          'cmd_q':cmd_q,
                          'cmd_w':omega_des,
                          'cmd_v':cmd_v
                         }
-        return control_input
\ No newline at end of file
+        return control_input
+
+    def update_batch(self, t, states, flat_outputs):
+        """
+        Batched version of update() that computes the commands for N vehicles in one call. All the SE(3)
+        algebra is done with broadcast operations over the leading batch axis, which is much cheaper per
+        vehicle than calling update() N times when sweeping many rollouts.
+
+        Inputs:
+            t, present time in seconds
+            states, array of shape (N,13), each row is [x, v, q [i,j,k,w], w]
+            flat_outputs, a dict of stacked desired flat outputs with the same keys as update(), where
+                x, x_dot, x_ddot, x_dddot, x_ddddot have shape (N,3), and
+                yaw, yaw_dot, yaw_ddot have shape (N,) (scalars are broadcast to all vehicles)
+
+        Outputs:
+            control_input, a dict with the same keys as update(), each stacked along the first axis
+                cmd_motor_speeds (N,4), cmd_motor_thrusts (N,4), cmd_thrust (N,), cmd_moment (N,3),
+                cmd_q (N,4), cmd_w (N,3), cmd_v (N,3)
+        """
+        states = np.asarray(states, dtype=float)
+        N = states.shape[0]
+
+        # split the state
+        x = states[:, 0:3]
+        v = states[:, 3:6]
+        R = quat_to_rotmat_batch(states[:, 6:10])
+        W = states[:, 10:13]
+
+        # converting flat_outputs to desired
+        desired = desired_from_flat_outputs_batch(flat_outputs, N)
+
+        f, Rc, Wc, Wc_dot, error = position_control_batch(x, v, R, W, desired, self.k_vec, self.mass)
+        M, error['R'], error['W'] = attitude_control_batch(R, W, Rc, Wc, Wc_dot, self.k_vec, self.inertia)
+
+        # Compute motor speeds. Avoid taking square root of negative numbers.
+        TM = np.column_stack((f, M))
+        cmd_rotor_thrusts = TM @ self.TM_to_f.T
+        cmd_motor_speeds = cmd_rotor_thrusts / self.k_eta
+        cmd_motor_speeds = np.sign(cmd_motor_speeds) * np.sqrt(np.abs(cmd_motor_speeds))
+
+        control_input = {'cmd_motor_speeds':cmd_motor_speeds,
+                         'cmd_motor_thrusts':cmd_rotor_thrusts,
+                         'cmd_thrust':f,
+                         'cmd_moment':M,
+                         'cmd_q':rotmat_to_quat_batch(Rc),
+                         'cmd_w':Wc,
+                         'cmd_v':np.array(desired['v'])
+                        }
+        return control_input
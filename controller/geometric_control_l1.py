@@ -1,6 +1,5 @@
 from __future__ import print_function, division, absolute_import
 import numpy as np
-from scipy.spatial.transform import Rotation
 
 # import jax
 # import jax.numpy as np
@@ -14,15 +13,25 @@ import mpl_toolkits.mplot3d.axes3d as p3
 import matplotlib.animation as animation
 import sys
 from time import perf_counter
+from controller.geometric_control import geometric_controller, desired_from_flat_output, DESIRED_KEYS
+from controller.geometric_control import position_control_batch, attitude_control_batch, desired_from_flat_outputs_batch
+from controller.math import HAS_NUMBA, cross, cross_batch, dot_batch
+from controller.rotation import quat_to_rotmat, rotmat_to_quat, quat_to_rotmat_batch, rotmat_to_quat_batch
+
+# Fields of the L1 memory with their flattened sizes, in the order of din_L1 and of the get_state() snapshots
+L1_STATE_FIELDS = (('v_hat', 3), ('omega_hat', 3), ('R', 9), ('v', 3), ('omega', 3), ('u_b', 4), ('u_ad', 4),
+                   ('sigma_m_hat', 4), ('sigma_um_hat', 2), ('lpf1', 4), ('lpf2', 4))
+L1_STATE_SIZE = sum(size for _, size in L1_STATE_FIELDS)
 
 class L1_GeoControl(object):
     """
     implementing the original geometric control
     """
-    def __init__(self, quad_params):
+    def __init__(self, quad_params, use_jit=None):
         """
         Parameters:
             quad_params, dict with keys specified in rotorpy/vehicles
+            use_jit, run the geometric control law in the numba kernel; None (default) uses it whenever numba is installed
         """
 
         # Quadrotor physical parameters.
@@ -105,6 +114,13 @@ class L1_GeoControl(object):
                                  (k * self.rotor_dir).reshape(1,-1)))
         self.TM_to_f = np.linalg.inv(self.f_to_TM)
 
+        # Flattened gains and scratch buffers reused across update() calls.
+        # Note: if self.k is replaced after construction, k_vec must be rebuilt as well.
+        self.k_vec = {key: np.ravel(gain).astype(float) for key, gain in self.k.items()}
+        self.desired_buffer = {key: np.zeros(3) for key in DESIRED_KEYS}
+        self.TM_buffer = np.zeros(4)
+        self.use_jit = HAS_NUMBA if use_jit is None else use_jit
+
         """ L1-related parameters """
         self.As_v = -1 # parameter for L1
         self.As_omega = -1 # parameter for L1
@@ -117,12 +133,30 @@ class L1_GeoControl(object):
 
         self.L1_params = (self.As_v, self.As_omega, self.dt_L1, self.ctoffq1Thrust, self.ctoffq1Moment, self.ctoffq2Moment, self.mass, self.g, self.J )
 
+        """ Constants of the L1 predictor, adaptation law and filters (computed once) """
+        self.Jinv = la.inv(self.J)
+        self.exp_As_v_dt = math.exp(self.As_v * self.dt_L1)
+        self.exp_As_omega_dt = math.exp(self.As_omega * self.dt_L1)
+        self.lpf1_coefficientThrust1 = math.exp(- self.ctoffq1Thrust * self.dt_L1)
+        self.lpf1_coefficientThrust2 = 1.0 - self.lpf1_coefficientThrust1
+        self.lpf1_coefficientMoment1 = math.exp(- self.ctoffq1Moment * self.dt_L1)
+        self.lpf1_coefficientMoment2 = 1.0 - self.lpf1_coefficientMoment1
+        self.lpf2_coefficientMoment1 = math.exp(- self.ctoffq2Moment * self.dt_L1)
+        self.lpf2_coefficientMoment2 = 1.0 - self.lpf2_coefficientMoment1
+
         # self.kx = 16*self.m*np.ones((3,)) # position gains
         # self.kv = 5.6*self.m*np.ones((3,)) # velocity gains
         # self.kR = 8.81*np.ones((3,)) # angular gains
         # self.kW = 2.54*np.ones((3,)) # rotational velocity gains
 
-        """ Initialization of L1 inputs """
+        self.reset()
+
+    def reset(self):
+        """
+        Clears the L1 predictor, uncertainty estimates and filter states (single-vehicle and batched), so that the
+        controller can be reused for a new episode.
+        """
+        # Initialization of L1 inputs
         self.v_hat_prev = np.array([0.0, 0.0, 0.0])
         self.omega_hat_prev = np.array([0.0, 0.0, 0.0])
         self.R_prev = np.zeros((9,)).reshape(3,3)
@@ -138,6 +172,36 @@ class L1_GeoControl(object):
         self.din_L1 = (self.v_hat_prev, self.omega_hat_prev, self.R_prev, self.v_prev, self.omega_prev,
                        self.u_b_prev, self.u_ad_prev, self.sigma_m_hat_prev, self.sigma_um_hat_prev, 
                        self.lpf1_prev, self.lpf2_prev)
+        self.din_L1_batch = None # array-backed L1 memory for update_batch, see init_L1_batch
+
+    def get_state(self, batch=False):
+        """
+        Snapshot of the L1 memory as a flat array of L1_STATE_SIZE values (fields in L1_STATE_FIELDS order), or with
+        batch=True an (N, L1_STATE_SIZE) array of the memory used by update_batch (None before its first call).
+        """
+        if not batch:
+            return np.concatenate([np.ravel(value) for value in self.din_L1])
+        if self.din_L1_batch is None:
+            return None
+        N = self.din_L1_batch['v'].shape[0]
+        return np.concatenate([self.din_L1_batch[key].reshape(N, -1) for key, _ in L1_STATE_FIELDS], axis=1)
+
+    def set_state(self, state):
+        """
+        Restores a snapshot of get_state(): a 1D array restores the memory of update(), a 2D array the batched
+        memory of update_batch.
+        """
+        state = np.asarray(state, dtype=float)
+        offsets = np.cumsum([size for _, size in L1_STATE_FIELDS])[:-1]
+        if state.ndim == 1:
+            fields = np.split(state.copy(), offsets)
+            fields[2] = fields[2].reshape(3, 3)
+            self.din_L1 = tuple(fields)
+        else:
+            N = state.shape[0]
+            self.init_L1_batch(N)
+            for (key, _), value in zip(L1_STATE_FIELDS, np.split(state, offsets, axis=1)):
+                self.din_L1_batch[key][:] = value.reshape(self.din_L1_batch[key].shape)
 
     def update_ref(self, t, flat_output):
         """
@@ -220,7 +284,7 @@ class L1_GeoControl(object):
         cmd_motor_speeds = cmd_motor_forces / self.k_eta
         cmd_motor_speeds = np.sign(cmd_motor_speeds) * np.sqrt(np.abs(cmd_motor_speeds))
 
-        cmd_q = Rotation.from_matrix(R_des).as_quat()
+        cmd_q = rotmat_to_quat(R_des)
 
 
         control_input = {'cmd_motor_speeds':cmd_motor_speeds,
@@ -262,363 +326,281 @@ class L1_GeoControl(object):
                 cmd_w, angular rates in the body frame, rad/s
                 cmd_v, velocity in the world frame, m/s
         """
-        cmd_motor_speeds = np.zeros((4,))
-        cmd_thrust = 0
-        cmd_moment = np.zeros((3,))
-        cmd_q = np.zeros((4,))
-        
-        # sheng: move the private functions here
-
-        # def normalize(x):
-        #     """Return normalized vector."""
-        #     return x / np.linalg.norm(x)
-
-        # def vee_map(S):
-        #     """Return vector corresponding to given skew symmetric matrix."""
-        #     return np.array([-S[1,2], S[0,2], -S[0,1]])
-        
-        def wedge(x):
-            """Return wedged vector."""
-            wedge_x = np.array([[0,-x[2][0], x[1][0]], [x[2][0], 0, -x[0][0]], [-x[1][0], x[0][0], 0]])
-            return wedge_x
-        
-        
-        def deriv_unit_vector(q, q_dot, q_ddot):
-            """derivative of a unit vector"""
-            nq = np.linalg.norm(q)
-            u = q / nq
-            u_dot = q_dot / nq - q * np.dot(np.ravel(q), np.ravel(q_dot)) / nq**3
-            u_ddot = q_ddot / nq - q_dot / (nq**3) * (2 * np.dot(np.ravel(q), np.ravel(q_dot))) \
-            - q / nq**3 * (np.dot(np.ravel(q_dot), np.ravel(q_dot)) + np.dot(np.ravel(q), np.ravel(q_ddot))) \
-            + 3 * q / nq**5 * np.dot(np.ravel(q), np.ravel(q_dot))**2
-            return u, u_dot, u_ddot
-
-        
-        def vee(S):
-            """Return vector corresponding to given skew symmetric matrix."""
-            s = np.array([[-S[1,2]], [S[0,2]], [-S[0,1]]])
-            return s
-
-
-        
-        # note: rotoypy seems to use ENU
-        
-        def geometric_controller(self, state, flat_output):
-            # split the state
-            x = state['x'].reshape(3,1)
-            v = state['v'].reshape(3,1)
-            R = Rotation.from_quat(state['q']).as_matrix()
-            W = state['w'].reshape(3,1)
-            
-            # converting flat_output to desired
-            desired = dict()
-            desired.update({'x': flat_output['x'].reshape(3,1)})
-            desired.update({'v': flat_output['x_dot'].reshape(3,1)})
-            desired.update({'x_2dot': flat_output['x_ddot'].reshape(3,1)})
-            desired.update({'x_3dot': flat_output['x_dddot'].reshape(3,1)})
-            desired.update({'x_4dot': flat_output['x_ddddot'].reshape(3,1)})
-
-            desired.update({'yaw': flat_output['yaw']})
-            b1 = np.array([np.cos(flat_output['yaw']), np.sin(flat_output['yaw']), 0])
-            b1_dot = np.array([flat_output['yaw_dot'] * -np.sin(flat_output['yaw']), 
-                               flat_output['yaw_dot'] * np.cos(flat_output['yaw']), 
-                               0])
-            b1_2dot = np.array([flat_output['yaw_ddot'] * -np.sin(flat_output['yaw']) + flat_output['yaw_dot']**2 * -np.cos(flat_output['yaw']), 
-                               flat_output['yaw_ddot'] * np.cos(flat_output['yaw']) + flat_output['yaw_dot']**2 * -np.sin(flat_output['yaw']), 
-                               0])
-            
-            desired.update({'b1': b1.reshape(3,1)})
-            desired.update({'b1_dot': b1_dot.reshape(3,1)})
-            desired.update({'b1_2dot': b1_2dot.reshape(3,1)})
-
-            f, Rc, Wc, Wc_dot, error = position_control(x, v, R, W, desired, self.k, self.mass)
-            # print(R)
-            # print(Rc)
-            M, error['R'], error['W'] = attitude_control(R, W, Rc, Wc, Wc_dot, self.k, self.inertia)
-
-            u = np.vstack((f, M[0]))
-            u = np.vstack((u, M[1]))
-            u = np.vstack((u, M[2]))
-            
-            # print('R=')
-            # print(R)
-            # print('Rc=')
-            # print(Rc)
-
-            return f, M, u, error, Rc, Wc
-
-
-        def L1AC(self, R, W, x, v, f, M):
-            (As_v, As_omega, dt, ctoffq1Thrust, ctoffq1Moment, ctoffq2Moment, kg_vehicleMass, GRAVITY_MAGNITUDE, J ) = self.L1_params
-            (v_hat_prev, omega_hat_prev, R_prev, v_prev, omega_prev,
-            u_b_prev, u_ad_prev, sigma_m_hat_prev, sigma_um_hat_prev,
-            lpf1_prev, lpf2_prev) = self.din_L1
-
-            # == begin L1 adaptive control ==
-            # first do the state predictor
-            e3 = np.array([0.0, 0.0, 1.0])
-            # load translational velocity
-            v_now = v
-
-            # load rotational velocity
-            omega_now = W
-
-            massInverse = 1.0 / kg_vehicleMass
-
-            # compute prediction error (on previous step)
-            vpred_error_prev = v_hat_prev - v_prev # computes v_tilde for (k-1) step
-            omegapred_error_prev = omega_hat_prev - omega_prev # computes omega_tilde for (k-1) step
-
-            v_hat = v_hat_prev + (-e3 * GRAVITY_MAGNITUDE - R_prev[:,2]* (u_b_prev[0] + u_ad_prev[0] + sigma_m_hat_prev[0]) * massInverse + R_prev[:,0] * sigma_um_hat_prev[0] * massInverse + R_prev[:,1] * sigma_um_hat_prev[1] * massInverse + vpred_error_prev * As_v) * dt
-            Jinv = la.inv(J)
-            # temp vector: thrustMomentCmd[1--3] + u_ad_prev[1--3] + sigma_m_hat_prev[1--3]
-            # original form
-            tempVec = np.array([u_b_prev[1] + u_ad_prev[1] + sigma_m_hat_prev[1], u_b_prev[2] + u_ad_prev[2] + sigma_m_hat_prev[2], u_b_prev[3] + u_ad_prev[3] + sigma_m_hat_prev[3]])
-            omega_hat = omega_hat_prev + (-np.matmul(Jinv, np.cross(omega_prev, (np.matmul(J, omega_prev)))) + np.matmul(Jinv, tempVec) + omegapred_error_prev * As_omega) * dt
-
-            # update the state prediction storage
-            v_hat_prev = v_hat
-            omega_hat_prev = omega_hat
-
-            # compute prediction error (for this step)
-            vpred_error = v_hat - v_now
-            omegapred_error = omega_hat - omega_now
-
-            # exponential coefficients coefficient for As
-            exp_As_v_dt = math.exp(As_v * dt)
-            exp_As_omega_dt = math.exp(As_omega * dt)
-
-            # latter part of uncertainty estimation (piecewise constant) (step2: adaptation law)
-            PhiInvmu_v = vpred_error / (exp_As_v_dt - 1) * As_v * exp_As_v_dt
-            PhiInvmu_omega = omegapred_error / (exp_As_omega_dt - 1) * As_omega * exp_As_omega_dt
-
-            sigma_m_hat = np.array([0.0,0.0,0.0,0.0]) # estimated matched uncertainty
-            sigma_m_hat_2to4 = np.array([0.0,0.0,0.0]) # second to fourth element of the estimated matched uncertainty
-            sigma_um_hat = np.array([0.0,0.0]) # estimated unmatched uncertainty
-
-            sigma_m_hat[0] = -np.dot(R[:,2], PhiInvmu_v) * kg_vehicleMass
-            # turn np.dot(R[:,2], PhiInvmu_v) * kg_vehicleMass to -np.dot(R[:,2], PhiInvmu_v) * kg_vehicleMass
-            sigma_m_hat_2to4 = -np.matmul(J, PhiInvmu_omega)
-            sigma_m_hat[1] = sigma_m_hat_2to4[0]
-            sigma_m_hat[2] = sigma_m_hat_2to4[1]
-            sigma_m_hat[3] = sigma_m_hat_2to4[2]
-
-            sigma_um_hat[0] = np.dot(R[:,0], PhiInvmu_v) * kg_vehicleMass
-            sigma_um_hat[1] = np.dot(R[:,1], PhiInvmu_v) * kg_vehicleMass
-
-            # store uncertainty estimations
-            sigma_m_hat_prev = sigma_m_hat
-            sigma_um_hat_prev = sigma_um_hat
-
-            # compute lpf1 coefficients
-            lpf1_coefficientThrust1 = math.exp(- ctoffq1Thrust * dt)
-            lpf1_coefficientThrust2 = 1.0 - lpf1_coefficientThrust1
-
-            lpf1_coefficientMoment1 = math.exp(- ctoffq1Moment * dt)
-            lpf1_coefficientMoment2 = 1.0 - lpf1_coefficientMoment1
-
-            # update the adaptive control
-            u_ad_int = np.array([0.0,0.0,0.0,0.0])
-            u_ad = np.array([0.0,0.0,0.0,0.0])
-
-            # low-pass filter 1 (negation is added to u_ad_prev to filter the correct signal)
-            u_ad_int[0] = lpf1_coefficientThrust1 * (lpf1_prev[0]) + lpf1_coefficientThrust2 * sigma_m_hat[0]
-            u_ad_int[1:4] = lpf1_coefficientMoment1 * (lpf1_prev[1:4]) + lpf1_coefficientMoment2 * sigma_m_hat[1:4]
-
-            lpf1_prev = u_ad_int # store the current state
-
-            # coefficients for the second LPF on the moment channel
-            lpf2_coefficientMoment1 = math.exp(- ctoffq2Moment * dt)
-            lpf2_coefficientMoment2 = 1.0 - lpf2_coefficientMoment1
-
-            # low-pass filter 2 (optional)
-            u_ad[0] = u_ad_int[0] # only one filter on the thrust channel
-            u_ad[1:4] = lpf2_coefficientMoment1 * lpf2_prev[1:4] + lpf2_coefficientMoment2 * u_ad_int[1:4]
-
-            lpf2_prev = u_ad # store the current state
-
-            u_ad = -u_ad
-
-            # store the values for next iteration (negation is added to u_ad_prev to filter the correct signal)
-            u_ad_prev = u_ad
-
-            v_prev = v_now
-            omega_prev = omega_now
-            R_prev = R
-            u_b_prev = np.array([f,M[0],M[1],M[2]])
-
-            controlcmd_L1 = np.array([f,M[0],M[1],-M[2]]) + u_ad_prev
-
-            self.din_L1 = (v_hat_prev, omega_hat_prev, R_prev, v_prev, omega_prev,
-            u_b_prev, u_ad_prev, sigma_m_hat_prev, sigma_um_hat_prev,
-            lpf1_prev, lpf2_prev)
-
-            f_L1 = controlcmd_L1[0]
-            M_L1 = controlcmd_L1[1:4]
-            return (f_L1, M_L1, sigma_m_hat)
-
-        # position control
-        def position_control(x, v, R, W, desired, k, m):
-            e3 = np.array([[0],[0],[1]])
-            # e3 = np.array([0,0,1])
-            g = 9.8
-
-            error_x = x - desired['x']
-            error_v = v - desired['v']
-            error = {
-                'x': error_x,
-                'v': error_v,
-                'W': 0,
-                'R': 0
-            }
-            # ENU
-            # A = -k['x'] * error['x'] - k['v'] * error['v'] - m * g * e3 + m * desired['x_2dot']
-            A = -k['x'] * error['x'] - k['v'] * error['v'] + m * g * e3 + m * desired['x_2dot']
-            
-            b3 = R @ e3
-            # ENU
-            # f = -np.dot(np.ravel(A), b3)
-            f = np.dot(np.ravel(A), b3)
-            
-            # ENU
-            # ev_dot = g * e3 - f / m * b3 - desired['x_2dot']
-            ev_dot = -g * e3 + f / m * b3 - desired['x_2dot']
-            
-            A_dot = -k['x'] * error['v'] - k['v'] * ev_dot + m * desired['x_3dot']
-
-            b3_dot = R @ wedge(W) @ e3
-            # ENU
-            # f_dot = -np.dot(np.ravel(A_dot), b3) - np.dot(np.ravel(A), b3_dot)
-            f_dot = np.dot(np.ravel(A_dot), b3) + np.dot(np.ravel(A), b3_dot)
-            # ENU
-            # ev_2dot = -f_dot / m * b3 - f / m * b3_dot - desired['x_3dot']
-            ev_2dot = f_dot / m * b3 + f / m * b3_dot - desired['x_3dot']
-            # ENU
-            # A_ddot = - k['x'] * ev_dot - k['v'] * ev_2dot + m * desired['x_4dot']
-            A_ddot = - k['x'] * ev_dot - k['v'] * ev_2dot + m * desired['x_4dot']
-            
-            # ENU
-            # b3c, b3c_dot, b3c_ddot = deriv_unit_vector(-A, -A_dot, -A_ddot)
-            b3c, b3c_dot, b3c_ddot = deriv_unit_vector(A, A_dot, A_ddot)
-
-            A2 = -wedge(desired['b1']) @ b3c
-
-            A2_dot = -wedge(desired['b1_dot']) @ b3c - wedge(desired['b1']) @ b3c_dot
-
-            A2_ddot = -wedge(desired['b1_2dot']) @ b3c - 2 * wedge(desired['b1_dot']) @ b3c_dot - wedge(desired['b1']) @ b3c_ddot
-
-            b2c, b2c_dot, b2c_ddot = deriv_unit_vector(A2, A2_dot, A2_ddot)
-
-            b1c = wedge(b2c) @ b3c
-            b1c_dot = wedge(b2c_dot) @ b3c + wedge(b2c) @ b3c_dot
-            b1c_ddot = wedge(b2c_ddot) @ b3c + 2 * wedge(b2c_dot) @ b3c_dot + wedge(b2c) @ b3c_ddot
-
-            Rc = np.hstack((b1c, b2c))
-            Rc = np.hstack((Rc, b3c))
-            Rc_dot = np.hstack((b1c_dot, b2c_dot))
-            Rc_dot = np.hstack((Rc_dot, b3c_dot))
-
-            Rc_ddot = np.hstack((b1c_ddot, b2c_ddot))
-            Rc_ddot = np.hstack((Rc_ddot, b3c_ddot))
-
-            Wc = vee(np.transpose(Rc) @ Rc_dot)
-            # print(np.transpose(Rc) @ Rc_ddot - wedge(Wc) @ wedge(Wc))
-            Wc_dot = vee(np.transpose(Rc) @ Rc_ddot - wedge(Wc) @ wedge(Wc))
-            
-            return f, Rc, Wc, Wc_dot, error
-        
-        # attitude control
-        def attitude_control(R, W, Rd, Wd, Wddot, k, J):
-            eR = 1 / 2 * vee(np.transpose(Rd) @ R - np.transpose(R) @ Rd)
-            eW = W - np.transpose(R) @ Rd @ Wd
-            M = - k['R'] * eR - k['W'] * eW + wedge(W) @ (J @ W) - J @ (wedge(W) @ np.transpose(R) @ Rd @ Wd - np.transpose(R) @ Rd @ Wddot)
-            return M, eR, eW
-
-        # the original code starts from below
-        # # Get the desired force vector.
-        # pos_err  = state['x'] - flat_output['x']
-        # dpos_err = state['v'] - flat_output['x_dot']
-        # F_des = self.mass * (- self.kp_pos*pos_err
-        #                      - self.kd_pos*dpos_err
-        #                      + flat_output['x_ddot']
-        #                      + np.array([0, 0, self.g]))
-
-        # # Desired thrust is force projects onto b3 axis.
-        # R = Rotation.from_quat(state['q']).as_matrix()
-        # b3 = R @ np.array([0, 0, 1])
-        # u1 = np.dot(F_des, b3)
-
-        # # Desired orientation to obtain force vector.
-        # b3_des = normalize(F_des)
-        # yaw_des = flat_output['yaw']
-        # c1_des = np.array([np.cos(yaw_des), np.sin(yaw_des), 0])
-        # b2_des = normalize(np.cross(b3_des, c1_des))
-        # b1_des = np.cross(b2_des, b3_des)
-        # R_des = np.stack([b1_des, b2_des, b3_des]).T
-
-        # # Orientation error.
-        # S_err = 0.5 * (R_des.T @ R - R.T @ R_des) # sheng: this is the same as we do
-        # att_err = vee_map(S_err)
-
-        # # Angular velocity error (this is oversimplified).
-        # w_des = np.array([0, 0, flat_output['yaw_dot']]) # sheng: this is indeed oversimplified
-        # w_err = state['w'] - w_des
-
-        # # Desired torque, in units N-m.
-        # u2 = self.inertia @ (-self.kp_att*att_err - self.kd_att*w_err) + np.cross(state['w'], self.inertia@state['w'])  # Includes compensation for wxJw component
-
-        # # Compute command body rates by doing PD on the attitude error. 
-        # cmd_w = -self.kp_att*att_err - self.kd_att*w_err
+        R = quat_to_rotmat(state['q'])
+        desired = desired_from_flat_output(flat_output, self.desired_buffer)
 
         # Compute motor speeds. Avoid taking square root of negative numbers.
-        f, M, u, error, R_des, omega_des = geometric_controller(self, state, flat_output)
-        f = f[0]
-        M = M.reshape(3)
+        f, M, error, R_des, omega_des = geometric_controller(state['x'], state['v'], R, state['w'], desired,
+                                                             self.k_vec, self.mass, self.inertia, self.use_jit)
 
         x = state['x'].reshape(3)
         v = state['v'].reshape(3)
-        R = Rotation.from_quat(state['q']).as_matrix()     
         W = state['w'].reshape(3)
 
-        f_l1, M_l1, sigma_m_hat = L1AC(self,R,W,x,v,f,M)
-
-        # u_new = np.vstack((f_l1, M_l1[0]))
-        # u_new = np.vstack((u_new, M_l1[1]))
-        # u_new = np.vstack((u_new, M_l1[2]))
-        u_new = np.vstack((f_l1.reshape(1,1),M_l1.reshape(3,1)))
-        # u_new = np.vstack((f, M[0]))
-        # u_new = np.vstack((u_new, M[1]))
-        # u_new = np.vstack((u_new, M[2]))
-        # print('f is ', f)
-        # print('M is ', M)
-        # print('u is ', u)
-        # print('x is ',x)
-        # print('v is ',v)
-        # print('R is ',R)
-        # print('W is ',W)
-        # print('uncertainty is ', sigma_m_hat)
-        # print('f_l1 ', f_l1)
-        # print('M_l1 ', M_l1)
-        # print('after u is ', u_new)
-        # print(' ')
-        TM = np.array(u_new)
+        f_l1, M_l1, sigma_m_hat = self.L1AC(R,W,x,v,f,M)
+
+        TM = self.TM_buffer
+        TM[0] = f_l1
+        TM[1:4] = M_l1
         cmd_rotor_thrusts = self.TM_to_f @ TM
         cmd_motor_speeds = cmd_rotor_thrusts / self.k_eta
         cmd_motor_speeds = np.sign(cmd_motor_speeds) * np.sqrt(np.abs(cmd_motor_speeds))
 
-        # Assign controller commands. sheng: todo
-        cmd_thrust = u_new[0]                                             # Commanded thrust, in units N.
-        cmd_moment = u_new[1:4]                                             # Commanded moment, in units N-m.
-        cmd_q = Rotation.from_matrix(R_des).as_quat()               # Commanded attitude as a quaternion.
-        # cmd_v = -self.kp_vel*pos_err + flat_output['x_dot']     # Commanded velocity in world frame (if using cmd_vel control abstraction), in units m/s
+        # Assign controller commands.
+        cmd_thrust = f_l1                                             # Commanded thrust, in units N.
+        cmd_moment = M_l1                                             # Commanded moment, in units N-m.
+        cmd_q = rotmat_to_quat(R_des)               # Commanded attitude as a quaternion.
         cmd_v = flat_output['x_dot']     # sheng: desired velocity (use the simplified version)
-        
+
         control_input = {'cmd_motor_speeds':cmd_motor_speeds,
                          'cmd_motor_thrusts':cmd_rotor_thrusts,
-                         'cmd_thrust':cmd_thrust[0],
-                         'cmd_moment':cmd_moment.reshape(3,),
+                         'cmd_thrust':cmd_thrust,
+                         'cmd_moment':cmd_moment,
                          'cmd_q':cmd_q,
                          'cmd_w':omega_des,
                          'cmd_v':cmd_v
                         }
-        return control_input
\ No newline at end of file
+        return control_input
+
+    def L1AC(self, R, W, x, v, f, M):
+        """
+        One step of the L1 adaptive control on top of the baseline geometric control (f, M).
+        The predictor and filter memory is carried across calls in self.din_L1.
+        """
+        (As_v, As_omega, dt, ctoffq1Thrust, ctoffq1Moment, ctoffq2Moment, kg_vehicleMass, GRAVITY_MAGNITUDE, J ) = self.L1_params
+        (v_hat_prev, omega_hat_prev, R_prev, v_prev, omega_prev,
+        u_b_prev, u_ad_prev, sigma_m_hat_prev, sigma_um_hat_prev,
+        lpf1_prev, lpf2_prev) = self.din_L1
+
+        # == begin L1 adaptive control ==
+        # first do the state predictor
+        e3 = np.array([0.0, 0.0, 1.0])
+        # load translational velocity
+        v_now = v
+
+        # load rotational velocity
+        omega_now = W
+
+        massInverse = 1.0 / kg_vehicleMass
+
+        # compute prediction error (on previous step)
+        vpred_error_prev = v_hat_prev - v_prev # computes v_tilde for (k-1) step
+        omegapred_error_prev = omega_hat_prev - omega_prev # computes omega_tilde for (k-1) step
+
+        v_hat = v_hat_prev + (-e3 * GRAVITY_MAGNITUDE - R_prev[:,2]* (u_b_prev[0] + u_ad_prev[0] + sigma_m_hat_prev[0]) * massInverse + R_prev[:,0] * sigma_um_hat_prev[0] * massInverse + R_prev[:,1] * sigma_um_hat_prev[1] * massInverse + vpred_error_prev * As_v) * dt
+        Jinv = self.Jinv
+        # temp vector: thrustMomentCmd[1--3] + u_ad_prev[1--3] + sigma_m_hat_prev[1--3]
+        # original form
+        tempVec = u_b_prev[1:4] + u_ad_prev[1:4] + sigma_m_hat_prev[1:4]
+        omega_hat = omega_hat_prev + (-np.matmul(Jinv, cross(omega_prev, (np.matmul(J, omega_prev)))) + np.matmul(Jinv, tempVec) + omegapred_error_prev * As_omega) * dt
+
+        # update the state prediction storage
+        v_hat_prev = v_hat
+        omega_hat_prev = omega_hat
+
+        # compute prediction error (for this step)
+        vpred_error = v_hat - v_now
+        omegapred_error = omega_hat - omega_now
+
+        # exponential coefficients coefficient for As
+        exp_As_v_dt = self.exp_As_v_dt
+        exp_As_omega_dt = self.exp_As_omega_dt
+
+        # latter part of uncertainty estimation (piecewise constant) (step2: adaptation law)
+        PhiInvmu_v = vpred_error / (exp_As_v_dt - 1) * As_v * exp_As_v_dt
+        PhiInvmu_omega = omegapred_error / (exp_As_omega_dt - 1) * As_omega * exp_As_omega_dt
+
+        sigma_m_hat = np.array([0.0,0.0,0.0,0.0]) # estimated matched uncertainty
+        sigma_m_hat_2to4 = np.array([0.0,0.0,0.0]) # second to fourth element of the estimated matched uncertainty
+        sigma_um_hat = np.array([0.0,0.0]) # estimated unmatched uncertainty
+
+        sigma_m_hat[0] = -np.dot(R[:,2], PhiInvmu_v) * kg_vehicleMass
+        # turn np.dot(R[:,2], PhiInvmu_v) * kg_vehicleMass to -np.dot(R[:,2], PhiInvmu_v) * kg_vehicleMass
+        sigma_m_hat_2to4 = -np.matmul(J, PhiInvmu_omega)
+        sigma_m_hat[1] = sigma_m_hat_2to4[0]
+        sigma_m_hat[2] = sigma_m_hat_2to4[1]
+        sigma_m_hat[3] = sigma_m_hat_2to4[2]
+
+        sigma_um_hat[0] = np.dot(R[:,0], PhiInvmu_v) * kg_vehicleMass
+        sigma_um_hat[1] = np.dot(R[:,1], PhiInvmu_v) * kg_vehicleMass
+
+        # store uncertainty estimations
+        sigma_m_hat_prev = sigma_m_hat
+        sigma_um_hat_prev = sigma_um_hat
+
+        # compute lpf1 coefficients
+        lpf1_coefficientThrust1 = self.lpf1_coefficientThrust1
+        lpf1_coefficientThrust2 = self.lpf1_coefficientThrust2
+
+        lpf1_coefficientMoment1 = self.lpf1_coefficientMoment1
+        lpf1_coefficientMoment2 = self.lpf1_coefficientMoment2
+
+        # update the adaptive control
+        u_ad_int = np.array([0.0,0.0,0.0,0.0])
+        u_ad = np.array([0.0,0.0,0.0,0.0])
+
+        # low-pass filter 1 (negation is added to u_ad_prev to filter the correct signal)
+        u_ad_int[0] = lpf1_coefficientThrust1 * (lpf1_prev[0]) + lpf1_coefficientThrust2 * sigma_m_hat[0]
+        u_ad_int[1:4] = lpf1_coefficientMoment1 * (lpf1_prev[1:4]) + lpf1_coefficientMoment2 * sigma_m_hat[1:4]
+
+        lpf1_prev = u_ad_int # store the current state
+
+        # coefficients for the second LPF on the moment channel
+        lpf2_coefficientMoment1 = self.lpf2_coefficientMoment1
+        lpf2_coefficientMoment2 = self.lpf2_coefficientMoment2
+
+        # low-pass filter 2 (optional)
+        u_ad[0] = u_ad_int[0] # only one filter on the thrust channel
+        u_ad[1:4] = lpf2_coefficientMoment1 * lpf2_prev[1:4] + lpf2_coefficientMoment2 * u_ad_int[1:4]
+
+        lpf2_prev = u_ad # store the current state
+
+        u_ad = -u_ad
+
+        # store the values for next iteration (negation is added to u_ad_prev to filter the correct signal)
+        u_ad_prev = u_ad
+
+        v_prev = v_now
+        omega_prev = omega_now
+        R_prev = R
+        u_b_prev = np.array([f,M[0],M[1],M[2]])
+
+        controlcmd_L1 = np.array([f,M[0],M[1],-M[2]]) + u_ad_prev
+
+        self.din_L1 = (v_hat_prev, omega_hat_prev, R_prev, v_prev, omega_prev,
+        u_b_prev, u_ad_prev, sigma_m_hat_prev, sigma_um_hat_prev,
+        lpf1_prev, lpf2_prev)
+
+        f_L1 = controlcmd_L1[0]
+        M_L1 = controlcmd_L1[1:4]
+        return (f_L1, M_L1, sigma_m_hat)
+
+    def init_L1_batch(self, num_vehicles):
+        """
+        Allocate the L1 predictor, uncertainty estimates and the two LPF states for num_vehicles vehicles.
+        This is the batched counterpart of din_L1: every field is a preallocated contiguous array with the
+        vehicle index on the first axis, and all fields are updated in place by L1AC_batch.
+        """
+        self.din_L1_batch = {
+            'v_hat':        np.zeros((num_vehicles, 3)),
+            'omega_hat':    np.zeros((num_vehicles, 3)),
+            'R':            np.zeros((num_vehicles, 3, 3)),
+            'v':            np.zeros((num_vehicles, 3)),
+            'omega':        np.zeros((num_vehicles, 3)),
+            'u_b':          np.zeros((num_vehicles, 4)),
+            'u_ad':         np.zeros((num_vehicles, 4)),
+            'sigma_m_hat':  np.zeros((num_vehicles, 4)),
+            'sigma_um_hat': np.zeros((num_vehicles, 2)),
+            'lpf1':         np.zeros((num_vehicles, 4)),
+            'lpf2':         np.zeros((num_vehicles, 4)),
+        }
+
+    def L1AC_batch(self, R, W, v, f, M):
+        """
+        One step of the L1 adaptive control for all vehicles in the batch. Same law as L1AC in update().
+
+        Inputs:
+            R, rotation matrices of shape (N,3,3)
+            W, v, angular and linear velocities of shape (N,3)
+            f, M, baseline thrust (N,) and moments (N,3)
+        Outputs:
+            f_L1, M_L1, sigma_m_hat, of shapes (N,), (N,3) and (N,4); sigma_m_hat is a copy of the estimate kept in
+            self.din_L1_batch
+        """
+        (As_v, As_omega, dt, ctoffq1Thrust, ctoffq1Moment, ctoffq2Moment, kg_vehicleMass, GRAVITY_MAGNITUDE, J ) = self.L1_params
+        din = self.din_L1_batch
+        e3 = np.array([0.0, 0.0, 1.0])
+        massInverse = 1.0 / kg_vehicleMass
+        R_prev, u_b_prev, u_ad_prev = din['R'], din['u_b'], din['u_ad']
+        sigma_m_hat, sigma_um_hat = din['sigma_m_hat'], din['sigma_um_hat']
+
+        # state predictor (on previous step)
+        vpred_error_prev = din['v_hat'] - din['v']
+        omegapred_error_prev = din['omega_hat'] - din['omega']
+        thrust_prev = (u_b_prev[:, 0:1] + u_ad_prev[:, 0:1] + sigma_m_hat[:, 0:1]) * massInverse
+        din['v_hat'] += (-e3 * GRAVITY_MAGNITUDE - R_prev[:, :, 2] * thrust_prev
+                         + R_prev[:, :, 0] * sigma_um_hat[:, 0:1] * massInverse
+                         + R_prev[:, :, 1] * sigma_um_hat[:, 1:2] * massInverse
+                         + vpred_error_prev * As_v) * dt
+        tempVec = u_b_prev[:, 1:4] + u_ad_prev[:, 1:4] + sigma_m_hat[:, 1:4]
+        omega_prev = din['omega']
+        din['omega_hat'] += ((tempVec - cross_batch(omega_prev, omega_prev @ J.T)) @ self.Jinv.T
+                             + omegapred_error_prev * As_omega) * dt
+
+        # prediction error (for this step) and piecewise-constant adaptation law
+        vpred_error = din['v_hat'] - v
+        omegapred_error = din['omega_hat'] - W
+        PhiInvmu_v = vpred_error / (self.exp_As_v_dt - 1) * As_v * self.exp_As_v_dt
+        PhiInvmu_omega = omegapred_error / (self.exp_As_omega_dt - 1) * As_omega * self.exp_As_omega_dt
+
+        sigma_m_hat[:, 0:1] = -dot_batch(R[:, :, 2], PhiInvmu_v) * kg_vehicleMass
+        sigma_m_hat[:, 1:4] = -PhiInvmu_omega @ J.T
+        sigma_um_hat[:, 0:1] = dot_batch(R[:, :, 0], PhiInvmu_v) * kg_vehicleMass
+        sigma_um_hat[:, 1:2] = dot_batch(R[:, :, 1], PhiInvmu_v) * kg_vehicleMass
+
+        # low-pass filter 1
+        lpf1 = din['lpf1']
+        lpf1[:, 0] = self.lpf1_coefficientThrust1 * lpf1[:, 0] + self.lpf1_coefficientThrust2 * sigma_m_hat[:, 0]
+        lpf1[:, 1:4] = self.lpf1_coefficientMoment1 * lpf1[:, 1:4] + self.lpf1_coefficientMoment2 * sigma_m_hat[:, 1:4]
+
+        # low-pass filter 2 (only on the moment channels)
+        lpf2 = din['lpf2']
+        lpf2[:, 0] = lpf1[:, 0]
+        lpf2[:, 1:4] = self.lpf2_coefficientMoment1 * lpf2[:, 1:4] + self.lpf2_coefficientMoment2 * lpf1[:, 1:4]
+
+        # store the values for next iteration (negation is added to u_ad_prev to filter the correct signal)
+        np.negative(lpf2, out=u_ad_prev)
+        din['v'][:] = v
+        din['omega'][:] = W
+        R_prev[:] = R
+        u_b_prev[:, 0] = f
+        u_b_prev[:, 1:4] = M
+
+        f_L1 = f + u_ad_prev[:, 0]
+        M_L1 = M * np.array([1.0, 1.0, -1.0]) + u_ad_prev[:, 1:4]
+        return f_L1, M_L1, sigma_m_hat.copy()
+
+    def update_batch(self, t, states, flat_outputs):
+        """
+        Batched version of update() for N vehicles, each with its own L1 predictor and filter states.
+        The L1 memory is (re)allocated with init_L1_batch() whenever the batch size changes.
+
+        Inputs:
+            t, present time in seconds
+            states, array of shape (N,13), each row is [x, v, q [i,j,k,w], w]
+            flat_outputs, a dict of stacked desired flat outputs, see GeoControl.update_batch()
+
+        Outputs:
+            control_input, a dict with the same keys as update(), each stacked along the first axis
+        """
+        states = np.asarray(states, dtype=float)
+        N = states.shape[0]
+        if self.din_L1_batch is None or self.din_L1_batch['v'].shape[0] != N:
+            self.init_L1_batch(N)
+
+        x = states[:, 0:3]
+        v = states[:, 3:6]
+        R = quat_to_rotmat_batch(states[:, 6:10])
+        W = states[:, 10:13]
+
+        desired = desired_from_flat_outputs_batch(flat_outputs, N)
+
+        f, Rc, Wc, Wc_dot, error = position_control_batch(x, v, R, W, desired, self.k_vec, self.mass)
+        M, error['R'], error['W'] = attitude_control_batch(R, W, Rc, Wc, Wc_dot, self.k_vec, self.inertia)
+
+        f_l1, M_l1, sigma_m_hat = self.L1AC_batch(R, W, v, f, M)
+
+        TM = np.column_stack((f_l1, M_l1))
+        cmd_rotor_thrusts = TM @ self.TM_to_f.T
+        cmd_motor_speeds = cmd_rotor_thrusts / self.k_eta
+        cmd_motor_speeds = np.sign(cmd_motor_speeds) * np.sqrt(np.abs(cmd_motor_speeds))
+
+        control_input = {'cmd_motor_speeds':cmd_motor_speeds,
+                         'cmd_motor_thrusts':cmd_rotor_thrusts,
+                         'cmd_thrust':f_l1,
+                         'cmd_moment':M_l1,
+                         'cmd_q':rotmat_to_quat_batch(Rc),
+                         'cmd_w':Wc,
+                         'cmd_v':np.array(desired['v'])
+                        }
+        return control_input
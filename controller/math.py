@@ -1,5 +1,17 @@
 import numpy as np
 
+try:
+    import numba
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+def jit(func):
+    """Compile func with numba (nopython mode) if it is installed, otherwise return it unchanged."""
+    if HAS_NUMBA:
+        return numba.njit(cache=True)(func)
+    return func
+
 def wedge(x):
             """Return wedged vector."""
             wedge_x = np.array([[0,-x[2][0], x[1][0]], [x[2][0], 0, -x[0][0]], [-x[1][0], x[0][0], 0]])
@@ -9,11 +21,12 @@ def wedge(x):
 def deriv_unit_vector(q, q_dot, q_ddot):
     """derivative of a unit vector"""
     nq = np.linalg.norm(q)
+    q_qdot = np.dot(np.ravel(q), np.ravel(q_dot))
     u = q / nq
-    u_dot = q_dot / nq - q * np.dot(np.ravel(q), np.ravel(q_dot)) / nq**3
-    u_ddot = q_ddot / nq - q_dot / (nq**3) * (2 * np.dot(np.ravel(q), np.ravel(q_dot))) \
+    u_dot = q_dot / nq - q * q_qdot / nq**3
+    u_ddot = q_ddot / nq - q_dot / (nq**3) * (2 * q_qdot) \
     - q / nq**3 * (np.dot(np.ravel(q_dot), np.ravel(q_dot)) + np.dot(np.ravel(q), np.ravel(q_ddot))) \
-    + 3 * q / nq**5 * np.dot(np.ravel(q), np.ravel(q_dot))**2
+    + 3 * q / nq**5 * q_qdot**2
     return u, u_dot, u_ddot
 
 def normalize(x):
@@ -27,8 +40,208 @@ def vee(R):
                     R[0,2] - R[2,0], 
                     R[1,0] - R[0,1]]) / 2
 
+def cross(a, b):
+    """Cross product of two 3-vectors (much cheaper than np.cross for a single pair)"""
+    a0, a1, a2 = a
+    b0, b1, b2 = b
+    return np.array([a1 * b2 - a2 * b1,
+                     a2 * b0 - a0 * b2,
+                     a0 * b1 - a1 * b0])
+
 def skew(v):
     """Convert vector to skew symmetric matrix"""
     return np.array([[0, -v[2], v[1]],
                     [v[2], 0, -v[0]],
-                    [-v[1], v[0], 0]])
\ No newline at end of file
+                    [-v[1], v[0], 0]])
+
+def wedge_batch(x):
+    """Return wedged vectors for a stack of vectors of shape (N,3)."""
+    wedge_x = np.zeros(x.shape[:-1] + (3, 3))
+    wedge_x[..., 0, 1] = -x[..., 2]
+    wedge_x[..., 0, 2] = x[..., 1]
+    wedge_x[..., 1, 0] = x[..., 2]
+    wedge_x[..., 1, 2] = -x[..., 0]
+    wedge_x[..., 2, 0] = -x[..., 1]
+    wedge_x[..., 2, 1] = x[..., 0]
+    return wedge_x
+
+
+def vee_batch(S):
+    """Convert a stack of skew-symmetric matrices of shape (N,3,3) to vectors of shape (N,3)"""
+    return np.stack([S[..., 2, 1] - S[..., 1, 2],
+                     S[..., 0, 2] - S[..., 2, 0],
+                     S[..., 1, 0] - S[..., 0, 1]], axis=-1) / 2
+
+
+def cross_batch(a, b):
+    """Cross product of two stacks of vectors of shape (N,3)"""
+    return np.stack([a[..., 1] * b[..., 2] - a[..., 2] * b[..., 1],
+                     a[..., 2] * b[..., 0] - a[..., 0] * b[..., 2],
+                     a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]], axis=-1)
+
+
+def dot_batch(a, b):
+    """Row-wise dot product of two stacks of vectors of shape (N,3), returned with shape (N,1)"""
+    return np.sum(a * b, axis=-1, keepdims=True)
+
+
+def deriv_unit_vector_batch(q, q_dot, q_ddot):
+    """derivative of a stack of unit vectors of shape (N,3)"""
+    nq = np.linalg.norm(q, axis=-1, keepdims=True)
+    q_qdot = dot_batch(q, q_dot)
+    u = q / nq
+    u_dot = q_dot / nq - q * q_qdot / nq**3
+    u_ddot = q_ddot / nq - q_dot / (nq**3) * (2 * q_qdot) \
+    - q / nq**3 * (dot_batch(q_dot, q_dot) + dot_batch(q, q_ddot)) \
+    + 3 * q / nq**5 * q_qdot**2
+    return u, u_dot, u_ddot
+
+
+"""
+JIT kernels for 3-vectors and 3x3 matrices. These are written element-wise so that numba compiles them
+into allocation-light machine code; without numba they still run as plain python (slowly), and callers
+should use the NumPy functions above instead, see HAS_NUMBA.
+"""
+
+@jit
+def dot_kernel(a, b):
+    """Dot product of two 3-vectors"""
+    return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+
+@jit
+def cross_kernel(a, b):
+    """Cross product of two 3-vectors"""
+    out = np.empty(3)
+    out[0] = a[1] * b[2] - a[2] * b[1]
+    out[1] = a[2] * b[0] - a[0] * b[2]
+    out[2] = a[0] * b[1] - a[1] * b[0]
+    return out
+
+@jit
+def skew_kernel(v):
+    """Convert a 3-vector to a skew symmetric matrix"""
+    out = np.zeros((3, 3))
+    out[0, 1] = -v[2]
+    out[0, 2] = v[1]
+    out[1, 0] = v[2]
+    out[1, 2] = -v[0]
+    out[2, 0] = -v[1]
+    out[2, 1] = v[0]
+    return out
+
+@jit
+def vee_kernel(S):
+    """Convert a skew-symmetric matrix to a 3-vector"""
+    out = np.empty(3)
+    out[0] = (S[2, 1] - S[1, 2]) / 2
+    out[1] = (S[0, 2] - S[2, 0]) / 2
+    out[2] = (S[1, 0] - S[0, 1]) / 2
+    return out
+
+@jit
+def normalize_kernel(x):
+    """Return normalized 3-vector"""
+    return x / np.sqrt(dot_kernel(x, x))
+
+@jit
+def matvec_kernel(A, x):
+    """A @ x for a 3x3 matrix and a 3-vector"""
+    out = np.empty(3)
+    for i in range(3):
+        out[i] = A[i, 0] * x[0] + A[i, 1] * x[1] + A[i, 2] * x[2]
+    return out
+
+@jit
+def matmul_kernel(A, B):
+    """A @ B for 3x3 matrices"""
+    out = np.empty((3, 3))
+    for i in range(3):
+        for j in range(3):
+            out[i, j] = A[i, 0] * B[0, j] + A[i, 1] * B[1, j] + A[i, 2] * B[2, j]
+    return out
+
+@jit
+def matTmul_kernel(A, B):
+    """A.T @ B for 3x3 matrices"""
+    out = np.empty((3, 3))
+    for i in range(3):
+        for j in range(3):
+            out[i, j] = A[0, i] * B[0, j] + A[1, i] * B[1, j] + A[2, i] * B[2, j]
+    return out
+
+@jit
+def deriv_unit_vector_kernel(q, q_dot, q_ddot):
+    """derivative of a unit 3-vector"""
+    nq = np.sqrt(dot_kernel(q, q))
+    q_qdot = dot_kernel(q, q_dot)
+    u = q / nq
+    u_dot = q_dot / nq - q * q_qdot / nq**3
+    u_ddot = q_ddot / nq - q_dot / (nq**3) * (2 * q_qdot) \
+    - q / nq**3 * (dot_kernel(q_dot, q_dot) + dot_kernel(q, q_ddot)) \
+    + 3 * q / nq**5 * q_qdot**2
+    return u, u_dot, u_ddot
+
+@jit
+def geometric_control_kernel(x, v, R, W, xd, vd, xd_2dot, xd_3dot, xd_4dot, b1, b1_dot, b1_2dot,
+                             kx, kv, kR, kW, m, J):
+    """
+    Geometric position and attitude control law in one kernel. Same law as position_control followed by
+    attitude_control in controller/geometric_control.py. All vectors are float arrays of shape (3,).
+
+    Outputs:
+        f, M, Rc, Wc, thrust, moment, commanded attitude and angular velocity
+        ex, ev, eR, eW, position, velocity, attitude and angular velocity errors
+    """
+    g = 9.8
+    e3 = np.array([0.0, 0.0, 1.0])
+
+    # position control
+    ex = x - xd
+    ev = v - vd
+    A = -kx * ex - kv * ev + m * g * e3 + m * xd_2dot
+
+    b3 = R[:, 2].copy()
+    f = dot_kernel(A, b3)
+
+    ev_dot = -g * e3 + f / m * b3 - xd_2dot
+    A_dot = -kx * ev - kv * ev_dot + m * xd_3dot
+
+    W_e3 = np.array([W[1], -W[0], 0.0])
+    b3_dot = matvec_kernel(R, W_e3)
+    f_dot = dot_kernel(A_dot, b3) + dot_kernel(A, b3_dot)
+    ev_2dot = f_dot / m * b3 + f / m * b3_dot - xd_3dot
+    A_ddot = - kx * ev_dot - kv * ev_2dot + m * xd_4dot
+
+    b3c, b3c_dot, b3c_ddot = deriv_unit_vector_kernel(A, A_dot, A_ddot)
+
+    A2 = -cross_kernel(b1, b3c)
+    A2_dot = -cross_kernel(b1_dot, b3c) - cross_kernel(b1, b3c_dot)
+    A2_ddot = -cross_kernel(b1_2dot, b3c) - 2 * cross_kernel(b1_dot, b3c_dot) - cross_kernel(b1, b3c_ddot)
+
+    b2c, b2c_dot, b2c_ddot = deriv_unit_vector_kernel(A2, A2_dot, A2_ddot)
+
+    b1c = cross_kernel(b2c, b3c)
+    b1c_dot = cross_kernel(b2c_dot, b3c) + cross_kernel(b2c, b3c_dot)
+    b1c_ddot = cross_kernel(b2c_ddot, b3c) + 2 * cross_kernel(b2c_dot, b3c_dot) + cross_kernel(b2c, b3c_ddot)
+
+    Rc = np.empty((3, 3))
+    Rc_dot = np.empty((3, 3))
+    Rc_ddot = np.empty((3, 3))
+    for i in range(3):
+        Rc[i, 0], Rc[i, 1], Rc[i, 2] = b1c[i], b2c[i], b3c[i]
+        Rc_dot[i, 0], Rc_dot[i, 1], Rc_dot[i, 2] = b1c_dot[i], b2c_dot[i], b3c_dot[i]
+        Rc_ddot[i, 0], Rc_ddot[i, 1], Rc_ddot[i, 2] = b1c_ddot[i], b2c_ddot[i], b3c_ddot[i]
+
+    Wc = vee_kernel(matTmul_kernel(Rc, Rc_dot))
+    Wc_hat = skew_kernel(Wc)
+    Wc_dot = vee_kernel(matTmul_kernel(Rc, Rc_ddot) - matmul_kernel(Wc_hat, Wc_hat))
+
+    # attitude control
+    RtRd = matTmul_kernel(R, Rc)
+    eR = 1 / 2 * vee_kernel(RtRd.T - RtRd)
+    RtRd_Wd = matvec_kernel(RtRd, Wc)
+    eW = W - RtRd_Wd
+    M = - kR * eR - kW * eW + cross_kernel(W, matvec_kernel(J, W)) \
+        - matvec_kernel(J, cross_kernel(W, RtRd_Wd) - matvec_kernel(RtRd, Wc_dot))
+
+    return f, M, Rc, Wc, ex, ev, eR, eW
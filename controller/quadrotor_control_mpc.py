@@ -1,31 +1,60 @@
 import numpy as np
 from time import time
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from scipy.spatial.transform import Rotation
 from rotorpy.trajectories.hover_traj  import HoverTraj
 from controller.quadrotor_mpc import QuadMPC
+from controller.quadrotor_traopt import WARM_START_MODES
 from controller.quadrotor_util import skew_symmetric, v_dot_q, quaternion_inverse
+from controller.deadline_monitor import DeadlineMonitor
 class ModelPredictiveControl(object):
     """
 
     """
     def __init__(self, quad_params, sim_rate, 
-                 trajectory, t_final, t_horizon, n_nodes 
+                 trajectory, t_final, t_horizon, n_nodes, warm_start='none', solve_budget=None,
+                 async_solve=False, expected_delay=None, compute_residuals=False
                  ):
         """
         Parameters:
             quad_params, dict with keys specified in rotorpy/vehicles
+            warm_start, initialization of the solver iterate before each solve:
+                'none', the previous solution as left by acados
+                'shift', the previous solution shifted forward by one node
+                'reference', the reference trajectory
+            solve_budget, deadline of a solve in seconds for the deadline monitor, default optimization_dt
+            async_solve, run the solves in a background thread while the simulation keeps applying the previous
+                input sequence (see update_async); call close() when done
+            expected_delay, compute delay assumed by the asynchronous mode in seconds, between 0 and optimization_dt
+                (the default): each solve starts from the state predicted that far ahead, against the reference of
+                that time, and its solution is applied from then on, before the next solve is launched
+            compute_residuals, also record the KKT residuals of each solve, at the cost of an extra residual
+                evaluation per solve
         """
+        if warm_start not in WARM_START_MODES:
+            raise ValueError("Unknown warm start mode '{}', expected one of {}".format(warm_start, WARM_START_MODES))
+        self.warm_start = warm_start
+
         self.quad_mpc = QuadMPC(quad_params=quad_params, trajectory=trajectory, t_final=t_final,
-                                t_horizon=t_horizon, n_nodes=n_nodes)
+                                t_horizon=t_horizon, n_nodes=n_nodes, compute_residuals=compute_residuals)
 
         # compute optimation rate
         self.optimization_dt = t_horizon / n_nodes
         self.sim_dt = 1/sim_rate
-        self.sliding_index = 0 #determine current MPC reference
+        self.solve_budget = self.optimization_dt if solve_budget is None else solve_budget
 
-        # Initilize controls
-        self.cmd_motor_forces = np.zeros((4,))
+        # Asynchronous mode: a single worker thread, so at most one solve is in flight (acados releases the GIL)
+        self.async_solve = async_solve
+        self.expected_delay = self.optimization_dt if expected_delay is None else expected_delay
+        if not 0 <= self.expected_delay <= self.optimization_dt:
+            raise ValueError('expected_delay must be between 0 and optimization_dt ({} s), got {}'.format(
+                self.optimization_dt, self.expected_delay))
+        # Reference index offset of the predicted state, a fraction of a node
+        self.delay_nodes = self.expected_delay / self.optimization_dt
+        self.executor = ThreadPoolExecutor(max_workers=1) if async_solve else None
+        self.pending = None
+        self.reset()
 
         # Load quad params
         self.num_rotors      = quad_params['num_rotors']
@@ -36,6 +65,56 @@ class ModelPredictiveControl(object):
         self.f_to_TM = np.vstack((np.ones((1,self.num_rotors)),np.hstack([np.cross(self.rotor_pos[key],np.array([0,0,1])).reshape(-1,1)[0:2] for key in self.rotor_pos]), np.array([k*(-1)**i for i in range(self.num_rotors)]).reshape(1,-1)))
         self.TM_to_f = np.linalg.inv(self.f_to_TM)
         
+    def reset(self, trajectory=None, t_final=None):
+        """
+        Restarts the controller at the beginning of the reference, with zero motor forces, a new deadline monitor
+        and reset solver iterates. The compiled solver and the reference are kept, so a new episode on the same
+        trajectory does not pay for the setup again.
+
+        trajectory, if given, re-targets the controller to this trajectory (over t_final seconds, default the
+        current duration): its reference is generated while the compiled solver is still reused
+        """
+        self._discard_pending()
+        if trajectory is not None:
+            self.quad_mpc.set_trajectory(trajectory, t_final)
+        self.sliding_index = 0 #determine current MPC reference
+        self.cmd_motor_forces = np.zeros((4,))   # Initilize controls
+        self.deadline_monitor = DeadlineMonitor(self.solve_budget)
+        self.quad_mpc.quad_opt.reset()
+        # Input sequence applied by the asynchronous mode (N x 4 motor forces) and the time of its first node
+        self.plan = None
+        self.plan_start = 0.0
+        self.pending_start = 0.0
+
+    def close(self):
+        """
+        Waits for the solve in flight, if any, and stops the worker thread of the asynchronous mode.
+        """
+        self._discard_pending()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def get_state(self):
+        """
+        Snapshot of the controller as a flat array: [sliding_index, cmd_motor_forces (4), optimizer snapshot], see
+        QuadOptimizer.get_state. The deadline monitor is not part of it. Only the synchronous mode can be
+        snapshotted, the asynchronous one has a solve in flight.
+        """
+        if self.async_solve:
+            raise RuntimeError('Snapshots of the asynchronous MPC are not supported')
+        return np.concatenate([[self.sliding_index], self.cmd_motor_forces, self.quad_mpc.quad_opt.get_state()])
+
+    def set_state(self, state):
+        """
+        Restores a snapshot of get_state().
+        """
+        if self.async_solve:
+            raise RuntimeError('Snapshots of the asynchronous MPC are not supported')
+        self.sliding_index = int(state[0])
+        self.cmd_motor_forces = np.array(state[1:5], dtype=float)
+        self.quad_mpc.quad_opt.set_state(state[5:])
+
     def update(self, t, state, flat_output):
         """
         This function receives the current time, true state, and desired flat
@@ -58,6 +137,8 @@ class ModelPredictiveControl(object):
         """
         # unpack state used for MPC
         state = self.unpack_state(state)
+        if self.async_solve:
+            return self.update_async(t, state)
 
         task_index = None
 
@@ -65,12 +146,20 @@ class ModelPredictiveControl(object):
         index, _ = divmod(t, self.optimization_dt)
         if int(index) == self.sliding_index:
             self.quad_mpc.set_reference(self.sliding_index)
-            w_opt,x_opt,sens_u = self.quad_mpc.run_optimization(initial_state=state, task_index=task_index)
+            w_opt,x_opt,sens_u = self.quad_mpc.run_optimization(initial_state=state, task_index=task_index,
+                                                                warm_start=self.warm_start)
+            self.deadline_monitor.record(self.quad_mpc.quad_opt.last_solve_stats)
             self.cmd_motor_forces = w_opt[:4]   # get controls
             cmd_motor_forces = self.cmd_motor_forces
             cmd_motor_speeds = cmd_motor_forces / self.k_eta
             cmd_motor_speeds = np.sign(cmd_motor_speeds) * np.sqrt(np.abs(cmd_motor_speeds))
             self.sliding_index += 1             # update slidng index
+        return self.control_input()
+
+    def control_input(self):
+        """
+        Control dict of the present motor forces self.cmd_motor_forces.
+        """
         # Compute motor speeds. Avoid taking square root of negative numbers.
         cmd_TM = self.f_to_TM @ self.cmd_motor_forces
         cmd_motor_forces = self.cmd_motor_forces
@@ -86,7 +175,113 @@ class ModelPredictiveControl(object):
         
 
         return control_input
+
+    def update_async(self, t, state):
+        """
+        update() of the asynchronous mode, state being the unpacked MPC state [x, v, q(wxyz), w].
+
+        At each optimization tick the next solve is launched in the worker thread from the state predicted with the
+        plan at its start time, expected_delay after the nominal time of the tick, against the reference interpolated
+        at that time. The previous plan stays in use until that start time, when the solve is collected (waiting for
+        it only if it is still running) and its input sequence becomes the plan. expected_delay being at most
+        optimization_dt, the start time is reached by the next tick. Between ticks the plan node of the present time
+        is applied, so the simulation steps overlap with the solve. The very first solve has no plan to fall back on
+        and is synchronous.
+        """
+        if self.pending is not None and t >= self.pending_start - 1e-9:
+            self._install(*self.pending.result(), self.pending_start)
+            self.pending = None
+
+        index, _ = divmod(t, self.optimization_dt)
+        if int(index) == self.sliding_index:
+            if self.plan is None:
+                self._install(*self._solve(state, self.sliding_index), t)
+            self.pending_start = self.sliding_index * self.optimization_dt + self.expected_delay
+            predicted_state = self.predict_state(state, t, self.pending_start - t)
+            self.pending = self.executor.submit(self._solve, predicted_state, self.sliding_index + self.delay_nodes)
+            self.sliding_index += 1
+
+        self.cmd_motor_forces = self.planned_input(t)
+        return self.control_input()
+
+    def _solve(self, state, reference_index):
+        """
+        One solve from state against the reference window at reference_index (fractional between nodes). Returns a copy of the optimal input
+        sequence and the solve statistics. Runs in the worker thread in the asynchronous mode.
+        """
+        self.quad_mpc.set_reference(reference_index)
+        self.quad_mpc.run_optimization(initial_state=state, warm_start=self.warm_start)
+        quad_opt = self.quad_mpc.quad_opt
+        return quad_opt.u_opt.copy(), dict(quad_opt.last_solve_stats)
+
+    def _install(self, plan, solve_stats, plan_start):
+        self.deadline_monitor.record(solve_stats)
+        self.plan = plan
+        self.plan_start = plan_start
+
+    def _discard_pending(self):
+        if self.pending is not None:
+            self.pending.exception()  # wait for the solve, whatever its outcome
+            self.pending = None
+
+    def planned_input(self, t):
+        """
+        Motor forces of the plan at time t: the node in progress, the first one before the plan starts and the last
+        one after its horizon.
+        """
+        node = int((t - self.plan_start + 1e-9) // self.optimization_dt)
+        return self.plan[min(max(node, 0), self.plan.shape[0] - 1)]
+
+    def nominal_dynamics(self, x, u):
+        """
+        Time derivative of the MPC state x = [x, v, q(wxyz), w] under the motor forces u, the model of
+        QuadOptimizer.quad_dynamics evaluated with NumPy.
+        """
+        quad_opt = self.quad_mpc.quad_opt
+        q = x[6:10]
+        w = x[10:13]
+        TM = self.f_to_TM @ u
+        x_dot = np.empty(13)
+        x_dot[0:3] = x[3:6]
+        x_dot[3:6] = v_dot_q(np.array([0.0, 0.0, TM[0] / quad_opt.quad_mass]), q) - np.array([0.0, 0.0, 9.81])
+        x_dot[6:10] = 0.5 * skew_symmetric(w) @ q
+        x_dot[10:13] = quad_opt.inv_J @ (TM[1:] - np.cross(w, quad_opt.J @ w))
+        return x_dot
+
+    def predict_state(self, state, t, delay):
+        """
+        MPC state predicted delay seconds after t by integrating the nominal model (RK4, steps of at most sim_dt)
+        under the inputs of the plan.
+        """
+        x = np.array(state, dtype=float)
+        if delay <= 0:
+            return x
+        steps = max(1, int(np.ceil(delay / self.sim_dt - 1e-9)))
+        h = delay / steps
+        for k in range(steps):
+            u = self.planned_input(t + k * h)
+            k1 = self.nominal_dynamics(x, u)
+            k2 = self.nominal_dynamics(x + 0.5 * h * k1, u)
+            k3 = self.nominal_dynamics(x + 0.5 * h * k2, u)
+            k4 = self.nominal_dynamics(x + h * k3, u)
+            x = x + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+            x[6:10] /= np.linalg.norm(x[6:10])
+        return x
     
+    def solver_statistics(self):
+        """
+        Summary of the solves so far: warm start mode, then the deadline monitor summary (number of solves and
+        deadline misses, failed solves, SQP iterations, solve time statistics in seconds, residuals), see
+        controller/deadline_monitor.py.
+        """
+        return dict(self.deadline_monitor.summary(), warm_start=self.warm_start)
+
+    def deadline_report(self):
+        """
+        Text summary of the real-time feasibility of the run, to be printed at its end.
+        """
+        return self.deadline_monitor.format_summary()
+
     def unpack_state(self, state):
         """
         This function unpacks the state and returns an array [x, v, quaternion(wxyz), w] of shape (13,)
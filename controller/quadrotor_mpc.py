@@ -6,68 +6,102 @@ from rotorpy.vehicles.hummingbird_params import quad_params  # There's also the
 from rotorpy.trajectories.circular_traj  import CircularTraj, ThreeDCircularTraj
 from rotorpy.trajectories.hover_traj  import HoverTraj
 from controller.quadrotor_util import minimum_snap_trajectory_generator
+from controller.reference_cache import reference_cache, reference_key
+from controller.trajectory_sampling import sample_trajectory
 
 class QuadMPC:
     def __init__(self, quad_params=quad_params, trajectory=CircularTraj(),
                  t_final=10, t_horizon=1, n_nodes=10,
-                 q_cost=None, r_cost=None, q_mask=None, model_name='quad_3d_acados_mpc', solver_options=None, plot_traj=False):
+                 q_cost=None, r_cost=None, q_mask=None, model_name='quad_3d_acados_mpc', solver_options=None, plot_traj=False,
+                 use_reference_cache=True, compute_residuals=False):
         """
-
+        use_reference_cache, reuse the reference generated for the same trajectory, timing and vehicle by an earlier
+        construction (see controller/reference_cache.py)
+        compute_residuals, add the KKT residuals to the solve statistics (see QuadOptimizer)
         """
             
         self.quad_opt = QuadOptimizer(quad_params=quad_params, t_horizon=t_horizon, n_nodes=n_nodes,
                                       q_cost=q_cost, r_cost=r_cost, q_mask=q_mask, 
-                                      model_name=model_name, solver_options=solver_options)
+                                      model_name=model_name, solver_options=solver_options,
+                                      compute_residuals=compute_residuals)
 
         plot = plot_traj
-        self.x_ref_list, self.u_ref_list, self.t_ref = self.prepare_ref_traj(trajectory, t_final, t_horizon, n_nodes, plot)
+        self.n_nodes = n_nodes
+        self.t_final = t_final
+        self.t_horizon = t_horizon
+        self.use_reference_cache = use_reference_cache
+        self.ref, self.t_ref = self.prepare_ref_traj(trajectory, t_final, t_horizon, n_nodes, plot,
+                                                     use_cache=use_reference_cache)
+
+    def set_trajectory(self, trajectory, t_final=None):
+        """
+        Re-targets the MPC to trajectory (over t_final seconds, default the current duration) by regenerating the
+        reference; the solver and its horizon are kept.
+        """
+        if t_final is not None:
+            self.t_final = t_final
+        self.ref, self.t_ref = self.prepare_ref_traj(trajectory, self.t_final, self.t_horizon, self.n_nodes,
+                                                     use_cache=self.use_reference_cache)
+
+    def prepare_ref_traj(self, traj, t_final, t_horizon, n_nodes, plot=False, use_cache=True):
+        """
+        Returns the full reference as one contiguous (T, 17) array, each row being [x, v, q(wxyz), w, u], and its
+        timestamps. The MPC windows are views into it (see set_reference).
+
+        use_cache, look the reference up in controller.reference_cache first; plotting always regenerates it
+        """
+        # Keyed on the parameters the generator actually uses (the module-level vehicle)
+        key = reference_key(traj, t_final, t_horizon, n_nodes, quad_params) if use_cache and not plot else None
+        cached = reference_cache.get(key) if key is not None else None
+        if cached is not None:
+            return cached['ref'], cached['t_ref']
 
-    def prepare_ref_traj(self, traj, t_final, t_horizon, n_nodes, plot=False):
         N = int(t_final/t_horizon * n_nodes)
         t_ref = np.linspace(0, t_final, N)
-        traj_d = np.zeros((4,3,N))
-        yaw_d = np.zeros((2,N))
-        for i,t in enumerate(t_ref):
-            state = traj.update(t)
-            traj_d[0,:,i] = state['x']
-            traj_d[1,:,i] = state['x_dot']
-            traj_d[2,:,i] = state['x_ddot']
-            traj_d[3,:,i] = state['x_dddot']
-            yaw_d[0,i] = state['yaw']
-            yaw_d[1,i] = state['yaw_dot']
+        flat = sample_trajectory(traj, t_ref)
+        traj_d = np.stack([flat['x'], flat['x_dot'], flat['x_ddot'], flat['x_dddot']]).transpose(0, 2, 1)  # 4x3xN
+        yaw_d = np.stack([flat['yaw'], flat['yaw_dot']])
         x_ref, t_ref, u_ref = minimum_snap_trajectory_generator(traj_d, yaw_d, t_ref, quad_params, 
                                                                    map_limits=None, plot=plot, to_list=True)
-        x_ref_list = []
-        u_ref_list = []
-        for i_l in range(N):
-            i_r = int(i_l + n_nodes)
-            if i_l > N - n_nodes:
-                x_ref_list.append([x_ref[0][i_l:,:], x_ref[1][i_l:,:], x_ref[2][i_l:,:], x_ref[3][i_l:,:]])
-                u_ref_list.append(u_ref[i_l:,:])
-            else:
-                x_ref_list.append([x_ref[0][i_l:i_r,:], x_ref[1][i_l:i_r,:], x_ref[2][i_l:i_r,:], x_ref[3][i_l:i_r,:]])
-                u_ref_list.append(u_ref[i_l:i_r,:])
-        return x_ref_list, u_ref_list, t_ref
+        ref = np.concatenate(x_ref + [u_ref], axis=1)
+        if key is not None:
+            reference_cache.put(key, {'ref': ref, 't_ref': t_ref})
+        return ref, t_ref
         
     def set_reference(self, index):
         """
         t, present time in seconds
         index, index of reference trajectory in the list
+
+        The window is a view of the next n_nodes rows of the reference (fewer at the end, where the optimizer repeats
+        the last row). A fractional index interpolates linearly between the rows around it (the quaternions are
+        renormalized), giving the window of a time between two nodes.
         """
-        if index >= len(self.x_ref_list):
-            index = len(self.x_ref_list) - 1
-        x_ref = self.x_ref_list[index]
-        u_ref = self.u_ref_list[index]
+        if index >= self.ref.shape[0]:
+            index = self.ref.shape[0] - 1
 
         use_model = 0
 
-        self.quad_opt.set_reference_trajectory(x_target=x_ref, u_target=u_ref, use_model=use_model)
+        lower = int(np.floor(index))
+        fraction = index - lower
+        if fraction == 0:
+            self.quad_opt.set_reference_window(self.ref[lower:lower + self.n_nodes], use_model=use_model)
+            return
+        rows = np.minimum(lower + np.arange(self.n_nodes), self.ref.shape[0] - 1)
+        window = (1 - fraction)*self.ref[rows] + fraction*self.ref[np.minimum(rows + 1, self.ref.shape[0] - 1)]
+        window[:, 6:10] /= np.linalg.norm(window[:, 6:10], axis=1, keepdims=True)
+        self.quad_opt.set_reference_window(window, use_model=use_model)
 
-    def run_optimization(self, initial_state=None, return_x=True, task_index=None):
+    def run_optimization(self, initial_state=None, return_x=True, task_index=None, return_sens=False, warm_start='none'):
+        """
+        return_sens, whether to compute du_0/dx_init; sens_u is None otherwise
+        warm_start, initialization of the solver iterate, one of 'none', 'shift', 'reference'
+        """
         x_init = initial_state
         use_model = 0
 
-        w_opt,x_opt,sens_u = self.quad_opt.run_optimization(initial_state=x_init, use_model=use_model, return_x=return_x)
+        w_opt,x_opt,sens_u = self.quad_opt.run_optimization(initial_state=x_init, use_model=use_model, return_x=return_x,
+                                                            return_sens=return_sens, warm_start=warm_start)
         return w_opt,x_opt,sens_u
 
     def clear_model(self):
@@ -14,17 +14,22 @@ import scipy.io
 import os
 import sys
 import shutil
+from time import perf_counter
 import casadi as cs
 import numpy as np
 from copy import copy
 from acados_template import AcadosOcp, AcadosOcpSolver, AcadosModel
 from controller.quadrotor_util import skew_symmetric, v_dot_q, safe_mkdir_recursive, quaternion_inverse, discretize_dynamics_and_cost
+from controller.acados_cache import ACADOS_MODELS_DIR, ocp_fingerprint, solver_build_dir, load_or_build_solver, clear_solver
+
+# Initializations of the solver iterate before a solve, see QuadOptimizer.warm_start
+WARM_START_MODES = ('none', 'shift', 'reference')
 
 class QuadOptimizer:
     def __init__(self, quad_params, t_horizon=1, n_nodes=5,
                  q_cost=None, r_cost=None, q_mask=None,
                  model_name="quad_3d_acados_mpc", 
-                 solver_options=None):
+                 solver_options=None, acados_models_dir=ACADOS_MODELS_DIR, compute_residuals=False):
         """
         :param quad: quadrotor params
         :param t_horizon: time horizon for MPC optimization
@@ -36,6 +41,10 @@ class QuadOptimizer:
         :param q_mask: Optional boolean mask that determines which variables from the state compute towards the cost
         function. In case no argument is passed, all variables are weighted.
         :param solver_options: Optional set of extra options dictionary for solvers.
+        :param acados_models_dir: directory of the compiled solver cache. Solvers are built once per OCP fingerprint
+        and loaded from there afterwards; concurrent constructions in several processes are safe.
+        :param compute_residuals: whether to add the KKT residuals of each solution to last_solve_stats. SQP_RTI does
+        not compute them during the solve, so this costs an extra residual evaluation per solve (outside solve_time).
         :param rdrv_d_mat: 3x3 matrix that corrects the drag with a linear model according to Faessler et al. 2018. None
         if not used
         """
@@ -101,6 +110,8 @@ class QuadOptimizer:
 
         # ### Setup and compile Acados OCP solvers ### #
         self.acados_ocp_solver = {}
+        self.acados_build_dirs = {}
+        self.batched_sensitivity = True
 
         # # Add one more weight to the rotation (use quaternion norm weighting in acados)
         # q_diagonal = np.concatenate((q_cost[:6], np.mean(q_cost[6:9])[np.newaxis], q_cost[6:]))
@@ -108,10 +119,9 @@ class QuadOptimizer:
         #     q_mask = np.concatenate((q_mask[:6], np.zeros(1), q_mask[6:]))
         #     q_diagonal *= q_mask
 
-        # Ensure current working directory is current folder
-        os.chdir(os.path.dirname(os.path.realpath(__file__)))
-        self.acados_models_dir = '../../acados_models'
-        safe_mkdir_recursive(os.path.join(os.getcwd(), self.acados_models_dir))
+        # Absolute so that the build does not depend on (or change) the working directory
+        self.acados_models_dir = os.path.abspath(acados_models_dir)
+        safe_mkdir_recursive(self.acados_models_dir)
 
         print(self.acados_models_dir)
 
@@ -127,7 +137,6 @@ class QuadOptimizer:
                 n_param = 0
 
             acados_source_path = os.environ['ACADOS_SOURCE_DIR']
-            sys.path.insert(0, '../common')
 
             # Create OCP object to formulate the optimization
             ocp = AcadosOcp()
@@ -176,21 +185,57 @@ class QuadOptimizer:
             ocp.solver_options.print_level = 0
             ocp.solver_options.nlp_solver_type = 'SQP_RTI' if solver_options is None else solver_options["solver_type"]
 
-            # Compile acados OCP solver if necessary
-            json_file = os.path.join(self.acados_models_dir, key_model.name + '_acados_ocp.json')
-            self.acados_ocp_solver[key] = AcadosOcpSolver(ocp, json_file=json_file)
+            # Compile acados OCP solver if necessary. The mass and inertia are baked into the dynamics expression.
+            fingerprint = ocp_fingerprint(ocp, self.quad_mass, self.J, self.f_to_TM)
+            self.acados_build_dirs[key] = solver_build_dir(self.acados_models_dir, key_model.name, fingerprint)
+            self.acados_ocp_solver[key] = load_or_build_solver(ocp, self.acados_build_dirs[key])
+
+        # Preallocated buffers for the stage references and the solution (see set_reference_trajectory, get_solution)
+        self.flat_transfer = hasattr(AcadosOcpSolver, 'get_flat')
+        self.yref = np.zeros((self.N + 1, self.state_dim + 4))
+        self.w_opt = np.zeros(self.N * 4)
+        self.u_opt = self.w_opt.reshape(self.N, 4)
+        self.x_opt = np.zeros((self.N + 1, self.state_dim))
+        self.has_solution = False
+        self.last_solve_stats = None
+        self.compute_residuals = compute_residuals
+
+    def reset(self):
+        """
+        Resets the iterates of the acados solvers and forgets the last solution, so that the next solve does not
+        depend on a previous episode.
+        """
+        for solver in self.acados_ocp_solver.values():
+            solver.reset()
+        self.w_opt[:] = 0
+        self.x_opt[:] = 0
+        self.has_solution = False
+        self.last_solve_stats = None
+
+    def get_state(self):
+        """
+        Snapshot of the last solution as a flat array: [has_solution, w_opt (N*4), x_opt ((N+1)*13)].
+        """
+        return np.concatenate([[float(self.has_solution)], self.w_opt, self.x_opt.reshape(-1)])
 
-    def clear_acados_model(self):
+    def set_state(self, state, use_model=0):
         """
-        Removes previous stored acados models to avoid name conflicts.
+        Restores a snapshot of get_state(), including the solver iterate, so that the next solve starts where the
+        snapshot was taken.
         """
+        self.reset()
+        if state[0]:
+            self.w_opt[:] = state[1:1 + self.w_opt.size]
+            self.x_opt.reshape(-1)[:] = state[1 + self.w_opt.size:]
+            self.has_solution = True
+            self.set_iterate(self.x_opt, self.u_opt, use_model)
 
-        json_file = os.path.join(self.acados_models_dir, 'acados_ocp.json')
-        if os.path.exists(json_file):
-            os.remove(os.path.join(os.getcwd(), json_file))
-        compiled_model_dir = os.path.join(os.getcwd(), 'c_generated_code')
-        if os.path.exists(compiled_model_dir):
-            shutil.rmtree(compiled_model_dir)
+    def clear_acados_model(self):
+        """
+        Removes the cached acados solvers of this optimizer so that they are rebuilt on the next construction.
+        """
+        for build_dir in self.acados_build_dirs.values():
+            clear_solver(build_dir)
 
     def add_missing_states(self, dnn_outs):
         """
@@ -337,29 +382,46 @@ class QuadOptimizer:
             assert x_target[0].shape[0] == (u_target.shape[0] + 1) or x_target[0].shape[0] == u_target.shape[0]
 
         # If not enough states in target sequence, append last state until required length is met
-        while x_target[0].shape[0] < self.N + 1:
-            x_target = [np.concatenate((x, np.expand_dims(x[-1, :], 0)), 0) for x in x_target]
+        n_missing = self.N + 1 - x_target[0].shape[0]
+        if n_missing > 0:
+            x_target = [np.concatenate((x, np.repeat(x[-1:, :], n_missing, 0)), 0) for x in x_target]
             if u_target is not None:
-                u_target = np.concatenate((u_target, np.expand_dims(u_target[-1, :], 0)), 0)
+                u_target = np.concatenate((u_target, np.repeat(u_target[-1:, :], n_missing, 0)), 0)
 
-        stacked_x_target = np.concatenate([x for x in x_target], 1)
+        self.target = copy(x_target)
 
-        #  Transform velocity to body frame
-        x_mean = stacked_x_target[int(self.N / 2)]
-        v_b = v_dot_q(x_mean[3:6], quaternion_inverse(x_mean[6:10]))
-        x_target_mean = np.concatenate((x_mean[:3], v_b, x_mean[6:]))
+        # Stage references [x_ref, u_ref] of all nodes, written in one go
+        column = 0
+        for x in x_target:
+            self.yref[:, column:column + x.shape[1]] = x[:self.N + 1]
+            column += x.shape[1]
+        self.yref[:self.N, self.state_dim:] = u_target[:self.N]
 
-        self.target = copy(x_target)
+        self._send_stage_references(use_model)
+        return use_model
+
+    def set_reference_window(self, ref, use_model=0):
+        """
+        Same as set_reference_trajectory for a reference already stacked as an n x 17 array (state, input) per row,
+        e.g. a view into a longer reference. Rows beyond N+1 are ignored, missing rows repeat the last one.
+        """
+        n_rows = min(ref.shape[0], self.N + 1)
+        self.yref[:n_rows] = ref[:n_rows]
+        self.yref[n_rows:] = ref[n_rows - 1]
+        self.target = self.yref[:, :self.state_dim]
 
+        self._send_stage_references(use_model)
+        return use_model
+
+    def _send_stage_references(self, use_model):
+        solver = self.acados_ocp_solver[use_model]
         for j in range(self.N):
-            ref = stacked_x_target[j, :]
-            ref = np.concatenate((ref, u_target[j, :]))
-            self.acados_ocp_solver[use_model].set(j, "yref", ref)
+            solver.set(j, "yref", self.yref[j])
         # the last MPC node has only a state reference but no input reference
-        self.acados_ocp_solver[use_model].set(self.N, "yref", stacked_x_target[self.N, :])
-        return use_model
+        solver.set(self.N, "yref", self.yref[self.N, :self.state_dim])
 
-    def run_optimization(self, initial_state=None, use_model=0, return_x=False, task_index=0):
+    def run_optimization(self, initial_state=None, use_model=0, return_x=False, task_index=0, return_sens=False,
+                         warm_start='none'):
         """
         Optimizes a trajectory to reach the pre-set target state, starting from the input initial state, that minimizes
         the quadratic cost function and respects the constraints of the system
@@ -368,7 +430,11 @@ class QuadOptimizer:
         :param use_model: integer, select which model to use from the available options.
         :param return_x: bool, whether to also return the optimized sequence of states alongside with the controls.
         :param gp_regression_state: 13-element list of state for GP prediction. If None, initial_state will be used.
-        :return: optimized control input sequence (flattened)
+        :param return_sens: bool, whether to also compute the sensitivity du_0/dx_init (see solution_sensitivity).
+        Otherwise None is returned in its place.
+        :param warm_start: initialization of the iterate before the solve, one of WARM_START_MODES (see warm_start).
+        :return: optimized control input sequence (flattened). The arrays returned are copies of the solution
+        buffers (see get_solution), so they stay valid after the next solve.
         """
 
         if initial_state is None:
@@ -383,27 +449,112 @@ class QuadOptimizer:
         self.acados_ocp_solver[use_model].set(0, 'ubx', x_init)
 
         # Solve OCP
-        self.acados_ocp_solver[use_model].solve()
-
+        self.warm_start(warm_start, use_model)
+        solver = self.acados_ocp_solver[use_model]
+        tic = perf_counter()
+        status = solver.solve()
+        self.last_solve_stats = {'status': int(status),
+                                 'sqp_iter': int(np.squeeze(solver.get_stats('sqp_iter'))),
+                                 'time_tot': float(np.squeeze(solver.get_stats('time_tot'))),
+                                 'solve_time': perf_counter() - tic}
+        self._add_solution_quality(solver, self.last_solve_stats)
 
         # Solve du/dx_init
+        sens_u = self.solution_sensitivity(use_model) if return_sens else None
+
+        # Get u, N is number of steps in MPC horizon
+        self.get_solution(use_model)
+        return self.w_opt.copy() if not return_x else (self.w_opt.copy(), self.x_opt.copy(), sens_u)
+
+    def _add_solution_quality(self, solver, stats):
+        """
+        Adds the status of the last QP to stats and, with compute_residuals, the KKT residuals [stationarity, equality,
+        inequality, complementarity] of the solution, recomputed where acados supports it.
+        """
+        stats['qp_status'] = int(np.atleast_1d(np.squeeze(solver.get_stats('qp_stat')))[-1])
+        if not self.compute_residuals:
+            return
+        try:
+            residuals = solver.get_residuals(recompute=True)
+        except TypeError:
+            residuals = solver.get_residuals()
+        stats['res_stat'], stats['res_eq'], stats['res_ineq'], stats['res_comp'] = (float(r) for r in residuals)
+
+    def warm_start(self, mode, use_model=0):
+        """
+        Initializes the solver iterate before a solve. Modes:
+            'none', keep the iterate acados holds, i.e. the previous solution without shifting
+            'shift', previous solution shifted forward by one node, with the last node repeated
+            'reference', the stage references set by set_reference_trajectory
+        'shift' falls back to 'reference' until a first solution is available.
+        """
+        if mode not in WARM_START_MODES:
+            raise ValueError("Unknown warm start mode '{}', expected one of {}".format(mode, WARM_START_MODES))
+        if mode == 'none':
+            return
+        if mode == 'shift' and self.has_solution:
+            # In-place shift of the solution buffers (numpy handles the overlapping copy)
+            self.x_opt[:-1] = self.x_opt[1:]
+            self.u_opt[:-1] = self.u_opt[1:]
+            x_guess, u_guess = self.x_opt, self.u_opt
+        else:
+            x_guess, u_guess = self.yref[:, :self.state_dim], self.yref[:self.N, self.state_dim:]
+
+        self.set_iterate(x_guess, u_guess, use_model)
+
+    def set_iterate(self, x_guess, u_guess, use_model=0):
+        """
+        Sets the solver iterate to the (N+1) x 13 states x_guess and N x 4 inputs u_guess.
+        """
+        solver = self.acados_ocp_solver[use_model]
+        if self.flat_transfer:
+            solver.set_flat("x", np.ascontiguousarray(x_guess).reshape(-1))
+            solver.set_flat("u", np.ascontiguousarray(u_guess).reshape(-1))
+        else:
+            for i in range(self.N):
+                solver.set(i, "x", x_guess[i])
+                solver.set(i, "u", u_guess[i])
+            solver.set(self.N, "x", x_guess[self.N])
+
+    def get_solution(self, use_model=0):
+        """
+        Reads the primal solution of the last solve into the preallocated buffers self.w_opt (flattened N x 4 inputs,
+        self.u_opt is the same data as an N x 4 view) and self.x_opt (N+1 x 13 states), with one get_flat call per
+        field on acados versions that provide it. The buffers are overwritten by the next call, copy them to keep a
+        solution.
+        """
+        solver = self.acados_ocp_solver[use_model]
+        if self.flat_transfer:
+            self.w_opt[:] = solver.get_flat("u")
+            self.x_opt.reshape(-1)[:] = solver.get_flat("x")
+        else:
+            for i in range(self.N):
+                self.u_opt[i] = solver.get(i, "u")
+                self.x_opt[i] = solver.get(i, "x")
+            self.x_opt[self.N] = solver.get(self.N, "x")
+        self.has_solution = True
+        return self.u_opt, self.x_opt
+
+    def solution_sensitivity(self, use_model=0):
+        """
+        Sensitivity du_0/dx_init (4x13) of the first optimal input w.r.t. the initial state at the last solution. Uses
+        one batched eval_solution_sensitivity call on acados versions that provide it, otherwise one eval_param_sens
+        call per state.
+        """
+        solver = self.acados_ocp_solver[use_model]
+        if self.batched_sensitivity and hasattr(solver, 'eval_solution_sensitivity'):
+            try:
+                sens = solver.eval_solution_sensitivity(0, 'initial_state')
+                sens_u = sens['sens_u'] if isinstance(sens, dict) else sens[1]
+                return np.reshape(sens_u, (4, 13))
+            except Exception:
+                # Not supported with this solver configuration, use the per-state evaluation from now on
+                self.batched_sensitivity = False
+
         sens_u = np.zeros((4,13))
         field = 'ex'
         stage = 0
         for index in range(13):
-            self.acados_ocp_solver[use_model].eval_param_sens(index,stage,field)
-            temp = self.acados_ocp_solver[use_model].get(0,'sens_u')
-            sens_u[:,index] = temp
-        
-        
-        # Get u, N is number of steps in MPC horizon
-        w_opt_acados = np.ndarray((self.N, 4))
-        x_opt_acados = np.ndarray((self.N + 1, len(x_init)))
-        x_opt_acados[0, :] = self.acados_ocp_solver[use_model].get(0, "x")
-        for i in range(self.N):
-            w_opt_acados[i, :] = self.acados_ocp_solver[use_model].get(i, "u")
-            x_opt_acados[i + 1, :] = self.acados_ocp_solver[use_model].get(i + 1, "x")
-
-        w_opt_acados = np.reshape(w_opt_acados, (-1))
-        return w_opt_acados if not return_x else (w_opt_acados, x_opt_acados,sens_u)
-
+            solver.eval_param_sens(index,stage,field)
+            sens_u[:,index] = solver.get(0,'sens_u')
+        return sens_u
@@ -190,6 +190,20 @@ def undo_quaternion_flip(q_past, q_current):
         return -q_current
     return q_current
 
+def undo_quaternion_flips(q, start=1):
+    """
+    Vectorized equivalent of applying undo_quaternion_flip sequentially along a quaternion series, i.e. of
+    q[i] = undo_quaternion_flip(q[i - 1], q[i]) for i = start, ..., N-1. A sample is flipped when its dot product with
+    the corrected previous one is negative, so the flips accumulate as a cumulative product of signs.
+    :param q: Nx4 array of quaternions
+    :param start: index of the first sample that may be flipped
+    :return: Nx4 array with the flips removed
+    """
+
+    sign = np.ones(q.shape[0])
+    sign[start:] = np.where(np.sum(q[start - 1:-1] * q[start:], 1) < 0, -1.0, 1.0)
+    return q * np.cumprod(sign)[:, np.newaxis]
+
 def rotation_matrix_to_quat(rot):
     """
     Calculate a quaternion from a 3x3 rotation matrix.
@@ -201,6 +215,31 @@ def rotation_matrix_to_quat(rot):
     q = pyquaternion.Quaternion(matrix=rot)
     return np.array([q.w, q.x, q.y, q.z])
 
+def rotation_matrix_to_quat_batch(rot):
+    """
+    Batched version of rotation_matrix_to_quat: same branch choice and sign as pyquaternion, without its orthogonality
+    check.
+
+    :param rot: Nx3x3 numpy array of valid rotation matrices
+    :return: Nx4 array of the corresponding quaternions. Quaternion format: wxyz
+    """
+
+    # pyquaternion's trace method works on the transposed matrix
+    m = np.swapaxes(rot, 1, 2)
+    m00, m01, m02 = m[:, 0, 0], m[:, 0, 1], m[:, 0, 2]
+    m10, m11, m12 = m[:, 1, 0], m[:, 1, 1], m[:, 1, 2]
+    m20, m21, m22 = m[:, 2, 0], m[:, 2, 1], m[:, 2, 2]
+
+    t = np.stack((1 + m00 - m11 - m22, 1 - m00 + m11 - m22, 1 - m00 - m11 + m22, 1 + m00 + m11 + m22))
+    q = np.stack((np.stack((m12 - m21, t[0], m01 + m10, m20 + m02), 1),
+                  np.stack((m20 - m02, m01 + m10, t[1], m12 + m21), 1),
+                  np.stack((m01 - m10, m20 + m02, m12 + m21, t[2]), 1),
+                  np.stack((t[3], m12 - m21, m20 - m02, m01 - m10), 1)))
+
+    branch = np.where(m22 < 0, np.where(m00 > m11, 0, 1), np.where(m00 < -m11, 2, 3))
+    samples = np.arange(rot.shape[0])
+    return q[branch, samples] * (0.5 / np.sqrt(t[branch, samples]))[:, np.newaxis]
+
 def minimum_snap_trajectory_generator(traj_derivatives, yaw_derivatives, t_ref, quad_params, map_limits=None, plot=False, to_list=False):
     """
     Follows the Minimum Snap Trajectory paper to generate a full trajectory given the position reference and its
@@ -256,10 +295,9 @@ def minimum_snap_trajectory_generator(traj_derivatives, yaw_derivatives, t_ref,
 
     yawing = np.any(yaw_derivatives[0, :] != 0)
 
+    # Note: q_dot_q and quaternion_inverse act column-wise on 4xN arrays, so they are applied to all samples at once
     rate = np.zeros((len_traj, 3))
-    f_t = np.zeros((len_traj, 1))
-    for i in range(len_traj):
-        f_t[i, 0] = quad_mass * z_b[i].dot(thrust[i, :].T)
+    f_t = quad_mass * np.sum(z_b * thrust, 1)[:, np.newaxis]
 
     if yawing:
         # yaw is defined as the projection of the body-x axis on the horizontal plane
@@ -272,26 +310,17 @@ def minimum_snap_trajectory_generator(traj_derivatives, yaw_derivatives, t_ref,
 
         # Rotation matrix (from body to world)
         b_r_w = np.concatenate((x_b[:, :, np.newaxis], y_b[:, :, np.newaxis], z_b[:, :, np.newaxis]), -1)
-        q = []
-        for i in range(len_traj):
-            # Transform to quaternion
-            q.append(rotation_matrix_to_quat(b_r_w[i]))
-            if i > 1:
-                q[-1] = undo_quaternion_flip(q[-2], q[-1])
-        q = np.stack(q)
+        # Transform to quaternion
+        q = undo_quaternion_flips(rotation_matrix_to_quat_batch(b_r_w), start=2)
 
         # Compute angular rate vector
         # Total thrust acceleration must be equal to the projection of the quadrotor acceleration into the Z body axis
-        a_proj = np.zeros((len_traj, 1))
-
-        for i in range(len_traj):
-            a_proj[i, 0] = z_b[i].dot(traj_derivatives[3, :, i])
+        a_proj = np.sum(z_b * traj_derivatives[3, :, :].T, 1)[:, np.newaxis]
 
         h_omega = quad_mass / f_t * (traj_derivatives[3, :, :].T - a_proj * z_b)
-        for i in range(len_traj):
-            rate[i, 0] = -h_omega[i].dot(y_b[i])
-            rate[i, 1] = h_omega[i].dot(x_b[i])
-            rate[i, 2] = -yaw_derivatives[1, i] * np.array([0, 0, 1]).dot(z_b[i])
+        rate[:, 0] = -np.sum(h_omega * y_b, 1)
+        rate[:, 1] = np.sum(h_omega * x_b, 1)
+        rate[:, 2] = -yaw_derivatives[1, :] * z_b[:, 2]
 
     else:
         # new way to compute attitude:
@@ -304,9 +333,7 @@ def minimum_snap_trajectory_generator(traj_derivatives, yaw_derivatives, t_ref,
 
         # Use numerical differentiation of quaternions
         q_dot = np.gradient(q, axis=0) / discretization_dt
-        w_int = np.zeros((len_traj, 3))
-        for i in range(len_traj):
-            w_int[i, :] = 2.0 * q_dot_q(quaternion_inverse(q[i, :]), q_dot[i])[1:]
+        w_int = 2.0 * q_dot_q(quaternion_inverse(q.T), q_dot.T)[1:].T
         rate[:, 0] = w_int[:, 0]
         rate[:, 1] = w_int[:, 1]
         rate[:, 2] = w_int[:, 2]
@@ -314,18 +341,17 @@ def minimum_snap_trajectory_generator(traj_derivatives, yaw_derivatives, t_ref,
         go_crazy_about_yaw = True
         if go_crazy_about_yaw:
             print("Maximum yawrate before adaption: %.3f" % np.max(np.abs(rate[:, 2])))
-            q_new = q
-            yaw_corr_acc = 0.0
-            for i in range(1, len_traj):
-                yaw_corr = -rate[i, 2] * discretization_dt
-                yaw_corr_acc += yaw_corr
-                q_corr = np.array([np.cos(yaw_corr_acc / 2.0), 0.0, 0.0, np.sin(yaw_corr_acc / 2.0)])
-                q_new[i, :] = q_dot_q(q[i, :], q_corr)
-                w_int[i, :] = 2.0 * q_dot_q(quaternion_inverse(q[i, :]), q_dot[i])[1:]
-
+            # Rotate every sample but the first about z by the accumulated yaw rate correction
+            q_new = q.copy()
+            yaw_corr_acc = np.cumsum(-rate[1:, 2] * discretization_dt)
+            q_corr = np.zeros((4, len_traj - 1))
+            q_corr[0] = np.cos(yaw_corr_acc / 2.0)
+            q_corr[3] = np.sin(yaw_corr_acc / 2.0)
+            q_new[1:] = q_dot_q(q[1:].T, q_corr).T
+
+            # The first sample keeps the rate computed from the uncorrected quaternions
             q_new_dot = np.gradient(q_new, axis=0) / discretization_dt
-            for i in range(1, len_traj):
-                w_int[i, :] = 2.0 * q_dot_q(quaternion_inverse(q_new[i, :]), q_new_dot[i])[1:]
+            w_int[1:] = 2.0 * q_dot_q(quaternion_inverse(q_new[1:].T), q_new_dot[1:].T)[1:].T
 
             q = q_new
             rate[:, 0] = w_int[:, 0]
@@ -344,10 +370,7 @@ def minimum_snap_trajectory_generator(traj_derivatives, yaw_derivatives, t_ref,
     b = np.concatenate((f_t, tau), axis=-1)
     # a_mat = np.concatenate((quad.y_f[np.newaxis, :], -quad.x_f[np.newaxis, :],
     #                         quad.z_l_tau[np.newaxis, :], np.ones_like(quad.z_l_tau)[np.newaxis, :]), 0)
-    reference_u = np.zeros((len_traj, 4))
-    for i in range(len_traj):
-        reference_u[i, :] = np.matmul(TM_to_f, b[i, :])
-        # reference_u[i, :] = np.linalg.solve(a_mat, b[i, :])
+    reference_u = b @ TM_to_f.T
     # reference_u = b
 
     full_pos = traj_derivatives[0, :, :].T
@@ -0,0 +1,157 @@
+"""
+Cache of generated MPC reference trajectories.
+
+Sampling a trajectory and running minimum_snap_trajectory_generator is repeated by every QuadMPC construction,
+although the result only depends on the trajectory, t_final, the horizon, the number of nodes and the vehicle
+parameters. References are kept in a small in-memory LRU and as .npz files on disk (also evicted least recently used),
+so repeated runs over the same trajectories skip the generation entirely.
+"""
+import os
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+# Next to the repository root, like the compiled acados solvers.
+REFERENCE_CACHE_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'reference_cache'))
+
+# Bump when the reference generation changes, so that stale files are not reused.
+REFERENCE_VERSION = 1
+
+
+class UnhashableParameter(TypeError):
+    pass
+
+
+def _update_hash(h, value):
+    """
+    Feeds a canonical representation of value into the hash h. Raises UnhashableParameter for values without one
+    (e.g. callables), in which case the reference is not cached.
+    """
+    if isinstance(value, dict):
+        h.update(b'{')
+        for key in sorted(value, key=str):
+            h.update(str(key).encode())
+            _update_hash(h, value[key])
+        h.update(b'}')
+    elif isinstance(value, (list, tuple)):
+        h.update(b'[')
+        for item in value:
+            _update_hash(h, item)
+        h.update(b']')
+    elif isinstance(value, (np.ndarray, np.generic)):
+        if value.dtype == object:
+            raise UnhashableParameter(value.dtype)
+        value = np.ascontiguousarray(value)
+        h.update('{}{}'.format(value.dtype.str, value.shape).encode())
+        h.update(value.tobytes())
+    elif value is None or isinstance(value, (bool, int, float, str)):
+        h.update(repr(value).encode())
+    else:
+        raise UnhashableParameter(type(value).__name__)
+
+
+def reference_key(trajectory, t_final, t_horizon, n_nodes, quad_params):
+    """
+    Cache key of the reference generated for trajectory, or None if the trajectory has parameters that cannot be
+    hashed reliably.
+    """
+    h = hashlib.sha1()
+    try:
+        _update_hash(h, [REFERENCE_VERSION, type(trajectory).__module__, type(trajectory).__qualname__,
+                         vars(trajectory), t_final, t_horizon, n_nodes, quad_params])
+    except UnhashableParameter:
+        return None
+    return h.hexdigest()
+
+
+class ReferenceCache(object):
+    """
+    Two-level LRU cache of reference arrays. Entries are dicts of numpy arrays; they are shared between readers and
+    must not be modified.
+    """
+    def __init__(self, cache_dir=REFERENCE_CACHE_DIR, max_memory_entries=8, max_disk_entries=64):
+        """
+        Parameters:
+            cache_dir, directory of the .npz files, None to only cache in memory
+            max_memory_entries, number of references kept in memory
+            max_disk_entries, number of reference files kept in cache_dir
+        """
+        self.cache_dir = cache_dir
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.memory = OrderedDict()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def get(self, key):
+        """
+        Returns the arrays stored under key, or None.
+        """
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if self.cache_dir is None or not os.path.exists(self.path(key)):
+            return None
+        try:
+            with np.load(self.path(key)) as data:
+                arrays = {name: data[name] for name in data.files}
+            os.utime(self.path(key))  # mark as recently used for the disk eviction
+        except (OSError, ValueError):
+            # Removed by another process in the meantime or unreadable, regenerate it
+            return None
+        self._remember(key, arrays)
+        return arrays
+
+    def put(self, key, arrays):
+        """
+        Stores the dict of arrays under key in memory and on disk.
+        """
+        self._remember(key, arrays)
+        if self.cache_dir is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Write to a temporary file first so that concurrent readers never see a partial file
+        tmp_path = '{}.{}.tmp.npz'.format(self.path(key)[:-len('.npz')], os.getpid())
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, self.path(key))
+        self._evict_disk()
+
+    def clear(self):
+        """
+        Removes all cached references, in memory and on disk.
+        """
+        self.memory.clear()
+        if self.cache_dir is not None and os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                if name.endswith('.npz'):
+                    os.remove(os.path.join(self.cache_dir, name))
+
+    def _remember(self, key, arrays):
+        self.memory[key] = arrays
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def _evict_disk(self):
+        files = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)
+                 if name.endswith('.npz') and '.tmp.' not in name]
+        if len(files) <= self.max_disk_entries:
+            return
+        files.sort(key=_last_used)
+        for path in files[:len(files) - self.max_disk_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass  # already evicted by another process
+
+
+def _last_used(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0.0
+
+
+# Shared by all QuadMPC instances of a process.
+reference_cache = ReferenceCache()
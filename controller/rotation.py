@@ -0,0 +1,184 @@
+"""
+Lightweight quaternion/rotation matrix conversions.
+
+Drop-in replacements for the scipy Rotation round-trips done every control tick, e.g.
+Rotation.from_quat(q).as_matrix() -> quat_to_rotmat(q). Quaternions follow the scipy/rotorpy
+convention [i,j,k,w] and the results match scipy (including the sign of the quaternion returned by
+rotmat_to_quat). The scalar functions are compiled with numba when it is installed; their public
+wrappers convert the inputs to float arrays first, so lists and integer arrays are accepted like
+scipy does. The *_batch versions act on stacks of shape (N,4) and (N,3,3): with numba they loop over
+the compiled scalar code, otherwise they are vectorized with NumPy.
+"""
+import numpy as np
+from controller.math import HAS_NUMBA, jit
+
+
+@jit
+def _quat_to_rotmat_into(q, R):
+    """Writes the rotation matrix of the quaternion q = [i,j,k,w] into R (q is normalized first, as scipy does)."""
+    n = np.sqrt(q[0] * q[0] + q[1] * q[1] + q[2] * q[2] + q[3] * q[3])
+    x = q[0] / n
+    y = q[1] / n
+    z = q[2] / n
+    w = q[3] / n
+    R[0, 0] = 1.0 - 2.0 * (y * y + z * z)
+    R[0, 1] = 2.0 * (x * y - z * w)
+    R[0, 2] = 2.0 * (x * z + y * w)
+    R[1, 0] = 2.0 * (x * y + z * w)
+    R[1, 1] = 1.0 - 2.0 * (x * x + z * z)
+    R[1, 2] = 2.0 * (y * z - x * w)
+    R[2, 0] = 2.0 * (x * z - y * w)
+    R[2, 1] = 2.0 * (y * z + x * w)
+    R[2, 2] = 1.0 - 2.0 * (x * x + y * y)
+
+@jit
+def _rotmat_to_quat_into(R, q):
+    """Writes the quaternion [i,j,k,w] of the rotation matrix R into q (Shepperd's method, same branch choice as scipy)."""
+    trace = R[0, 0] + R[1, 1] + R[2, 2]
+    i = 0
+    if R[1, 1] > R[i, i]:
+        i = 1
+    if R[2, 2] > R[i, i]:
+        i = 2
+    if trace > R[i, i]:
+        q[0] = R[2, 1] - R[1, 2]
+        q[1] = R[0, 2] - R[2, 0]
+        q[2] = R[1, 0] - R[0, 1]
+        q[3] = 1.0 + trace
+    else:
+        j = (i + 1) % 3
+        k = (j + 1) % 3
+        q[i] = 1.0 - trace + 2.0 * R[i, i]
+        q[j] = R[j, i] + R[i, j]
+        q[k] = R[k, i] + R[i, k]
+        q[3] = R[k, j] - R[j, k]
+    n = np.sqrt(q[0] * q[0] + q[1] * q[1] + q[2] * q[2] + q[3] * q[3])
+    for l in range(4):
+        q[l] /= n
+
+@jit
+def _quat_to_rotmat(q):
+    R = np.empty((3, 3))
+    _quat_to_rotmat_into(q, R)
+    return R
+
+@jit
+def _rotmat_to_quat(R):
+    q = np.empty(4)
+    _rotmat_to_quat_into(R, q)
+    return q
+
+@jit
+def _quat_multiply(p, q):
+    out = np.empty(4)
+    out[0] = p[3] * q[0] + p[0] * q[3] + p[1] * q[2] - p[2] * q[1]
+    out[1] = p[3] * q[1] - p[0] * q[2] + p[1] * q[3] + p[2] * q[0]
+    out[2] = p[3] * q[2] + p[0] * q[1] - p[1] * q[0] + p[2] * q[3]
+    out[3] = p[3] * q[3] - p[0] * q[0] - p[1] * q[1] - p[2] * q[2]
+    return out
+
+@jit
+def _quat_inverse(q):
+    out = np.empty(4)
+    out[0] = -q[0]
+    out[1] = -q[1]
+    out[2] = -q[2]
+    out[3] = q[3]
+    return out
+
+def quat_to_rotmat(q):
+    """Rotation matrix of the quaternion q = [i,j,k,w]."""
+    return _quat_to_rotmat(np.asarray(q, dtype=float))
+
+def rotmat_to_quat(R):
+    """Quaternion [i,j,k,w] of the rotation matrix R."""
+    return _rotmat_to_quat(np.asarray(R, dtype=float))
+
+def quat_multiply(p, q):
+    """Hamilton product p*q of two quaternions [i,j,k,w] (the rotation q followed by p)."""
+    return _quat_multiply(np.asarray(p, dtype=float), np.asarray(q, dtype=float))
+
+def quat_inverse(q):
+    """Inverse of a unit quaternion [i,j,k,w] (its conjugate)."""
+    return _quat_inverse(np.asarray(q, dtype=float))
+
+
+@jit
+def _quat_to_rotmat_loop(q):
+    R = np.empty((q.shape[0], 3, 3))
+    for n in range(q.shape[0]):
+        _quat_to_rotmat_into(q[n], R[n])
+    return R
+
+@jit
+def _rotmat_to_quat_loop(R):
+    q = np.empty((R.shape[0], 4))
+    for n in range(R.shape[0]):
+        _rotmat_to_quat_into(R[n], q[n])
+    return q
+
+def quat_to_rotmat_batch(q):
+    """Rotation matrices (N,3,3) of the quaternions q (N,4)."""
+    q = np.asarray(q, dtype=float)
+    if HAS_NUMBA:
+        return _quat_to_rotmat_loop(q)
+    q = q / np.linalg.norm(q, axis=1, keepdims=True)
+    x, y, z, w = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    R = np.empty((q.shape[0], 3, 3))
+    R[:, 0, 0] = 1.0 - 2.0 * (y * y + z * z)
+    R[:, 0, 1] = 2.0 * (x * y - z * w)
+    R[:, 0, 2] = 2.0 * (x * z + y * w)
+    R[:, 1, 0] = 2.0 * (x * y + z * w)
+    R[:, 1, 1] = 1.0 - 2.0 * (x * x + z * z)
+    R[:, 1, 2] = 2.0 * (y * z - x * w)
+    R[:, 2, 0] = 2.0 * (x * z - y * w)
+    R[:, 2, 1] = 2.0 * (y * z + x * w)
+    R[:, 2, 2] = 1.0 - 2.0 * (x * x + y * y)
+    return R
+
+def rotmat_to_quat_batch(R):
+    """Quaternions (N,4) of the rotation matrices R (N,3,3)."""
+    R = np.asarray(R, dtype=float)
+    if HAS_NUMBA:
+        return _rotmat_to_quat_loop(R)
+    N = R.shape[0]
+    rows = np.arange(N)
+    decision = np.empty((N, 4))
+    decision[:, :3] = np.diagonal(R, axis1=1, axis2=2)
+    decision[:, 3] = decision[:, :3].sum(axis=1)
+    choice = decision.argmax(axis=1)
+
+    q = np.empty((N, 4))
+    ind = choice == 3
+    if np.any(ind):
+        Ri = R[ind]
+        q[ind, 0] = Ri[:, 2, 1] - Ri[:, 1, 2]
+        q[ind, 1] = Ri[:, 0, 2] - Ri[:, 2, 0]
+        q[ind, 2] = Ri[:, 1, 0] - Ri[:, 0, 1]
+        q[ind, 3] = 1.0 + decision[ind, 3]
+    ind = ~ind
+    if np.any(ind):
+        i = choice[ind]
+        j = (i + 1) % 3
+        k = (j + 1) % 3
+        r = rows[ind]
+        q[r, i] = 1.0 - decision[r, 3] + 2.0 * R[r, i, i]
+        q[r, j] = R[r, j, i] + R[r, i, j]
+        q[r, k] = R[r, k, i] + R[r, i, k]
+        q[r, 3] = R[r, k, j] - R[r, j, k]
+    return q / np.linalg.norm(q, axis=1, keepdims=True)
+
+def quat_multiply_batch(p, q):
+    """Hamilton products p*q of the quaternions p, q (N,4)."""
+    out = np.empty(np.broadcast(p, q).shape)
+    out[:, 0] = p[:, 3] * q[:, 0] + p[:, 0] * q[:, 3] + p[:, 1] * q[:, 2] - p[:, 2] * q[:, 1]
+    out[:, 1] = p[:, 3] * q[:, 1] - p[:, 0] * q[:, 2] + p[:, 1] * q[:, 3] + p[:, 2] * q[:, 0]
+    out[:, 2] = p[:, 3] * q[:, 2] + p[:, 0] * q[:, 1] - p[:, 1] * q[:, 0] + p[:, 2] * q[:, 3]
+    out[:, 3] = p[:, 3] * q[:, 3] - p[:, 0] * q[:, 0] - p[:, 1] * q[:, 1] - p[:, 2] * q[:, 2]
+    return out
+
+def quat_inverse_batch(q):
+    """Inverses (conjugates) of the unit quaternions q (N,4)."""
+    out = q * -1.0
+    out[:, 3] = q[:, 3]
+    return out
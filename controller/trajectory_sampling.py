@@ -0,0 +1,160 @@
+"""
+Batched evaluation of rotorpy trajectories.
+
+rotorpy trajectories are evaluated one time instant at a time, each call returning a new dict of small arrays.
+sample_trajectory evaluates a trajectory over a whole time vector at once and returns a struct-of-arrays with the same
+keys as trajectory.update, vector quantities of shape (N, 3) and scalar ones of shape (N,) (the layout of
+rotorpy.simulate.merge_dicts). CircularTraj, ThreeDCircularTraj, TwoDLissajous and HoverTraj are evaluated with
+vectorized closed forms that reproduce their update() expressions term by term; any other trajectory falls back to
+calling update() per sample.
+"""
+import numpy as np
+from rotorpy.trajectories.circular_traj import CircularTraj, ThreeDCircularTraj
+from rotorpy.trajectories.lissajous_traj import TwoDLissajous
+from rotorpy.trajectories.hover_traj import HoverTraj
+
+# Keys of a flat output, in the order of trajectory.update
+FLAT_OUTPUT_KEYS = ('x', 'x_dot', 'x_ddot', 'x_dddot', 'x_ddddot', 'yaw', 'yaw_dot', 'yaw_ddot')
+
+
+def _constant(value, n):
+    return np.full(n, value, dtype=float)
+
+
+def _sample_circular(traj, t):
+    n = t.shape[0]
+    r, s, w = traj.radius, traj.sign, traj.omega
+    phase = s*w*t
+    cos, sin = np.cos(phase), np.sin(phase)
+    # Per derivative order: the two in-plane components, as written in CircularTraj.update
+    in_plane = [(-r*s*w*sin,         r*s*w*cos),
+                (-r*((s*w)**2)*cos,  -r*((s*w)**2)*sin),
+                (r*((s*w)**3)*sin,   -r*((s*w)**3)*cos),
+                (r*((s*w)**4)*cos,   r*((s*w)**4)*sin)]
+    if traj.plane == 'XY':
+        axes, normal, offsets = (0, 1), 2, (traj.cx, traj.cy, traj.cz)
+    elif traj.plane == 'YZ':
+        axes, normal, offsets = (1, 2), 0, (traj.cy, traj.cz, traj.cx)
+    else:
+        axes, normal, offsets = (0, 2), 1, (traj.cx, traj.cz, traj.cy)
+        # CircularTraj.update drops the direction sign in the x jerk of the XZ circle
+        in_plane[2] = (r*((s*w)**3)*np.sin(w*t), in_plane[2][1])
+
+    flat = {}
+    x = np.empty((n, 3))
+    x[:, axes[0]] = offsets[0] + r*cos
+    x[:, axes[1]] = offsets[1] + r*sin
+    x[:, normal] = offsets[2]
+    flat['x'] = x
+    for key, (first, second) in zip(FLAT_OUTPUT_KEYS[1:5], in_plane):
+        derivative = np.zeros((n, 3))
+        derivative[:, axes[0]] = first
+        derivative[:, axes[1]] = second
+        flat[key] = derivative
+
+    if traj.yaw_bool:
+        flat['yaw'] = np.pi/4*np.sin(np.pi*t)
+        flat['yaw_dot'] = np.pi*np.pi/4*np.cos(np.pi*t)
+        flat['yaw_ddot'] = -np.pi*np.pi*np.pi/4*np.sin(np.pi*t)
+    else:
+        flat['yaw'], flat['yaw_dot'], flat['yaw_ddot'] = _constant(0, n), _constant(0, n), _constant(0, n)
+    return flat
+
+
+def _sample_three_d_circular(traj, t):
+    n = t.shape[0]
+    r, w = np.asarray(traj.radius), np.asarray(traj.omega)
+    phase = w*t[:, np.newaxis]
+    cos, sin = np.cos(phase), np.sin(phase)
+    center = np.array([traj.cx, traj.cy, traj.cz])
+    # The x axis follows a cosine, y and z a sine
+    x = center + r*np.where([True, False, False], cos, sin)
+    x_dot = r*w*np.where([True, False, False], -sin, cos)
+    x_ddot = -r*(w**2)*np.where([True, False, False], cos, sin)
+    x_dddot = r*(w**3)*np.where([True, False, False], sin, -cos)
+    x_dddot[:, 2] = -x_dddot[:, 2]
+    x_ddddot = r*(w**4)*np.where([True, False, False], cos, sin)
+
+    flat = {'x': x, 'x_dot': x_dot, 'x_ddot': x_ddot, 'x_dddot': x_dddot, 'x_ddddot': x_ddddot}
+    # ThreeDCircularTraj has no yaw_ddot
+    if traj.yaw_bool:
+        flat['yaw'] = 0.8*np.pi/2*np.sin(2.5*t)
+        flat['yaw_dot'] = 0.8*2.5*np.pi/2*np.cos(2.5*t)
+    else:
+        flat['yaw'], flat['yaw_dot'] = _constant(0, n), _constant(0, n)
+    return flat
+
+
+def _sample_lissajous(traj, t):
+    n = t.shape[0]
+    a, b, A, B = traj.a, traj.b, traj.A, traj.B
+    sin_x, cos_x = np.sin(a*t + traj.delta), np.cos(a*t + traj.delta)
+    sin_y, cos_y = np.sin(b*t), np.cos(b*t)
+
+    def stack(x, y, z):
+        out = np.empty((n, 3))
+        out[:, 0], out[:, 1], out[:, 2] = x, y, z
+        return out
+
+    flat = {'x': stack(traj.x_offset + A*sin_x, traj.y_offset + B*sin_y, traj.height),
+            'x_dot': stack(a*A*cos_x, b*B*cos_y, 0),
+            'x_ddot': stack(-(a)**2*A*sin_x, -(b)**2*B*sin_y, 0),
+            'x_dddot': stack(-(a)**3*A*cos_x, -(b)**3*B*cos_y, 0),
+            'x_ddddot': stack((a)**4*A*sin_x, (b)**4*B*sin_y, 0)}
+    if traj.yaw_bool:
+        flat['yaw'] = np.pi/4*np.sin(np.pi*t)
+        flat['yaw_dot'] = np.pi*np.pi/4*np.cos(np.pi*t)
+        flat['yaw_ddot'] = np.pi*np.pi*np.pi/4*np.cos(np.pi*t)  # as in TwoDLissajous.update
+    else:
+        flat['yaw'], flat['yaw_dot'], flat['yaw_ddot'] = _constant(0, n), _constant(0, n), _constant(0, n)
+    return flat
+
+
+def _sample_hover(traj, t):
+    n = t.shape[0]
+    flat = {'x': np.tile(np.asarray(traj.x0, dtype=float), (n, 1))}
+    for key in FLAT_OUTPUT_KEYS[1:5]:
+        flat[key] = np.zeros((n, 3))
+    flat['yaw'], flat['yaw_dot'], flat['yaw_ddot'] = _constant(0, n), _constant(0, n), _constant(0, n)
+    return flat
+
+
+# Closed forms by exact trajectory class; subclasses may override update() and use the loop.
+CLOSED_FORM_SAMPLERS = {CircularTraj: _sample_circular,
+                        ThreeDCircularTraj: _sample_three_d_circular,
+                        TwoDLissajous: _sample_lissajous,
+                        HoverTraj: _sample_hover}
+
+
+def sample_trajectory_loop(trajectory, t):
+    """
+    Evaluates trajectory.update at every time of t and stacks the flat outputs.
+    """
+    t = np.asarray(t, dtype=float)
+    flats = [trajectory.update(ti) for ti in t]
+    return {key: np.array([flat[key] for flat in flats], dtype=float) for key in flats[0]}
+
+
+def sample_trajectory(trajectory, t):
+    """
+    Evaluates trajectory at all times of the 1D array t.
+
+    Returns a dict with the keys of trajectory.update, vector quantities of shape (N, 3) and scalar ones of shape (N,).
+    """
+    t = np.asarray(t, dtype=float)
+    sampler = CLOSED_FORM_SAMPLERS.get(type(trajectory))
+    if sampler is None:
+        return sample_trajectory_loop(trajectory, t)
+    return sampler(trajectory, t)
+
+
+def flat_output_at(samples, index, flat_output=None):
+    """
+    Fills the dict flat_output (a new one if None) with the flat output of sample index, as returned by
+    trajectory.update. The values are views into samples, so reusing the same dict avoids per-step allocations.
+    """
+    if flat_output is None:
+        flat_output = {}
+    for key, values in samples.items():
+        flat_output[key] = values[index]
+    return flat_output
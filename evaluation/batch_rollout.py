@@ -0,0 +1,293 @@
+"""
+Lockstep rollout of a swarm of vehicles in one process.
+
+Instead of simulating each vehicle in its own process with Multirotor.step (a scipy solve_ivp call on a 20-dim state
+per step), BatchMultirotor integrates the states of all N vehicles at once, stacked as an (N, 16+num_rotors) array in
+the layout of Multirotor._pack_state, with a fixed-step RK4 of the vectorized rotorpy dynamics. batch_rollout advances
+the whole swarm tick by tick, calls the controller's update_batch once per tick and records into preallocated
+(T, N, ...) buffers, the layout of run_eval's all_pos arrays. For large swarms batch_rollout_sharded splits the
+vehicles into one batch per process.
+"""
+import multiprocessing
+import os
+import numpy as np
+from rotorpy.vehicles.multirotor import Multirotor
+from controller.rotation import quat_to_rotmat_batch
+from controller.trajectory_sampling import sample_trajectory, flat_output_at
+from evaluation.recorder import RolloutRecorder
+from evaluation.storage import RolloutWriter
+from evaluation.rollout import simulation_times, rollout_summary
+from evaluation.profiling import PhaseTimer
+
+# Columns of the packed state, see Multirotor._pack_state
+STATE_SLICES = {'x': slice(0, 3), 'v': slice(3, 6), 'q': slice(6, 10), 'w': slice(10, 13), 'wind': slice(13, 16)}
+
+
+def _cross(a, b):
+    """
+    Cross products of the vectors along the last axis of a and b (broadcast), cheaper than np.cross on small arrays.
+    """
+    out = np.empty(np.broadcast(a, b).shape)
+    out[..., 0] = a[..., 1]*b[..., 2] - a[..., 2]*b[..., 1]
+    out[..., 1] = a[..., 2]*b[..., 0] - a[..., 0]*b[..., 2]
+    out[..., 2] = a[..., 0]*b[..., 1] - a[..., 1]*b[..., 0]
+    return out
+
+
+class BatchMultirotor(Multirotor):
+    """
+    Multirotor whose dynamics are evaluated for a batch of vehicles sharing the same parameters. The single-vehicle
+    interface (step, statedot) is inherited unchanged.
+    """
+    def __init__(self, quad_params, control_abstraction='cmd_motor_speeds', aero=True):
+        if control_abstraction not in ('cmd_motor_speeds', 'cmd_motor_thrusts'):
+            raise ValueError("BatchMultirotor only supports the 'cmd_motor_speeds' and 'cmd_motor_thrusts' "
+                             "abstractions, got '{}'".format(control_abstraction))
+        super().__init__(quad_params, control_abstraction=control_abstraction, aero=aero)
+        self.rotor_dir = np.asarray(self.rotor_dir, dtype=float)
+        # The drag matrices are diagonal
+        self.drag_coeffs = np.diag(self.drag_matrix)
+        self.rotor_drag_coeffs = np.diag(self.rotor_drag_matrix)
+
+    @staticmethod
+    def pack_states(states):
+        """
+        Stacks a list of state dicts into an (N, 16+num_rotors) array.
+        """
+        return np.stack([Multirotor._pack_state(state) for state in states])
+
+    @staticmethod
+    def unpack_states(s):
+        """
+        State dict of the (N, 16+num_rotors) array s, each value being an (N, ...) view of s.
+        """
+        states = {key: s[:, columns] for key, columns in STATE_SLICES.items()}
+        states['rotor_speeds'] = s[:, 16:]
+        return states
+
+    def get_cmd_motor_speeds_batch(self, control):
+        if self.control_abstraction == 'cmd_motor_speeds':
+            return control['cmd_motor_speeds']
+        cmd_motor_speeds = control['cmd_motor_thrusts'] / self.k_eta
+        return np.sign(cmd_motor_speeds) * np.sqrt(np.abs(cmd_motor_speeds))
+
+    def compute_body_wrench_batch(self, body_rates, rotor_speeds, body_airspeed_vector):
+        """
+        Batched compute_body_wrench: body_rates and body_airspeed_vector are (N,3), rotor_speeds (N,num_rotors).
+        Returns the body frame force and moment, both (N,3).
+        """
+        N = rotor_speeds.shape[0]
+        thrust = self.k_eta*rotor_speeds**2                                                 # (N,rotors)
+        forces = np.zeros((N, self.num_rotors, 3))                                          # T (+H) per rotor
+        forces[:, :, 2] = thrust
+        moments = np.zeros((N, self.num_rotors, 3))                                         # M_yaw (+M_flap) per rotor
+        moments[:, :, 2] = self.rotor_dir*self.k_m*rotor_speeds**2
+        FtotB = np.zeros((N, 3))
+
+        if self.aero:
+            # Local airspeed of each rotor, (N,rotors,3)
+            local_airspeeds = body_airspeed_vector[:, np.newaxis, :] + _cross(body_rates[:, np.newaxis, :],
+                                                                              self.rotor_geometry)
+            # Parasitic drag force acting at the CoM
+            FtotB -= np.linalg.norm(body_airspeed_vector, axis=1)[:, np.newaxis]*self.drag_coeffs*body_airspeed_vector
+            # Rotor drag (aka H force) acting at each propeller hub.
+            forces -= rotor_speeds[:, :, np.newaxis]*self.rotor_drag_coeffs*local_airspeeds
+            # Pitching flapping moment acting at each propeller hub: -k_flap*speed*(local_airspeed x e3)
+            flap = self.k_flap*rotor_speeds
+            moments[:, :, 0] -= flap*local_airspeeds[:, :, 1]
+            moments[:, :, 1] += flap*local_airspeeds[:, :, 0]
+
+        # Moments of the rotor forces about the CoM
+        M_force = _cross(self.rotor_geometry, forces).sum(axis=1)
+        FtotB += forces.sum(axis=1)
+        MtotB = M_force + moments.sum(axis=1)
+        return FtotB, MtotB
+
+    def s_dot_batch(self, s, cmd_rotor_speeds):
+        """
+        Batched _s_dot_fn: time derivative of the packed states s (N, 16+num_rotors) for fixed commands.
+        """
+        v = s[:, 3:6]
+        q = s[:, 6:10]
+        w = s[:, 10:13]
+        rotor_speeds = s[:, 16:]
+        R = quat_to_rotmat_batch(q)
+
+        s_dot = np.zeros_like(s)
+        s_dot[:, 0:3] = v
+
+        # Orientation derivative, as rotorpy's quat_dot: 0.5*G^T w, pulled back towards the unit sphere
+        qx, qy, qz, qw = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+        wx, wy, wz = w[:, 0], w[:, 1], w[:, 2]
+        q_dot = s_dot[:, 6:10]
+        q_dot[:, 0] = 0.5*(qw*wx - qz*wy + qy*wz)
+        q_dot[:, 1] = 0.5*(qz*wx + qw*wy - qx*wz)
+        q_dot[:, 2] = 0.5*(-qy*wx + qx*wy + qw*wz)
+        q_dot[:, 3] = 0.5*(-qx*wx - qy*wy - qz*wz)
+        q_dot -= 2*(np.sum(q**2, axis=1) - 1)[:, np.newaxis]*q
+
+        # Airspeed in the body frame, R^T (v - wind)
+        body_airspeed_vector = np.einsum('nji,nj->ni', R, v - s[:, 13:16])
+        FtotB, MtotB = self.compute_body_wrench_batch(w, rotor_speeds, body_airspeed_vector)
+
+        s_dot[:, 3:6] = (self.weight + np.einsum('nij,nj->ni', R, FtotB)) / self.mass
+        s_dot[:, 10:13] = (MtotB - _cross(w, w @ self.inertia.T)) @ self.inv_inertia.T
+        s_dot[:, 16:] = (cmd_rotor_speeds - rotor_speeds) / self.tau_m
+        return s_dot
+
+    def step_batch(self, s, control, t_step):
+        """
+        Integrates the packed states s (N, 16+num_rotors) over t_step with the batched controls held constant, using
+        one RK4 step for the rigid body and the exact solution of the first-order motor lag. Returns the new packed states, with normalized quaternions and motor noise added.
+        """
+        cmd_rotor_speeds = np.clip(self.get_cmd_motor_speeds_batch(control), self.rotor_speed_min, self.rotor_speed_max)
+
+        # The motor lag is linear with a constant command, so the rotor speeds are integrated exactly and set at the
+        # stage times; this keeps the fast motor mode (tau_m is shorter than typical steps) accurate and stable.
+        rotor_lag = s[:, 16:] - cmd_rotor_speeds
+        rotor_speeds_mid = cmd_rotor_speeds + rotor_lag*np.exp(-0.5*t_step/self.tau_m)
+        rotor_speeds_end = cmd_rotor_speeds + rotor_lag*np.exp(-t_step/self.tau_m)
+
+        k1 = self.s_dot_batch(s, cmd_rotor_speeds)
+        stage = s + 0.5*t_step*k1
+        stage[:, 16:] = rotor_speeds_mid
+        k2 = self.s_dot_batch(stage, cmd_rotor_speeds)
+        stage = s + 0.5*t_step*k2
+        stage[:, 16:] = rotor_speeds_mid
+        k3 = self.s_dot_batch(stage, cmd_rotor_speeds)
+        stage = s + t_step*k3
+        stage[:, 16:] = rotor_speeds_end
+        k4 = self.s_dot_batch(stage, cmd_rotor_speeds)
+        s = s + t_step/6*(k1 + 2*k2 + 2*k3 + k4)
+        s[:, 16:] = rotor_speeds_end
+
+        # Re-normalize unit quaternion.
+        s[:, 6:10] /= np.linalg.norm(s[:, 6:10], axis=1, keepdims=True)
+
+        # Add noise to the motor speed measurement
+        s[:, 16:] += np.random.normal(scale=np.abs(self.motor_noise), size=(s.shape[0], self.num_rotors))
+        return s
+
+
+def sample_trajectories(trajectories, t_offsets, time):
+    """
+    Flat outputs of all trajectories at time + their offset, stacked along the vehicle axis: (T, N, 3) for vectors
+    and (T, N) for scalars. Only the keys shared by all trajectories are kept.
+    """
+    samples = [sample_trajectory(trajectory, time + t_offset) for trajectory, t_offset in zip(trajectories, t_offsets)]
+    keys = [key for key in samples[0] if all(key in sample for sample in samples)]
+    return {key: np.stack([sample[key] for sample in samples], axis=1) for key in keys}
+
+
+def batch_rollout(vehicle, controller, trajectories, t_offsets=None, t_final=10, t_step=1/100, decimation=1,
+                  output_dir=None, wind_profiles=None, timer=None):
+    """
+    Simulates N vehicles in lockstep, vehicle i tracking trajectories[i] with the same batched controller.
+    Inputs:
+        vehicle: a BatchMultirotor.
+        controller: any controller with update_batch(t, states, flat_outputs), e.g. GeoControl or L1_GeoControl.
+        trajectories: list of the N trajectory objects.
+        t_offsets: time offset of each trajectory, default 0.
+        t_final: duration of the sim.
+        t_step: timestep for the simulation.
+        decimation: only every decimation-th step is recorded.
+        output_dir: if given, the rollout is streamed to this directory (see evaluation/storage.py) instead of returned.
+        wind_profiles: optional list of N rotorpy wind profiles, evaluated before every step.
+        timer: optional evaluation.profiling.PhaseTimer, timing the phases of the loop for the whole swarm.
+    Outputs:
+        time, states, controls, flats as struct-of-arrays with a vehicle axis, e.g. states['x'] of shape (T, N, 3),
+    or, with output_dir:
+        output_dir: the rollout directory, to be read with evaluation.storage.load_rollout.
+        summary: dict of summary metrics over all vehicles (see evaluation.rollout.rollout_summary).
+    """
+    N = len(trajectories)
+    if t_offsets is None:
+        t_offsets = np.zeros(N)
+    if timer is None:
+        timer = PhaseTimer(enabled=False)
+    time = simulation_times(t_final, t_step)
+    with timer.phase('trajectory'):
+        flats = sample_trajectories(trajectories, t_offsets, time)
+        flat = flat_output_at(flats, 0)
+
+    # Init the mavs at the first waypoint of their trajectory, hovering like rollout() does.
+    s = np.zeros((N, 16 + vehicle.num_rotors))
+    s[:, 0:3] = flats['x'][0]
+    s[:, 9] = 1  # q = [0, 0, 0, 1]
+    s[:, 16:] = 1788.53
+    if wind_profiles is not None:
+        s[:, 13:16] = [wind.update(time[0], s[j, 0:3]) for j, wind in enumerate(wind_profiles)]
+
+    if output_dir is None:
+        recorder = RolloutRecorder(len(time), decimation)
+    else:
+        recorder = RolloutWriter(output_dir, len(time), decimation)
+    with timer.phase('controller'):
+        control = controller.update_batch(time[0], s[:, :13], flat)
+    with timer.phase('logging'):
+        recorder.record(0, time[0], states=vehicle.unpack_states(s), controls=control)
+
+    for i in range(1, len(time)):
+        if wind_profiles is not None:
+            with timer.phase('wind'):
+                s[:, 13:16] = [wind.update(time[i], s[j, 0:3]) for j, wind in enumerate(wind_profiles)]
+        with timer.phase('vehicle'):
+            s = vehicle.step_batch(s, control, t_step)
+        with timer.phase('trajectory'):
+            flat_output_at(flats, i, flat)
+        with timer.phase('controller'):
+            control = controller.update_batch(time[i], s[:, :13], flat)
+        with timer.phase('logging'):
+            recorder.record(i, time[i], states=vehicle.unpack_states(s), controls=control)
+
+    time, logs = recorder.arrays()
+    flats = {key: values[::decimation] for key, values in flats.items()}
+
+    if output_dir is not None:
+        recorder.write_group('flats', flats)
+        summary = rollout_summary(time, logs['states'], flats)
+        return recorder.close(num_vehicles=N, **summary), summary
+
+    return time, logs['states'], logs['controls'], flats
+
+
+def _run_shard(args):
+    """
+    Rolls out one shard of vehicles in a worker process.
+    """
+    quad_params, controller_factory, trajectories, t_offsets, t_final, t_step, decimation, seed = args
+    if seed is not None:
+        np.random.seed(seed)
+    return batch_rollout(BatchMultirotor(quad_params), controller_factory(quad_params), trajectories, t_offsets,
+                         t_final, t_step, decimation)
+
+
+def batch_rollout_sharded(quad_params, controller_factory, trajectories, t_offsets=None, t_final=10, t_step=1/100,
+                          decimation=1, processes=None, seed=None):
+    """
+    batch_rollout of a large swarm split into one contiguous shard of vehicles per process, each shard running in
+    lockstep with its own vehicle and controller (built with controller_factory(quad_params)). The results are
+    concatenated along the vehicle axis, so they have the same layout as a single batch_rollout.
+
+    Parameters:
+        processes, number of shards and worker processes (default: number of CPUs); 1 runs in this process
+        seed, if given, shard k seeds np.random (motor noise) with seed + k
+    """
+    N = len(trajectories)
+    if t_offsets is None:
+        t_offsets = np.zeros(N)
+    processes = max(1, min(processes or os.cpu_count(), N))
+    bounds = np.linspace(0, N, processes + 1).astype(int)
+    shards = [(quad_params, controller_factory, trajectories[a:b], t_offsets[a:b], t_final, t_step, decimation,
+               None if seed is None else seed + k) for k, (a, b) in enumerate(zip(bounds[:-1], bounds[1:]))]
+
+    if processes == 1:
+        results = [_run_shard(shards[0])]
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.map(_run_shard, shards)
+
+    time = results[0][0]
+    states, controls, flats = [{key: np.concatenate([result[k][key] for result in results], axis=1)
+                                for key in results[0][k]} for k in (1, 2, 3)]
+    return time, states, controls, flats
@@ -0,0 +1,91 @@
+"""
+Pairwise collision detection for swarms.
+
+Small swarms compare every pair of agents with vectorized distances over chunks of timesteps. Large swarms build one
+cKDTree per timestep instead, which only visits nearby agents (per-timestep trees were faster here than a single tree
+over a chunk with time as a fourth coordinate).
+"""
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Swarms of at least this many agents use the KD-tree
+KDTREE_MIN_AGENTS = 64
+
+# Upper bound on the number of (timestep, pair) distances computed per chunk by the dense check
+CHUNK_SIZE = 1 << 16
+
+
+def _dense_pairs(positions, epsilon):
+    N, M, _ = positions.shape
+    first, second = np.triu_indices(M, 1)
+    chunk = max(1, CHUNK_SIZE // max(len(first), 1))
+    found = []
+    for start in range(0, N, chunk):
+        pos = positions[start:start + chunk]
+        dist_sq = np.zeros((pos.shape[0], len(first)))
+        for axis in range(3):
+            dist_sq += (pos[:, first, axis] - pos[:, second, axis])**2
+        t, pair = np.nonzero(dist_sq < epsilon**2)
+        found.append((t + start, first[pair], second[pair]))
+    return found
+
+
+def _kdtree_pairs(positions, epsilon):
+    found = []
+    for t, pos in enumerate(positions):
+        pairs = cKDTree(pos).query_pairs(epsilon, output_type='ndarray')
+        if len(pairs) == 0:
+            continue
+        # query_pairs includes the boundary, the dense check does not
+        pairs = pairs[np.sum((pos[pairs[:, 0]] - pos[pairs[:, 1]])**2, axis=-1) < epsilon**2]
+        found.append((np.full(len(pairs), t), pairs[:, 0], pairs[:, 1]))
+    return found
+
+
+def collision_events(all_positions, epsilon=1e-1, first_contact_only=False, method='auto'):
+    """
+    Finds the pairs of agents closer than epsilon.
+    Inputs:
+        all_positions: positions of shape (N timesteps, M agents, 3).
+        epsilon: the distance threshold constituting a collision.
+        first_contact_only: only report the first timestep of each colliding pair.
+        method: 'dense', 'kdtree' or 'auto' (KD-tree from KDTREE_MIN_AGENTS agents on).
+    Outputs:
+        timesteps, agents_i, agents_j: integer arrays, sorted by timestep then agents, with agents_i < agents_j.
+    """
+    positions = np.asarray(all_positions, dtype=float)
+    if method == 'auto':
+        method = 'kdtree' if positions.shape[1] >= KDTREE_MIN_AGENTS else 'dense'
+    if method == 'dense':
+        found = _dense_pairs(positions, epsilon)
+    elif method == 'kdtree':
+        found = _kdtree_pairs(positions, epsilon)
+    else:
+        raise ValueError("Unknown collision detection method '{}'".format(method))
+
+    if not found:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    t, i, j = (np.concatenate(values).astype(int) for values in zip(*found))
+    order = np.lexsort((j, i, t))
+    t, i, j = t[order], i[order], j[order]
+    if first_contact_only:
+        _, first = np.unique(i * positions.shape[1] + j, return_index=True)
+        first.sort()
+        t, i, j = t[first], i[first], j[first]
+    return t, i, j
+
+
+def find_collisions(all_positions, epsilon=1e-1, first_contact_only=False, method='auto'):
+    """
+    Checks if any two agents get within epsilon meters of any other agent. 
+    Inputs:
+        all_positions: the position vs time for each agent concatenated into one array. 
+        epsilon: the distance threshold constituting a collision. 
+        first_contact_only: only report the first timestep of each colliding pair. 
+        method: 'dense', 'kdtree' or 'auto', see collision_events. 
+    Outputs:
+        collisions: a list of dictionaries where each dict describes the time of a collision, agents involved, and the location. 
+    """
+    t, i, j = collision_events(all_positions, epsilon, first_contact_only, method)
+    return [{"timestep": ti, "agents": (ii, ji), "location": all_positions[ti, ii]}
+            for ti, ii, ji in zip(t.tolist(), i.tolist(), j.tolist())]
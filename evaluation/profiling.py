@@ -0,0 +1,138 @@
+"""
+Per-phase timing of simulation loops.
+
+A PhaseTimer records, per named phase (e.g. trajectory, controller, vehicle, logging), the wall time of every call,
+from which it reports call counts, totals and latency percentiles. Phases are timed with context managers:
+
+    timer = PhaseTimer()
+    with timer.phase('controller'):
+        control = controller.update(t, state, flat)
+
+A disabled timer hands out one shared no-op context manager, so the instrumentation can stay in the loops. Timers are
+picklable and merge() combines the timers of several rollouts, e.g. returned by the workers of a sweep, into one
+report. instrument() times the method of an existing object, for loops that cannot be edited (rotorpy's Environment).
+"""
+import functools
+from time import perf_counter
+import numpy as np
+
+PERCENTILES = (50, 90, 99)
+
+
+class _NullPhase(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase(object):
+    """
+    Timing context manager of one phase, collecting the duration of each call.
+    """
+    __slots__ = ('samples', '_start')
+
+    def __init__(self):
+        self.samples = []
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.samples.append(perf_counter() - self._start)
+        return False
+
+
+class PhaseTimer(object):
+    """
+    Wall-clock timer of the phases of a loop. Phases are reported in the order they were first entered.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.phases = {}
+
+    def phase(self, name):
+        """
+        Context manager timing one call of phase name. A phase must not be nested in itself.
+        """
+        if not self.enabled:
+            return _NULL_PHASE
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = _Phase()
+        return phase
+
+    def samples(self, name):
+        return np.asarray(self.phases[name].samples) if name in self.phases else np.zeros(0)
+
+    def merge(self, *timers):
+        """
+        Adds the samples of the other timers to this one and returns it.
+        """
+        for timer in timers:
+            for name, phase in timer.phases.items():
+                if name not in self.phases:
+                    self.phases[name] = _Phase()
+                self.phases[name].samples.extend(phase.samples)
+        return self
+
+    def report(self):
+        """
+        Dict of the phase statistics {phase: {count, total, mean, p50, p90, p99, max, fraction}}, times in seconds,
+        fraction being the share of the total time of all phases.
+        """
+        totals = {name: float(np.sum(phase.samples)) for name, phase in self.phases.items()}
+        grand_total = sum(totals.values())
+        report = {}
+        for name, phase in self.phases.items():
+            samples = np.asarray(phase.samples)
+            if samples.size == 0:
+                continue
+            stats = {'count': int(samples.size), 'total': totals[name], 'mean': float(samples.mean())}
+            for q, value in zip(PERCENTILES, np.percentile(samples, PERCENTILES)):
+                stats['p{}'.format(q)] = float(value)
+            stats['max'] = float(samples.max())
+            stats['fraction'] = totals[name] / grand_total if grand_total > 0 else float('nan')
+            report[name] = stats
+        return report
+
+    def format_report(self):
+        """
+        The report as a table, latencies in microseconds.
+        """
+        lines = ['{:<12s} {:>9s} {:>10s} {:>7s} {:>9s} {:>9s} {:>9s} {:>9s} {:>9s}'.format(
+            'phase', 'calls', 'total [s]', 'share', 'mean [us]', 'p50 [us]', 'p90 [us]', 'p99 [us]', 'max [us]')]
+        for name, stats in self.report().items():
+            lines.append('{:<12s} {:>9d} {:>10.3f} {:>6.1f}% {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+                name, stats['count'], stats['total'], 100*stats['fraction'],
+                *(1e6*stats[key] for key in ('mean', 'p50', 'p90', 'p99', 'max'))))
+        return '\n'.join(lines)
+
+
+def merge_timers(timers):
+    """
+    One timer with the samples of all timers (None entries are skipped).
+    """
+    return PhaseTimer().merge(*(timer for timer in timers if timer is not None))
+
+
+def instrument(obj, method, timer, name):
+    """
+    Replaces obj.method by a wrapper timing each call as phase name of timer. Returns obj.
+    """
+    wrapped = getattr(obj, method)
+
+    @functools.wraps(wrapped)
+    def timed(*args, **kwargs):
+        with timer.phase(name):
+            return wrapped(*args, **kwargs)
+    setattr(obj, method, timed)
+    return obj
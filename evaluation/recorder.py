@@ -0,0 +1,63 @@
+"""
+Preallocated struct-of-arrays log of a rollout.
+
+Instead of keeping one dict per step and merging them at the end (rotorpy.simulate.merge_dicts), RolloutRecorder copies
+each recorded step into fixed-shape float buffers, one per field, allocated on the first record from the shapes of
+its values. The result has the merge_dicts layout: time of shape (N,) and, per group (e.g. states, controls), one
+array of shape (N, ...) per field.
+"""
+import numpy as np
+
+
+class RolloutRecorder(object):
+    """
+    Records every decimation-th step of a rollout of num_steps steps.
+    """
+    def __init__(self, num_steps, decimation=1):
+        """
+        Parameters:
+            num_steps, number of steps of the rollout (including the initial one)
+            decimation, only steps that are multiples of decimation are recorded
+        """
+        if decimation < 1:
+            raise ValueError('decimation must be a positive integer, got {}'.format(decimation))
+        self.decimation = int(decimation)
+        self.capacity = (num_steps + self.decimation - 1) // self.decimation
+        self.time = self._allocate('time', (self.capacity,))
+        self.groups = {}
+        self.size = 0
+
+    def record(self, step, t, **groups):
+        """
+        Records the dicts given as keyword arguments (e.g. states=state, controls=control) at time t if step is
+        recorded. The dicts must have the same keys and value shapes at every call.
+        """
+        if step % self.decimation:
+            return
+        if self.size == self.capacity:
+            raise IndexError('RolloutRecorder is full ({} records)'.format(self.capacity))
+        i = self.size
+        self.time[i] = t
+        for name, values in groups.items():
+            buffers = self.groups.get(name)
+            if buffers is None:
+                buffers = self.groups[name] = {key: self._allocate(name, (self.capacity,) + np.shape(value), key)
+                                               for key, value in values.items()}
+            for key, value in values.items():
+                buffers[key][i] = value
+        self.size += 1
+
+    def _allocate(self, name, shape, key=None):
+        """
+        Buffer of the field key of group name (or of the time if key is None).
+        """
+        return np.empty(shape)
+
+    def arrays(self):
+        """
+        Returns time and a dict of {group: {field: array}} of the recorded steps. The arrays are views of the
+        buffers, trimmed to the number of records.
+        """
+        return self.time[:self.size], {name: {key: buffer[:self.size] for key, buffer in buffers.items()}
+                                       for name, buffers in self.groups.items()}
+
@@ -0,0 +1,104 @@
+"""
+Closed-loop rollout of a vehicle and a controller along a trajectory, shared by run_eval.run_sim and the sweep engine.
+"""
+import numpy as np
+from controller.trajectory_sampling import sample_trajectory, flat_output_at
+from evaluation.recorder import RolloutRecorder
+from evaluation.storage import RolloutWriter
+from evaluation.profiling import PhaseTimer
+
+
+def simulation_times(t_final, t_step):
+    """
+    Simulation times from 0 until t_final is reached, accumulated step by step like the original run_sim loop.
+    """
+    time = [0]
+    while time[-1] < t_final:
+        time.append(time[-1] + t_step)
+    return np.array(time, dtype=float)
+
+
+def rollout(vehicle, controller, trajectory, t_offset, t_final, t_step, decimation=1, output_dir=None,
+            wind_profile=None, timer=None):
+    """
+    Simulates vehicle tracking trajectory with controller.
+    Inputs:
+        vehicle: a rotorpy vehicle, e.g. Multirotor.
+        controller: any controller with update(t, state, flat_output).
+        trajectory: the trajectory object for this mav to track. 
+        t_offset: time offset (useful for offsetting multiple mavs on the same trajectory). 
+        t_final: duration of the sim for this object. 
+        t_step: timestep for the simulation. 
+        decimation: only every decimation-th step is returned. 
+        output_dir: if given, the rollout is streamed to this directory (see evaluation/storage.py) instead of returned. 
+        wind_profile: optional rotorpy wind profile, evaluated before every step like rotorpy.simulate does. 
+        timer: optional evaluation.profiling.PhaseTimer, timing the trajectory, wind, vehicle, controller and logging
+               phases of the loop. 
+    Outputs:
+        time, states, controls, flats as struct-of-arrays,
+    or, with output_dir:
+        output_dir: the rollout directory, to be read with evaluation.storage.load_rollout. 
+        summary: dict of summary metrics (see rollout_summary). 
+    """
+    if timer is None:
+        timer = PhaseTimer(enabled=False)
+
+    # Simulation times and the flat outputs for all of them at once.
+    time = simulation_times(t_final, t_step)
+    with timer.phase('trajectory'):
+        flats = sample_trajectory(trajectory, time + t_offset)
+        flat = flat_output_at(flats, 0)
+
+    # Init mav at the first waypoint for the trajectory.
+    x0 = {'x': flats['x'][0],
+        'v': np.zeros(3,),
+        'q': np.array([0, 0, 0, 1]), # [i,j,k,w]
+        'w': np.zeros(3,),
+        'wind': np.array([0,0,0]),  # Since wind is handled elsewhere, this value is overwritten
+        'rotor_speeds': np.array([1788.53, 1788.53, 1788.53, 1788.53])}
+    if wind_profile is not None:
+        x0['wind'] = wind_profile.update(time[0], x0['x'])
+
+    if output_dir is None:
+        recorder = RolloutRecorder(len(time), decimation)
+    else:
+        recorder = RolloutWriter(output_dir, len(time), decimation)
+    state = x0
+    with timer.phase('controller'):
+        control = controller.update(time[0], state, flat)
+    with timer.phase('logging'):
+        recorder.record(0, time[0], states=state, controls=control)
+
+    for i in range(1, len(time)):
+        if wind_profile is not None:
+            with timer.phase('wind'):
+                state['wind'] = wind_profile.update(time[i], state['x'])
+        with timer.phase('vehicle'):
+            state = vehicle.step(state, control, t_step)
+        with timer.phase('trajectory'):
+            flat_output_at(flats, i, flat)
+        with timer.phase('controller'):
+            control = controller.update(time[i], state, flat)
+        with timer.phase('logging'):
+            recorder.record(i, time[i], states=state, controls=control)
+
+    time, logs = recorder.arrays()
+    flats = {key: values[::decimation] for key, values in flats.items()}
+
+    if output_dir is not None:
+        recorder.write_group('flats', flats)
+        summary = rollout_summary(time, logs['states'], flats)
+        return recorder.close(**summary), summary
+
+    return time, logs['states'], logs['controls'], flats
+
+
+def rollout_summary(time, states, flats):
+    """
+    Summary metrics of a rollout: duration, number of records and the position tracking error (RMS and max, m).
+    """
+    pos_error = np.linalg.norm(states['x'] - flats['x'], axis=-1)
+    return {'t_final': float(time[-1]),
+            'num_records': len(time),
+            'rms_pos_error': float(np.sqrt(np.mean(pos_error**2))),
+            'max_pos_error': float(np.max(pos_error))}
@@ -0,0 +1,110 @@
+"""
+Streaming of rollouts to disk.
+
+RolloutWriter is a RolloutRecorder whose buffers are .npy files opened as memory maps, one file per field, in a
+directory per rollout. Records go straight to the page cache and are flushed every flush_every records, so a worker
+never holds its rollout in memory and can return only the directory (and summary metrics) to the parent process.
+load_rollout memory-maps the files again for the analysis.
+
+Layout of a rollout directory:
+    time.npy                    (N,)
+    <group>.<field>.npy         (N, ...) e.g. states.x.npy, controls.cmd_motor_speeds.npy, flats.x.npy
+    meta.json                   number of records and any metadata given to close()
+The files are allocated for the full rollout; only the first meta.json['size'] rows are valid.
+"""
+import os
+import json
+import numpy as np
+from numpy.lib.format import open_memmap
+from evaluation.recorder import RolloutRecorder
+
+META_FILE = 'meta.json'
+
+
+def _field_file(name, key=None):
+    return name + '.npy' if key is None else '{}.{}.npy'.format(name, key)
+
+
+class RolloutWriter(RolloutRecorder):
+    """
+    Records a rollout into memory-mapped .npy files in directory.
+    """
+    def __init__(self, directory, num_steps, decimation=1, flush_every=1000):
+        """
+        Parameters:
+            directory, output directory of the rollout, created if needed
+            num_steps, number of steps of the rollout (including the initial one)
+            decimation, only steps that are multiples of decimation are recorded
+            flush_every, number of records between flushes to disk
+        """
+        self.directory = directory
+        self.flush_every = flush_every
+        os.makedirs(directory, exist_ok=True)
+        if os.path.exists(os.path.join(directory, META_FILE)):
+            os.remove(os.path.join(directory, META_FILE))  # incomplete until closed again
+        super().__init__(num_steps, decimation)
+
+    def _allocate(self, name, shape, key=None):
+        return open_memmap(os.path.join(self.directory, _field_file(name, key)), mode='w+', dtype=np.float64,
+                           shape=shape)
+
+    def record(self, step, t, **groups):
+        size = self.size
+        super().record(step, t, **groups)
+        if self.size != size and self.size % self.flush_every == 0:
+            self.flush()
+
+    def write_group(self, name, arrays):
+        """
+        Writes whole arrays of a group at once (e.g. precomputed flat outputs), each with one row per record.
+        """
+        for key, values in arrays.items():
+            values = np.asarray(values, dtype=np.float64)
+            buffer = open_memmap(os.path.join(self.directory, _field_file(name, key)), mode='w+', dtype=np.float64,
+                                 shape=values.shape)
+            buffer[:] = values
+            buffer.flush()
+            del buffer
+
+    def flush(self):
+        self.time.flush()
+        for buffers in self.groups.values():
+            for buffer in buffers.values():
+                buffer.flush()
+
+    def close(self, **metadata):
+        """
+        Flushes the files and writes meta.json, which marks the rollout as complete. Returns the directory.
+        """
+        self.flush()
+        meta = dict(metadata, size=self.size, decimation=self.decimation)
+        with open(os.path.join(self.directory, META_FILE), 'w') as f:
+            json.dump(meta, f)
+        return self.directory
+
+
+def load_rollout(directory, mmap_mode='r'):
+    """
+    Returns time and a dict of {group: {field: array}} of a rollout written by RolloutWriter, memory-mapped unless
+    mmap_mode is None. Raises FileNotFoundError if the rollout was not closed.
+    """
+    with open(os.path.join(directory, META_FILE)) as f:
+        size = json.load(f)['size']
+    time = None
+    groups = {}
+    for file_name in sorted(os.listdir(directory)):
+        if not file_name.endswith('.npy'):
+            continue
+        values = np.load(os.path.join(directory, file_name), mmap_mode=mmap_mode)[:size]
+        name = file_name[:-len('.npy')]
+        if name == 'time':
+            time = values
+        else:
+            group, key = name.split('.', 1)
+            groups.setdefault(group, {})[key] = values
+    return time, groups
+
+
+def load_metadata(directory):
+    with open(os.path.join(directory, META_FILE)) as f:
+        return json.load(f)
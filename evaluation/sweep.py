@@ -0,0 +1,262 @@
+"""
+Parallel sweep over a declarative grid of simulation settings.
+
+A grid maps each axis to its named values:
+    controller      name -> factory called with the nominal quad_params, e.g. SE3Control. Factories with a
+                    trajectory parameter, e.g. functools.partial(ModelPredictiveControl, sim_rate=100, t_horizon=0.5,
+                    n_nodes=10), are also given the trajectory of the task and t_final (the trajectory offset is not
+                    applied to their reference)
+    trajectory      name -> trajectory object, or (trajectory, t_offset)
+    wind            name -> rotorpy wind profile, or None (default {'none': None})
+    perturbation    name -> dict {quad_params key: scale factor} applied to the simulated vehicle only
+                    (default {'nominal': {}})
+    seed            list of ints seeding np.random (motor noise), default [0]
+and the sweep runs every combination. Each task streams its rollout to <output_dir>/<task_id> with RolloutWriter,
+whose meta.json doubles as the completion marker: with resume, completed tasks are skipped and their summaries read
+back. Tasks are scheduled with imap_unordered in chunks, and each task can be given a wall-clock timeout. Worker
+processes keep their vehicles and resettable controllers between tasks. With profile, each result carries the
+PhaseTimer of its rollout (see evaluation/profiling.py), to be merged into one report with merge_timers.
+"""
+import os
+import time
+import signal
+import inspect
+import itertools
+import multiprocessing
+import numpy as np
+from rotorpy.vehicles.multirotor import Multirotor
+from evaluation.rollout import rollout
+from evaluation.storage import META_FILE, load_metadata
+from evaluation.profiling import PhaseTimer
+
+SWEEP_AXES = ('controller', 'trajectory', 'wind', 'perturbation', 'seed')
+DEFAULT_AXES = {'wind': {'none': None}, 'perturbation': {'nominal': {}}, 'seed': [0]}
+
+
+class TaskTimeout(BaseException):
+    """
+    Raised by SIGALRM when a task runs out of time. A BaseException, like KeyboardInterrupt, so that the broad
+    'except Exception' handlers of the simulated code cannot swallow it.
+    """
+
+
+def _raise_timeout(signum, frame):
+    raise TaskTimeout()
+
+
+def perturb_params(quad_params, scales):
+    """
+    Copy of quad_params with the entries of scales multiplied by their scale factor.
+    """
+    params = dict(quad_params)
+    for key, scale in scales.items():
+        params[key] = quad_params[key] * scale
+    return params
+
+
+class Sweep(object):
+    """
+    Grid of simulation tasks sharing a vehicle model, duration and timestep.
+    """
+    def __init__(self, grid, quad_params, t_final=10, t_step=1/100, decimation=1, output_dir='sweep_out',
+                 profile=False):
+        """
+        Parameters:
+            grid, dict of axes as described in the module docstring
+            quad_params, nominal vehicle parameters
+            t_final, t_step, decimation, passed to evaluation.rollout.rollout
+            output_dir, directory of the rollouts, one subdirectory per task
+            profile, time the phases of each rollout and return the timer in the task result ('timer')
+        """
+        unknown = set(grid) - set(SWEEP_AXES)
+        if unknown:
+            raise ValueError('Unknown sweep axes {}, expected some of {}'.format(sorted(unknown), SWEEP_AXES))
+        self.grid = dict(DEFAULT_AXES, **grid)
+        for axis in ('controller', 'trajectory'):
+            if not self.grid.get(axis):
+                raise ValueError("The sweep grid needs at least one '{}'".format(axis))
+        self.quad_params = quad_params
+        self.t_final = t_final
+        self.t_step = t_step
+        self.decimation = decimation
+        self.output_dir = os.path.abspath(output_dir)
+        self.profile = profile
+        # Controllers and vehicles built by this process, reused across its tasks (see controller_for, vehicle_for)
+        self.controllers = {}
+        self.vehicles = {}
+        # Trajectory name each cached trajectory-bound controller currently tracks
+        self.controller_targets = {}
+
+    def tasks(self):
+        """
+        All tasks of the grid, as dicts of the value names per axis plus a unique task_id.
+        """
+        names = [list(self.grid[axis]) for axis in SWEEP_AXES]
+        tasks = []
+        for combination in itertools.product(*names):
+            task = dict(zip(SWEEP_AXES, combination))
+            task['task_id'] = '{controller}__{trajectory}__{wind}__{perturbation}__seed{seed}'.format(**task)
+            tasks.append(task)
+        return tasks
+
+    def task_dir(self, task):
+        return os.path.join(self.output_dir, task['task_id'])
+
+    def is_complete(self, task):
+        return os.path.exists(os.path.join(self.task_dir(task), META_FILE))
+
+    def trajectory_for(self, name):
+        """
+        Trajectory and time offset of the grid entry name.
+        """
+        trajectory = self.grid['trajectory'][name]
+        return trajectory if isinstance(trajectory, tuple) else (trajectory, 0)
+
+    def controller_for(self, name, trajectory_name):
+        """
+        Controller of the grid entry name for a task on the trajectory trajectory_name. Controllers with a reset()
+        method are built once per process and reset before each task, which amortizes expensive setups (e.g. the MPC
+        solver); others are built for every task. Controllers bound to a trajectory (see the module docstring) are
+        re-targeted with reset(trajectory=..., t_final=...) when the task's trajectory differs from the one they track.
+        """
+        factory = self.grid['controller'][name]
+        bound = _takes_trajectory(factory)
+        trajectory = self.trajectory_for(trajectory_name)[0] if bound else None
+        controller = self.controllers.get(name)
+        if controller is None:
+            if bound:
+                controller = factory(self.quad_params, trajectory=trajectory, t_final=self.t_final)
+            else:
+                controller = factory(self.quad_params)
+            if not hasattr(controller, 'reset'):
+                return controller
+            self.controllers[name] = controller
+            self.controller_targets[name] = trajectory_name
+        elif bound and self.controller_targets[name] != trajectory_name:
+            controller.reset(trajectory=trajectory, t_final=self.t_final)
+            self.controller_targets[name] = trajectory_name
+        else:
+            controller.reset()
+        return controller
+
+    def vehicle_for(self, name):
+        """
+        Vehicle with the parameter perturbation name, built once per process (Multirotor.step keeps no state).
+        """
+        if name not in self.vehicles:
+            self.vehicles[name] = Multirotor(perturb_params(self.quad_params, self.grid['perturbation'][name]))
+        return self.vehicles[name]
+
+    def run_task(self, task, timeout=None):
+        """
+        Simulates one task and returns its result dict: task_id, status ('ok', 'timeout' or 'error'), wall_time
+        and, when completed, the rollout summary (see evaluation.rollout.rollout_summary).
+        """
+        result = {'task_id': task['task_id']}
+        timer = PhaseTimer() if self.profile else None
+        tic = time.perf_counter()
+        if timeout is not None:
+            previous_handler = signal.signal(signal.SIGALRM, _raise_timeout)
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            trajectory, t_offset = self.trajectory_for(task['trajectory'])
+            np.random.seed(task['seed'])
+            vehicle = self.vehicle_for(task['perturbation'])
+            controller = self.controller_for(task['controller'], task['trajectory'])
+            _, result['summary'] = rollout(vehicle, controller, trajectory, t_offset, self.t_final, self.t_step,
+                                           self.decimation, self.task_dir(task), self.grid['wind'][task['wind']],
+                                           timer)
+            result['status'] = 'ok'
+        except TaskTimeout:
+            result['status'] = 'timeout'
+        except Exception as e:
+            result['status'] = 'error'
+            result['error'] = '{}: {}'.format(type(e).__name__, e)
+        finally:
+            if timeout is not None:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, previous_handler)
+        result['wall_time'] = time.perf_counter() - tic
+        if timer is not None:
+            result['timer'] = timer
+        return result
+
+    def run(self, processes=None, chunksize=None, timeout=None, resume=True, callback=None):
+        """
+        Runs the tasks of the grid and returns their results in grid order.
+
+        Parameters:
+            processes, size of the process pool (default: number of CPUs); 1 runs the tasks in this process
+            chunksize, number of tasks sent to a worker at once (default: about four chunks per worker)
+            timeout, wall-clock limit of a task in seconds (SIGALRM based, Unix only), None for no limit
+            resume, skip the tasks whose rollout is already complete in output_dir; their result has status 'cached'
+            callback, called with each result as it arrives
+        """
+        tasks = self.tasks()
+        results = {}
+        pending = []
+        for task in tasks:
+            if resume and self.is_complete(task):
+                meta = load_metadata(self.task_dir(task))
+                results[task['task_id']] = {'task_id': task['task_id'], 'status': 'cached', 'wall_time': 0.0,
+                                            'summary': meta}
+            else:
+                pending.append(task)
+
+        processes = processes or os.cpu_count()
+        if pending and processes == 1:
+            _init_worker(self, timeout)
+            self._collect(map(_run_task, pending), results, callback)
+        elif pending:
+            if chunksize is None:
+                chunksize = max(1, len(pending) // (4 * processes))
+            with multiprocessing.Pool(min(processes, len(pending)), initializer=_init_worker,
+                                      initargs=(self, timeout)) as pool:
+                self._collect(pool.imap_unordered(_run_task, pending, chunksize), results, callback)
+        return [results[task['task_id']] for task in tasks]
+
+    @staticmethod
+    def _collect(outcomes, results, callback):
+        for result in outcomes:
+            results[result['task_id']] = result
+            if callback is not None:
+                callback(result)
+
+
+def _takes_trajectory(factory):
+    """
+    Whether the controller factory has a trajectory parameter.
+    """
+    try:
+        return 'trajectory' in inspect.signature(factory).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+# State of a worker process, set once by the pool initializer instead of being sent with every task. Each worker
+# gets its own copy of the sweep, and so its own controller and vehicle caches.
+_worker_sweep = None
+_worker_timeout = None
+
+
+def _init_worker(sweep, timeout):
+    global _worker_sweep, _worker_timeout
+    _worker_sweep = sweep
+    _worker_timeout = timeout
+
+
+def _run_task(task):
+    return _worker_sweep.run_task(task, _worker_timeout)
+
+
+def summarize(results, wall_time=None):
+    """
+    Counts of the task statuses and, if wall_time is given, the throughput in tasks per second.
+    """
+    summary = {status: sum(result['status'] == status for result in results)
+               for status in ('ok', 'cached', 'timeout', 'error')}
+    if wall_time is not None:
+        summary['wall_time'] = wall_time
+        summary['tasks_per_second'] = (summary['ok'] + summary['timeout'] + summary['error']) / wall_time \
+            if wall_time > 0 else float('nan')
+    return summary
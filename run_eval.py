@@ -12,7 +12,11 @@ from rotorpy.trajectories.speed_traj import ConstantSpeed
 from rotorpy.trajectories.minsnap import MinSnap 
 from rotorpy.world import World
 from rotorpy.utils.animate import animate
-from rotorpy.simulate import merge_dicts
+from evaluation.rollout import rollout
+from evaluation.storage import load_rollout
+from evaluation.collisions import find_collisions
+from evaluation.sweep import Sweep, summarize
+from evaluation.profiling import merge_timers
 
 import numpy as np
 import matplotlib
@@ -20,11 +24,12 @@ import matplotlib.pyplot as plt
 from scipy.spatial.transform import Rotation
 import os
 import yaml
-import multiprocessing
+import argparse
+from time import perf_counter
 
 ####################### Helper functions
 
-def run_sim(trajectory, t_offset, t_final=10, t_step=1/100):
+def run_sim(trajectory, t_offset, t_final=10, t_step=1/100, decimation=1, output_dir=None, timer=None):
     """
     Runs an instance of the simulation environment which creates a vehicle object and tracking controller on
     an individual cpu process using Python's multiprocessing. 
@@ -33,145 +38,126 @@ def run_sim(trajectory, t_offset, t_final=10, t_step=1/100):
         t_offset: time offset (useful for offsetting multiple mavs on the same trajectory). 
         t_final: duration of the sim for this object. 
         t_step: timestep for the simulation. 
+        decimation: only every decimation-th step is returned. 
+        output_dir: if given, the rollout is streamed to this directory (see evaluation/storage.py) instead of returned. 
+        timer: optional evaluation.profiling.PhaseTimer timing the phases of the simulation loop. 
     Outputs:
         time: time array. 
         states: array of quadrotor states. 
         controls: array of quadrotor control variables. 
         flats: array of flat outputs describing the trajectory to track. 
+    or, with output_dir:
+        output_dir: the rollout directory, to be read with evaluation.storage.load_rollout. 
+        summary: dict of summary metrics (see evaluation.rollout.rollout_summary). 
     """
     mav = Multirotor(quad_params)
     controller = SE3Control(quad_params)
 
-    # Init mav at the first waypoint for the trajectory.
-    x0 = {'x': trajectory.update(t_offset)['x'],
-        'v': np.zeros(3,),
-        'q': np.array([0, 0, 0, 1]), # [i,j,k,w]
-        'w': np.zeros(3,),
-        'wind': np.array([0,0,0]),  # Since wind is handled elsewhere, this value is overwritten
-        'rotor_speeds': np.array([1788.53, 1788.53, 1788.53, 1788.53])}
-    
-    time = [0]
-    states = [x0]
-    flats = [trajectory.update(time[-1] + t_offset)]
-    controls = [controller.update(time[-1], states[-1], flats[-1])]
-
-    while True:
-        if time[-1] >= t_final:
-            break
-        time.append(time[-1] + t_step)
-        states.append(mav.step(states[-1], controls[-1], t_step))
-        flats.append(trajectory.update(time[-1] + t_offset))
-        controls.append(controller.update(time[-1], states[-1], flats[-1]))
-
-    time        = np.array(time, dtype=float)    
-    states      = merge_dicts(states)
-    controls    = merge_dicts(controls)
-    flats       = merge_dicts(flats)
-
-    return time, states, controls, flats
-
-def worker_fn(cfg):
+    return rollout(mav, controller, trajectory, t_offset, t_final, t_step, decimation, output_dir, timer=timer)
+
+def build_grid():
     """
-    Enumerates over the configurations for each process in multiprocessing.
+    The sweep grid (see evaluation/sweep.py): a swarm of Lissajous maneuvers offset in time and space, and a swarm of
+    MAVs following MinSnap trajectories between two rings, tracked by the SE3 controller.
     """
-    return run_sim(*cfg)
-
-def find_collisions(all_positions, epsilon=1e-1):
+    trajectories = {}
+    for i, (x_offset, t_offset) in enumerate([(-0.5, 0), (-0.25, 0.5), (0.0, 1.0), (0.25, 1.5), (0.50, 2.0)]):
+        trajectories['lissajous{}'.format(i)] = (TwoDLissajous(A=1, B=1, a=2, b=1, x_offset=x_offset, y_offset=0, height=2.0), t_offset)
+
+    # Programmatic construction of a swarm of MAVs following a MinSnap trajectory. 
+    Nc = 7
+    R = 0.5
+    for i in range(Nc):
+        x0 = np.array([-2 + R*np.cos(i*2*np.pi/Nc), R*np.sin(i*2*np.pi/Nc), 0])
+        xf = np.array([ 2 + R*np.cos(i*2*np.pi/Nc), R*np.sin(i*2*np.pi/Nc), 0])
+        trajectories['minsnap{}'.format(i)] = MinSnap(points=np.row_stack((x0, xf)), v_avg=1.0, verbose=False)
+
+    return {'controller': {'se3': SE3Control},
+            'trajectory': trajectories,
+            'wind': {'none': None},
+            'perturbation': {'nominal': {}},
+            'seed': [0]}
+
+def plot_swarm(results, output_dir, world):
     """
-    Checks if any two agents get within epsilon meters of any other agent. 
-    Inputs:
-        all_positions: the position vs time for each agent concatenated into one array. 
-        epsilon: the distance threshold constituting a collision. 
-    Outputs:
-        collisions: a list of dictionaries where each dict describes the time of a collision, agents involved, and the location. 
+    Animates the completed rollouts together and plots their paths alongside collision events (when applicable). 
     """
-
-    N, M, _ = all_positions.shape
-    collisions = []
-
-    for t in range(N):
-        # Get positions. 
-        pos_t = all_positions[t]
-
-        dist_sq = np.sum((pos_t[:, np.newaxis, :] - pos_t[np.newaxis, :, :])**2, axis=-1)
-
-        # Set diagonal to a large value to avoid false positives. 
-        np.fill_diagonal(dist_sq, np.inf)
-
-        close_pairs = np.where(dist_sq < epsilon**2)
-
-        for i, j in zip(*close_pairs):
-            if i < j: # avoid duplicate pairs.
-                collision_info = {
-                    "timestep": t,
-                    "agents": (i, j),
-                    "location": pos_t[i]
-                }
-                collisions.append(collision_info)
-
-    return collisions
+    # Concatentate all the relevant states/inputs for animation. 
+    all_pos = []
+    all_rot = []
+    all_wind = []
+    all_time = None
+
+    for r in results:
+        if r['status'] not in ('ok', 'cached'):
+            continue
+        all_time, logs = load_rollout(os.path.join(output_dir, r['task_id']))
+        all_pos.append(logs['states']['x'])
+        all_wind.append(logs['states']['wind'])
+        all_rot.append(Rotation.from_quat(logs['states']['q']).as_matrix())
+
+    all_pos = np.stack(all_pos, axis=1)
+    all_wind = np.stack(all_wind, axis=1)
+    all_rot = np.stack(all_rot, axis=1)
+
+    # Check for collisions.
+    collisions = find_collisions(all_pos, epsilon=2e-1)
+    print('{} collision events'.format(len(collisions)))
+
+    # Animate. 
+    ani = animate(all_time, all_pos, all_rot, all_wind, animate_wind=False, world=world, filename=None)
+
+    # Plot the positions of each agent in 3D, alongside collision events (when applicable)
+    fig = plt.figure()
+    ax = fig.add_subplot(projection='3d')
+    colors = plt.cm.tab10(range(all_pos.shape[1]))
+    for mav in range(all_pos.shape[1]):
+        ax.plot(all_pos[:, mav, 0], all_pos[:, mav, 1], all_pos[:, mav, 2], color=colors[mav])
+        ax.plot([all_pos[-1, mav, 0]], [all_pos[-1, mav, 1]], [all_pos[-1, mav, 2]], '*', markersize=10, markerfacecolor=colors[mav], markeredgecolor='k')
+    world.draw(ax)
+    for event in collisions:
+        ax.plot([all_pos[event['timestep'], event['agents'][0], 0]], [all_pos[event['timestep'], event['agents'][0], 1]], [all_pos[event['timestep'], event['agents'][0], 2]], 'rx', markersize=10)
+    ax.set_xlabel("x, m")
+    ax.set_ylabel("y, m")
+    ax.set_zlabel("z, m")
+
+    plt.show()
 
 ####################### Start of user code
 
-# Construct the world.
-world = World.empty([-3, 3, -3, 3, -3, 3])
-
-# Generate a list of configurations to run in parallel. Each config has a trajectory, time offset, sim duration, and sim time discretization.
-dt = 1/100
-tf = 10
-
-# Hard coded list of Lissajous maneuvers. 
-config_list = [(TwoDLissajous(A=1, B=1, a=2, b=1, x_offset=-0.5, y_offset=0, height=2.0), 0, tf, dt),
-               (TwoDLissajous(A=1, B=1, a=2, b=1, x_offset=-0.25, y_offset=0, height=2.0), 0.5, tf, dt),
-               (TwoDLissajous(A=1, B=1, a=2, b=1, x_offset=0.0, y_offset=0, height=2.0), 1.0, tf, dt),
-               (TwoDLissajous(A=1, B=1, a=2, b=1, x_offset=0.25, y_offset=0, height=2.0), 1.5, tf, dt),
-               (TwoDLissajous(A=1, B=1, a=2, b=1, x_offset=0.50, y_offset=0, height=2.0), 2.0, tf, dt)]
-
-# Programmatic construction of a swarm of MAVs following a MinSnap trajectory. 
-Nc = 7
-R = 0.5
-for i in range(Nc):
-    x0 = np.array([-2 + R*np.cos(i*2*np.pi/Nc), R*np.sin(i*2*np.pi/Nc), 0])
-    xf = np.array([ 2 + R*np.cos(i*2*np.pi/Nc), R*np.sin(i*2*np.pi/Nc), 0])
-    config_list.append((MinSnap(points=np.row_stack((x0, xf)), v_avg=1.0, verbose=False), 0, tf, dt))
-
-# Run RotorPy in parallel. 
-with multiprocessing.Pool() as pool:
-    results = pool.map(worker_fn, config_list)
-
-# Concatentate all the relevant states/inputs for animation. 
-all_pos = []
-all_rot = []
-all_wind = []
-all_time = results[0][0]
-
-for r in results:
-    all_pos.append(r[1]['x'])
-    all_wind.append(r[1]['wind'])
-    all_rot.append(Rotation.from_quat(r[1]['q']).as_matrix())
-
-all_pos = np.stack(all_pos, axis=1)
-all_wind = np.stack(all_wind, axis=1)
-all_rot = np.stack(all_rot, axis=1)
-
-# Check for collisions.
-collisions = find_collisions(all_pos, epsilon=2e-1)
-
-# Animate. 
-ani = animate(all_time, all_pos, all_rot, all_wind, animate_wind=False, world=world, filename=None)
-
-# Plot the positions of each agent in 3D, alongside collision events (when applicable)
-fig = plt.figure()
-ax = fig.add_subplot(projection='3d')
-colors = plt.cm.tab10(range(all_pos.shape[1]))
-for mav in range(all_pos.shape[1]):
-    ax.plot(all_pos[:, mav, 0], all_pos[:, mav, 1], all_pos[:, mav, 2], color=colors[mav])
-    ax.plot([all_pos[-1, mav, 0]], [all_pos[-1, mav, 1]], [all_pos[-1, mav, 2]], '*', markersize=10, markerfacecolor=colors[mav], markeredgecolor='k')
-world.draw(ax)
-for event in collisions:
-    ax.plot([all_pos[event['timestep'], event['agents'][0], 0]], [all_pos[event['timestep'], event['agents'][0], 1]], [all_pos[event['timestep'], event['agents'][0], 2]], 'rx', markersize=10)
-ax.set_xlabel("x, m")
-ax.set_ylabel("y, m")
-ax.set_zlabel("z, m")
-
-plt.show()
\ No newline at end of file
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs the sweep grid of build_grid() in parallel.')
+    parser.add_argument('--processes', type=int, default=None, help='size of the process pool (default: number of CPUs)')
+    parser.add_argument('--chunksize', type=int, default=None, help='tasks sent to a worker at once')
+    parser.add_argument('--timeout', type=float, default=None, help='wall-clock limit of a task, s')
+    parser.add_argument('--output-dir', default='sweep_out', help='directory of the rollouts')
+    parser.add_argument('--no-resume', action='store_true', help='rerun the tasks that are already complete')
+    parser.add_argument('--t-final', type=float, default=10, help='duration of each sim, s')
+    parser.add_argument('--dt', type=float, default=1/100, help='timestep of the sims, s')
+    parser.add_argument('--animate', action='store_true', help='animate the swarm and plot collisions afterwards')
+    parser.add_argument('--profile', action='store_true', help='time the phases of the simulation loops')
+    args = parser.parse_args()
+
+    # Construct the world.
+    world = World.empty([-3, 3, -3, 3, -3, 3])
+
+    sweep = Sweep(build_grid(), quad_params, t_final=args.t_final, t_step=args.dt, output_dir=args.output_dir,
+                  profile=args.profile)
+    tic = perf_counter()
+    results = sweep.run(processes=args.processes, chunksize=args.chunksize, timeout=args.timeout,
+                        resume=not args.no_resume,
+                        callback=lambda r: print('{:<48s} {:<8s} {:7.2f} s'.format(r['task_id'], r['status'], r['wall_time'])))
+    wall_time = perf_counter() - tic
+
+    print('{:<48s} {:<8s} {:>10s} {:>10s}'.format('task', 'status', 'rms [m]', 'max [m]'))
+    for r in results:
+        summary = r.get('summary', {})
+        print('{:<48s} {:<8s} {:>10.3f} {:>10.3f}'.format(r['task_id'], r['status'], summary.get('rms_pos_error', np.nan), summary.get('max_pos_error', np.nan)))
+        if r['status'] == 'error':
+            print('    ' + r['error'])
+    print(summarize(results, wall_time))
+    if args.profile:
+        print(merge_timers(r.get('timer') for r in results).format_report())
+
+    if args.animate:
+        plot_swarm(results, sweep.output_dir, world)
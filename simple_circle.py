@@ -42,6 +42,9 @@ except:
 # Also, worlds are how we construct obstacles. The following class contains methods related to constructing these maps. 
 from rotorpy.world import World
 
+# Per-phase timing of the simulation loop
+from evaluation.profiling import PhaseTimer, instrument
+
 # Reference the files above for more documentation. 
 
 # Other useful imports
@@ -96,6 +99,12 @@ x0 = {'x': np.array([0,0,0]),
       'rotor_speeds': np.array([1788.53, 1788.53, 1788.53, 1788.53])}
 sim_instance.vehicle.initial_state = x0
 
+# Time the trajectory, controller and vehicle calls made by the simulation loop (PhaseTimer(enabled=False) turns it off).
+timer = PhaseTimer()
+instrument(sim_instance.trajectory, 'update', timer, 'trajectory')
+instrument(sim_instance.controller, 'update', timer, 'controller')
+instrument(sim_instance.vehicle, 'step', timer, 'vehicle')
+
 # Executing the simulator as specified above is easy using the "run" method: 
 # All the arguments are listed below with their descriptions. 
 # You can save the animation (if animating) using the fname argument. Default is None which won't save it.
@@ -113,6 +122,9 @@ results = sim_instance.run(t_final      = 5,       # The maximum duration of the
                            fname   = None # Filename is specified if you want to save the animation. The save location is rotorpy/data_out/. 
                     )
 
+print(timer.format_report())
+print(mpc_controller.deadline_report())
+
 # # There are booleans for if you want to plot all/some of the results, animate the multirotor, and 
 # # if you want the simulator to output the EXIT status (end time reached, out of control, etc.)
 # # The results are a dictionary containing the relevant state, input, and measurements vs time.